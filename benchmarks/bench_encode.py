@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Benchmark of the PlantUML encoder.
+
+Compares :func:`plantweb.plantuml.encode` against the previous per-byte
+implementation for inputs from 1 KB to 10 MB.
+
+Usage::
+
+    python benchmarks/bench_encode.py
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+from os import urandom
+from timeit import default_timer
+
+from plantweb.plantuml import encode
+
+
+SIZES = [
+    1024,
+    10 * 1024,
+    100 * 1024,
+    1024 * 1024,
+    10 * 1024 * 1024,
+]
+
+
+def legacy_encode(data):
+    """
+    Previous per-byte implementation, kept for comparison.
+    """
+    res = ''
+    for i in range(0, len(data), 3):
+        if i + 2 == len(data):
+            res += _legacy_encode3bytes(data[i], data[i + 1], 0)
+        elif i + 1 == len(data):
+            res += _legacy_encode3bytes(data[i], 0, 0)
+        else:
+            res += _legacy_encode3bytes(data[i], data[i + 1], data[i + 2])
+    return res
+
+
+def _legacy_encode3bytes(b1, b2, b3):
+    c1 = b1 >> 2
+    c2 = ((b1 & 0x3) << 4) | (b2 >> 4)
+    c3 = ((b2 & 0xF) << 2) | (b3 >> 6)
+    c4 = b3 & 0x3F
+    res = ''
+    res += _legacy_encode6bit(c1 & 0x3F)
+    res += _legacy_encode6bit(c2 & 0x3F)
+    res += _legacy_encode6bit(c3 & 0x3F)
+    res += _legacy_encode6bit(c4 & 0x3F)
+    return res
+
+
+def _legacy_encode6bit(b):
+    if b < 10:
+        return chr(48 + b)
+    b -= 10
+    if b < 26:
+        return chr(65 + b)
+    b -= 26
+    if b < 26:
+        return chr(97 + b)
+    b -= 26
+    if b == 0:
+        return '-'
+    if b == 1:
+        return '_'
+
+
+def measure(func, data):
+    """
+    Best of three runs of the given encoder, in seconds.
+    """
+    best = None
+    for _ in range(3):
+        start = default_timer()
+        func(data)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    print('{:>10}  {:>12}  {:>12}  {:>8}'.format(
+        'size', 'legacy (s)', 'encode (s)', 'speedup'
+    ))
+    for size in SIZES:
+        data = urandom(size)
+        assert encode(data) == legacy_encode(data)
+
+        legacy = measure(legacy_encode, data)
+        current = measure(encode, data)
+
+        print('{:>10}  {:>12.6f}  {:>12.6f}  {:>7.0f}x'.format(
+            size, legacy, current, legacy / current
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,10 +23,13 @@ from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
 import logging
-from os import makedirs
+from sys import argv as sys_argv
+from os import makedirs, cpu_count
 from os.path import isfile, abspath, expanduser
 
 from . import __version__
+from .defaults import read_defaults
+from .cache import MATERIALIZE_METHODS
 
 
 log = logging.getLogger(__name__)
@@ -40,6 +43,11 @@ V_LEVELS = {
     3: logging.DEBUG,
 }
 
+CACHE_ACTIONS = ['stats', 'prune', 'clear', 'verify']
+"""
+Actions of the ``cache`` command.
+"""
+
 
 class InvalidArguments(Exception):
     """
@@ -85,6 +93,12 @@ def validate_args(args):
     if args.format == 'auto':
         args.format = None
 
+    # Check number of jobs
+    if args.jobs < 1:
+        raise InvalidArguments(
+            'The number of jobs must be at least 1'
+        )
+
     # Ensure cache dir
     if not args.no_cache:
         makedirs(expanduser(args.cache_dir), exist_ok=True)
@@ -92,10 +106,166 @@ def validate_args(args):
     return args
 
 
+SIZE_SUFFIXES = {
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+}
+
+
+def parse_size(value):
+    """
+    Parse a size in bytes with an optional ``K``, ``M`` or ``G`` suffix.
+
+    :param str value: Size to parse, for example ``512M``.
+    :return: The size in bytes.
+    :rtype: int
+    """
+    from argparse import ArgumentTypeError
+
+    multiplier = SIZE_SUFFIXES.get(value[-1:].upper(), 1)
+    if multiplier != 1:
+        value = value[:-1]
+
+    try:
+        size = int(float(value) * multiplier)
+    except ValueError:
+        raise ArgumentTypeError('invalid size {}'.format(value))
+
+    if size < 0:
+        raise ArgumentTypeError('size must be positive')
+    return size
+
+
+def parse_methods(value):
+    """
+    Parse a comma separated list of methods to materialize outputs from the
+    cache. See :data:`plantweb.cache.MATERIALIZE_METHODS`.
+
+    :param str value: Methods to parse, for example ``reflink,copy``.
+    :return: The list of methods.
+    :rtype: list
+    """
+    from argparse import ArgumentTypeError
+
+    methods = [method.strip() for method in value.split(',')]
+    for method in methods:
+        if method not in MATERIALIZE_METHODS:
+            raise ArgumentTypeError(
+                'invalid method {}, choose from {}'.format(
+                    method, ', '.join(MATERIALIZE_METHODS)
+                )
+            )
+    return methods
+
+
+def validate_cache_args(args):
+    """
+    Validate that arguments of the cache command are valid.
+
+    :param args: An arguments namespace.
+    :type args: :py:class:`argparse.Namespace`
+    :return: The validated namespace.
+    :rtype: :py:class:`argparse.Namespace`
+    """
+    level = V_LEVELS.get(args.verbose, logging.DEBUG)
+    logging.basicConfig(format=FORMAT, level=level)
+
+    log.debug('Raw arguments:\n{}'.format(args))
+
+    defaults = read_defaults()
+
+    # Use the cache configuration of the user by default
+    if args.cache_dir is None:
+        args.cache_dir = defaults['cache_dir']
+    args.cache_dir = expanduser(args.cache_dir)
+
+    if args.max_size is None:
+        args.max_size = defaults['cache_max_size']
+    if args.max_age is None:
+        args.max_age = defaults['cache_max_age']
+
+    if args.action == 'prune' and \
+            args.max_size is None and args.max_age is None:
+        raise InvalidArguments(
+            'Pruning the cache requires a maximum size or age'
+        )
+
+    return args
+
+
+def parse_cache_args(argv):
+    """
+    Argument parsing routine for the ``cache`` command.
+
+    :param argv: A list of argument strings after the ``cache`` command.
+    :rtype argv: list
+    :return: A parsed and verified arguments namespace.
+    :rtype: :py:class:`argparse.Namespace`
+    """
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        prog='plantweb cache',
+        description='Manage the cache of rendered diagrams'
+    )
+    parser.set_defaults(command='cache')
+    parser.add_argument(
+        '-v', '--verbose',
+        help='increase verbosity level',
+        default=0,
+        action='count'
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        help='directory of the cache to manage'
+    )
+    parser.add_argument(
+        '--max-size',
+        type=parse_size,
+        help='maximum size of the cache, with an optional K, M or G suffix'
+    )
+    parser.add_argument(
+        '--max-age',
+        type=float,
+        help='maximum number of days since the last use of a diagram'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='report what would be removed without removing it'
+    )
+    parser.add_argument(
+        '--fix',
+        action='store_true',
+        help='remove corrupted diagrams found when verifying'
+    )
+
+    parser.add_argument(
+        'action',
+        help='action to perform on the cache',
+        choices=CACHE_ACTIONS
+    )
+
+    args = parser.parse_args(argv)
+    try:
+        args = validate_cache_args(args)
+    except InvalidArguments as e:
+        log.critical(e)
+        raise e
+
+    return args
+
+
 def parse_args(argv=None):
     """
     Argument parsing routine.
 
+    If the first argument is ``cache`` followed by one of the
+    :data:`CACHE_ACTIONS` or by a help option, the arguments are parsed as in
+    :func:`parse_cache_args`. Otherwise, ``cache`` is a source file to render.
+
     :param argv: A list of argument strings.
     :rtype argv: list
     :return: A parsed and verified arguments namespace.
@@ -103,9 +273,19 @@ def parse_args(argv=None):
     """
     from argparse import ArgumentParser
 
+    if argv is None:
+        argv = sys_argv[1:]
+
+    if argv[:1] == ['cache'] and any(
+            arg in CACHE_ACTIONS or arg in ['-h', '--help']
+            for arg in argv[1:]):
+        return parse_cache_args(argv[1:])
+
     parser = ArgumentParser(
-        description='Python client for the PlantUML server'
+        description='Python client for the PlantUML server',
+        epilog='use "plantweb cache --help" to manage the cache'
     )
+    parser.set_defaults(command='render')
     parser.add_argument(
         '-v', '--verbose',
         help='increase verbosity level',
@@ -147,6 +327,33 @@ def parse_args(argv=None):
         default='~/.cache/plantweb',
         help='directory to store cached renders'
     )
+    parser.add_argument(
+        '--normalize',
+        action='store_true',
+        help='normalize whitespace and comments of the sources before '
+        'rendering them, to share cached renders of equivalent sources'
+    )
+    parser.add_argument(
+        '--output-methods',
+        type=parse_methods,
+        help='comma separated methods tried to write outputs found in the '
+        'cache without reading them, from {}'.format(
+            ', '.join(MATERIALIZE_METHODS)
+        )
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=cpu_count() or 1,
+        help='number of files to render concurrently'
+    )
+    parser.add_argument(
+        '-w', '--watch',
+        action='store_true',
+        help='keep watching the source files and render them again when '
+        'their content changes'
+    )
 
     parser.add_argument(
         'sources',
@@ -164,4 +371,4 @@ def parse_args(argv=None):
     return args
 
 
-__all__ = ['parse_args']
+__all__ = ['parse_args', 'parse_cache_args']
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Local rendering backends module.
+
+Backends render the diagrams of an engine locally, skipping the call to the
+PlantUML server. They are registered by engine in :data:`BACKENDS` and the
+first available one is used, falling back to the PlantUML server if none is
+available or if the ``use_backends`` default is disabled.
+
+Plantweb registers a Graphviz ``dot`` backend for the ``graphviz`` engine,
+used when the ``dot`` executable is installed.
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+import logging
+from shutil import which
+from subprocess import Popen, PIPE
+from abc import ABCMeta, abstractmethod
+
+from six import add_metaclass
+
+from .defaults import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+BACKENDS = {}
+"""
+Registry of the backends by engine, in the order they are tried.
+"""
+
+
+@add_metaclass(ABCMeta)
+class Backend(object):
+    """
+    Base class of the local rendering backends.
+    """
+
+    name = None
+    """
+    Name of the backend.
+    """
+
+    @abstractmethod
+    def available(self, config=None):
+        """
+        Check if the backend can be used.
+
+        :param config: Configuration to use. If ``None``, the current
+         configuration will be used.
+        :type config: :class:`plantweb.defaults.RenderConfig`
+
+        :return: True if the backend can be used.
+        :rtype: bool
+        """
+
+    @abstractmethod
+    def render(self, format, content, config=None):
+        """
+        Render given content.
+
+        :param str format: Format of the rendered content.
+        :param str content: Content to render with mandatory ``@startxxx``
+         tags.
+        :param config: Configuration to use. If ``None``, the current
+         configuration will be used.
+        :type config: :class:`plantweb.defaults.RenderConfig`
+
+        :return: The bytes of the rendered diagram.
+        :rtype: bytes
+        """
+
+
+class DotBackend(Backend):
+    """
+    Backend rendering ``graphviz`` diagrams with the Graphviz ``dot``
+    executable set in the ``dot`` value of the configuration.
+
+    Each diagram is rendered by its own short-lived ``dot`` process, so
+    concurrent renders run in parallel.
+    """
+
+    name = 'dot'
+
+    def __init__(self):
+        self._found = {}
+
+    def executable(self, config=None):
+        """
+        Path to the ``dot`` executable, or ``None`` if not installed.
+        """
+        dot = (config or get_config()).dot
+        if dot not in self._found:
+            self._found[dot] = which(dot)
+        return self._found[dot]
+
+    def available(self, config=None):
+        return self.executable(config) is not None
+
+    def render(self, format, content, config=None):
+        # Remove the @startdot and @enddot tags
+        source = '\n'.join(
+            line for line in content.splitlines()
+            if not line.startswith(('@startdot', '@enddot'))
+        )
+
+        command = [self.executable(config), '-T{}'.format(format)]
+        log.debug('Calling dot:\n{}'.format(command))
+
+        process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        output, error = process.communicate(source.encode('utf-8'))
+
+        if process.returncode != 0:
+            raise RuntimeError(
+                'dot exited with code {}:\n{}'.format(
+                    process.returncode, error.decode('utf-8', 'replace')
+                )
+            )
+        return output
+
+
+def register_backend(engine, backend):
+    """
+    Register a backend to render the diagrams of given engine.
+
+    :param str engine: Name of the engine, as in
+     :data:`plantweb.render.WRAP_STR`.
+    :param backend: Backend to register.
+    :type backend: :class:`Backend`
+    """
+    BACKENDS.setdefault(engine, []).append(backend)
+
+
+def get_backend(engine, config=None):
+    """
+    Get the backend to use to render the diagrams of given engine.
+
+    :param str engine: Name of the engine.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The first available backend registered for the engine, or
+     ``None`` if the PlantUML server should be used.
+    :rtype: :class:`Backend`
+    """
+    if config is None:
+        config = get_config()
+
+    if not config.use_backends:
+        return None
+
+    for backend in BACKENDS.get(engine, []):
+        if backend.available(config):
+            return backend
+    return None
+
+
+register_backend('graphviz', DotBackend())
+
+
+__all__ = [
+    'Backend',
+    'DotBackend',
+    'register_backend',
+    'get_backend',
+    'BACKENDS',
+]
@@ -0,0 +1,1628 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Rendered diagrams cache module.
+
+The cache has two tiers:
+
+#. A bounded in-memory LRU cache, shared by the whole process. See
+   :class:`MemoryCache`.
+#. A cache directory in disk, shared by all processes. See
+   :data:`plantweb.defaults.DEFAULT_CONFIG`.
+
+The cache directory is sharded by the first two characters of the cache key
+of the content (see :func:`cache_key`), so a diagram is stored as
+``ab/cdef....svg``. Optionally, an index of the entries is kept in a SQLite
+database. See :class:`CacheIndex`.
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+import logging
+from re import compile as regex
+from time import time
+from hashlib import sha256
+from sqlite3 import connect
+from os import makedirs, replace, remove, fdopen, fstat, utime, scandir
+from os import getpid, link, symlink, close, open as os_open
+from os import O_RDWR, O_CREAT, O_EXCL
+from shutil import copyfile
+from threading import Lock, Thread, local
+from secrets import token_hex
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import Future
+from asyncio import get_running_loop, shield, CancelledError
+from weakref import WeakKeyDictionary
+from os.path import isfile, expanduser, join, dirname, basename, getmtime
+from os.path import abspath, lexists
+
+from .defaults import get_config
+
+try:
+    from fcntl import flock, ioctl, LOCK_EX, LOCK_UN
+except ImportError:
+    flock = None
+    ioctl = None
+
+try:
+    from os import copy_file_range
+except ImportError:
+    copy_file_range = None
+
+try:
+    from os import O_NOFOLLOW
+except ImportError:
+    O_NOFOLLOW = 0
+
+try:
+    from os import O_BINARY
+except ImportError:
+    O_BINARY = 0
+
+try:
+    from os import register_at_fork
+except ImportError:
+    register_at_fork = None
+
+
+log = logging.getLogger(__name__)
+
+
+# Flags used to create the temporary files, as in tempfile.mkstemp()
+_TEMPORARY_FLAGS = O_RDWR | O_CREAT | O_EXCL | O_NOFOLLOW | O_BINARY
+
+
+class MemoryCache(object):
+    """
+    Bounded in-memory LRU cache of rendered diagrams.
+
+    The cache is bounded both by the number of entries and by the total size
+    in bytes of the entries. Least recently used entries are evicted first.
+
+    :param int max_entries: Maximum number of entries to keep.
+    :param int max_size: Maximum total size, in bytes, of the entries to keep.
+    """
+
+    def __init__(self, max_entries, max_size):
+        self.max_entries = max_entries
+        self.max_size = max_size
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Get the entry for given key, marking it as recently used.
+
+        :param tuple key: Key of the entry.
+        :return: The cached bytes or ``None`` if not cached.
+        :rtype: bytes
+        """
+        with self._lock:
+            output = self._entries.get(key)
+
+            if output is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return output
+
+    def put(self, key, output):
+        """
+        Store given entry, evicting least recently used entries if needed.
+
+        Entries bigger than the maximum size of the cache are not stored.
+
+        :param tuple key: Key of the entry.
+        :param bytes output: Bytes to cache.
+        """
+        if len(output) > self.max_size or self.max_entries < 1:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._entries[key] = output
+            self.size += len(output)
+
+            while (
+                len(self._entries) > self.max_entries or
+                self.size > self.max_size
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Get the statistics of the cache.
+
+        :return: A dictionary with the number of ``entries``, total ``size``
+         in bytes, ``hits``, ``misses`` and ``evictions``.
+        :rtype: dict
+        """
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+_memory_cache_lock = Lock()
+
+
+def get_memory_cache(config=None):
+    """
+    Get the in-memory cache shared by the whole process.
+
+    The cache is created on first use, bounded by the
+    ``memory_cache_entries`` and ``memory_cache_size`` values of the
+    configuration used at that time.
+
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The shared in-memory cache.
+    :rtype: :class:`MemoryCache`
+    """
+    with _memory_cache_lock:
+        if not hasattr(get_memory_cache, 'cache'):
+            if config is None:
+                config = get_config()
+            get_memory_cache.cache = MemoryCache(
+                config.memory_cache_entries,
+                config.memory_cache_size,
+            )
+        return get_memory_cache.cache
+
+
+def cache_options(use_cache, cache_dir, config=None):
+    """
+    Resolve the caching options to their default values if unset.
+
+    :param bool use_cache: Use the cache. If ``None``, the value of the
+     configuration will be used.
+    :param str cache_dir: Directory to store the cached diagrams. If ``None``
+     the value of the configuration will be used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A tuple of ``(use_cache, cache_dir)`` with the user expanded
+     cache directory.
+    :rtype: tuple
+    """
+    if use_cache is None or cache_dir is None:
+        if config is None:
+            config = get_config()
+        if use_cache is None:
+            use_cache = config.use_cache
+        if cache_dir is None:
+            cache_dir = config.cache_dir
+    cache_dir = expanduser(cache_dir)
+
+    if use_cache:
+        prepare_cache_dir(cache_dir)
+
+    return (use_cache, cache_dir)
+
+
+def cache_namespace(server, engine, namespace=None, config=None):
+    """
+    Resolve the cache namespace for given server and engine.
+
+    The namespace is a template that can refer to the ``{server}`` URL, without
+    trailing slashes, and to the ``{engine}`` used. The formatted namespace is
+    then replaced by its canonical namespace if found in the
+    ``cache_aliases`` default.
+
+    :param str server: URL to PlantUML server.
+    :param str engine: Engine used to render the content.
+    :param str namespace: Namespace template. If ``None``, the
+     ``cache_namespace`` default will be used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The resolved namespace. An empty string means no namespace.
+    :rtype: str
+    """
+    if config is None:
+        config = get_config()
+
+    if namespace is None:
+        namespace = config.cache_namespace
+    if not namespace:
+        return ''
+
+    namespace = namespace.format(
+        server=(server or '').rstrip('/'),
+        engine=engine or '',
+    )
+    return config.cache_aliases.get(namespace, namespace)
+
+
+def cache_key(
+        content, server=None, engine=None, namespace=None, config=None,
+        backend=None):
+    """
+    Compute the sha256 hash string identifying given content in the cache.
+
+    Without a namespace the key is the sha256 of the content, as in previous
+    versions. Otherwise the resolved namespace is hashed along the content, so
+    that changing the server or the engine only invalidates the diagrams
+    rendered by them. See :func:`cache_namespace`.
+
+    Contents rendered by a local backend are always keyed by the name of the
+    backend too, whatever the namespace, so they never share the cache
+    entries of the diagrams rendered by the server. See
+    :mod:`plantweb.backends`.
+
+    :param str content: Content to render.
+    :param str server: URL to PlantUML server.
+    :param str engine: Engine used to render the content.
+    :param str namespace: Namespace template as in :func:`cache_namespace`.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :param str backend: Name of the local backend rendering the content, or
+     ``None`` if rendered by the server.
+
+    :return: A sha256 hash string identifying the content.
+    :rtype: str
+    """
+    namespace = cache_namespace(
+        server, engine, namespace=namespace, config=config
+    )
+    if namespace:
+        content = '{}\0{}'.format(namespace, content)
+    if backend is not None:
+        content = 'backend:{}\0{}'.format(backend, content)
+    return sha256(content.encode('utf-8')).hexdigest()
+
+
+def cache_path(cache_dir, sha, format):
+    """
+    Path to the cache file of the content identified by given sha and format.
+
+    :param str cache_dir: Directory of the cache.
+    :param str sha: sha256 hash string identifying the content.
+    :param str format: File format of the rendered content.
+
+    :return: Path to the cache file.
+    :rtype: str
+    """
+    return join(cache_dir, sha[:2], '{}.{}'.format(sha[2:], format))
+
+
+def _parse_cache_path(path):
+    """
+    Get the sha and format of the content of given cache file.
+    """
+    name, format = basename(path).split('.', 1)
+    return (basename(dirname(path)) + name, format)
+
+
+SHARD_REGEX = regex(r'^[0-9a-f]{2}$')
+"""
+Regular expression matching the name of the shard directories.
+"""
+
+CACHE_FILE_REGEX = regex(r'^[0-9a-f]{62}\.[a-z]+$')
+"""
+Regular expression matching the name of the cache files in a shard.
+"""
+
+FLAT_CACHE_FILE_REGEX = regex(r'^[0-9a-f]{64}\.[a-z]+$')
+"""
+Regular expression matching the name of the cache files in the previous flat
+layout of the cache directory.
+"""
+
+LAYOUT_FILE = '.layout'
+"""
+Name of the file that marks a cache directory as using the sharded layout.
+"""
+
+INDEX_FILE = 'index.sqlite'
+"""
+Name of the SQLite database with the index of a cache directory.
+"""
+
+TOUCH_INTERVAL = 60 * 60
+"""
+Minimum time, in seconds, between updates of the modification time of a
+cache file when it is used. The modification time is used to determine the
+least recently used files when pruning the cache. See :func:`prune_cache`.
+"""
+
+PRUNE_INTERVAL = 10 * 60
+"""
+Minimum time, in seconds, between automatic prunes of a cache directory. See
+:func:`maybe_prune`.
+"""
+
+LEFTOVER_AGE = 60 * 60
+"""
+Age, in seconds, after which temporary and lock files are considered
+leftovers of interrupted processes and removed when pruning the cache.
+"""
+
+CHUNK_SIZE = 64 * 1024
+"""
+Size, in bytes, of the chunks of streamed diagrams. It bounds the memory used
+by each streamed render. See :func:`stream_cached`.
+"""
+
+
+def _touch(fd, cache_file):
+    """
+    Mark given open cache file as recently used, if it wasn't recently.
+    """
+    if time() - fstat(fd.fileno()).st_mtime > TOUCH_INTERVAL:
+        try:
+            utime(cache_file)
+        except OSError:
+            pass
+
+
+def read_cache(cache_file):
+    """
+    Read given cache file.
+
+    Reading a file marks it as recently used. See :data:`TOUCH_INTERVAL`.
+
+    :param str cache_file: Path to the cache file.
+
+    :return: The cached bytes or ``None`` if not cached.
+    :rtype: bytes
+    """
+    log.debug('Trying to load cache file {} ...'.format(cache_file))
+    try:
+        fd = open(cache_file, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with fd:
+        _touch(fd, cache_file)
+        return fd.read()
+
+
+def copy_cache(cache_file, destination):
+    """
+    Copy given cache file to a file-like object, in chunks of
+    :data:`CHUNK_SIZE` bytes.
+
+    Copying a file marks it as recently used, as in :func:`read_cache`.
+
+    :param str cache_file: Path to the cache file.
+    :param destination: Binary file-like object to write to.
+
+    :return: The number of bytes copied or ``None`` if not cached.
+    :rtype: int
+    """
+    log.debug('Trying to copy cache file {} ...'.format(cache_file))
+    try:
+        fd = open(cache_file, 'rb')
+    except FileNotFoundError:
+        return None
+
+    size = 0
+    with fd:
+        _touch(fd, cache_file)
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+            destination.write(chunk)
+            size += len(chunk)
+
+    return size
+
+
+def _temporary(path):
+    """
+    Create a temporary file next to given path, with the permissions of a
+    regular new file.
+
+    Unlike :py:func:`tempfile.mkstemp`, the file is created with mode
+    ``0o666``, so the umask of the process is applied by the system.
+
+    :return: A tuple of ``(fd, tmpfile)`` as in :py:func:`tempfile.mkstemp`.
+    :rtype: tuple
+    """
+    directory = dirname(abspath(path))
+    makedirs(directory, exist_ok=True)
+
+    while True:
+        tmpfile = join(
+            directory, '.{}.{}.tmp'.format(basename(path), token_hex(4))
+        )
+        try:
+            return (os_open(tmpfile, _TEMPORARY_FLAGS, 0o666), tmpfile)
+        except FileExistsError:
+            continue
+
+
+@contextmanager
+def atomic_open(path):
+    """
+    Context manager that opens a file to write it atomically.
+
+    The file object writes to a temporary file in the same directory that is
+    atomically renamed to the file when the context exits, so readers never
+    see a partially written file and concurrent writers of the same bytes
+    never conflict. If an exception is raised the temporary file is removed
+    and the file is left untouched.
+
+    :param str path: Path to the file.
+
+    :return: A binary file object.
+    """
+    fd, tmpfile = _temporary(path)
+    try:
+        with fdopen(fd, 'wb') as tmp:
+            yield tmp
+        replace(tmpfile, path)
+    except BaseException:
+        remove(tmpfile)
+        raise
+
+
+def atomic_write(path, output):
+    """
+    Write given bytes to a file atomically. See :func:`atomic_open`.
+
+    :param str path: Path to the file.
+    :param bytes output: Bytes to write.
+    """
+    with atomic_open(path) as fd:
+        fd.write(output)
+
+
+FICLONE = 0x40049409
+"""
+Linux ``ioctl`` request to share the data blocks of a file with another file
+in filesystems supporting copy on write, like Btrfs or XFS.
+"""
+
+
+MATERIALIZE_METHODS = ['reflink', 'link', 'symlink', 'copy']
+"""
+Methods available to :func:`materialize` a copy of a file.
+"""
+
+
+def _reflink(source, tmpfile):
+    """
+    Share the data blocks of given source file with given temporary file.
+    """
+    if ioctl is None:
+        raise OSError('Reflinks are not supported')
+
+    with open(source, 'rb') as src, open(tmpfile, 'wb') as tmp:
+        ioctl(tmp.fileno(), FICLONE, src.fileno())
+
+
+def _link(source, tmpfile):
+    """
+    Replace given temporary file with a hard link to given source file.
+    """
+    if lexists(tmpfile):
+        remove(tmpfile)
+    link(source, tmpfile)
+
+
+def _symlink(source, tmpfile):
+    """
+    Replace given temporary file with a symbolic link to given source file.
+    """
+    if lexists(tmpfile):
+        remove(tmpfile)
+    symlink(abspath(source), tmpfile)
+
+
+def _copy(source, tmpfile):
+    """
+    Copy the data of given source file to given temporary file, in the kernel
+    using :py:func:`os.copy_file_range` when available or
+    :py:func:`shutil.copyfile`, that uses ``sendfile`` where available.
+    """
+    if copy_file_range is not None:
+        with open(source, 'rb') as src, open(tmpfile, 'wb') as tmp:
+            try:
+                while copy_file_range(src.fileno(), tmp.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError:
+                pass
+
+    copyfile(source, tmpfile)
+
+
+_MATERIALIZERS = {
+    'reflink': _reflink,
+    'link': _link,
+    'symlink': _symlink,
+    'copy': _copy,
+}
+
+
+def materialize(source, destination, methods=None, config=None):
+    """
+    Make given destination file a copy of given source file, avoiding to copy
+    the data when possible.
+
+    The given methods are tried in order until one succeeds:
+
+    ``reflink``
+       Share the data blocks of the source, in copy on write filesystems.
+       Each file keeps its own metadata.
+    ``link``
+       Hard link the source, in the same filesystem. Both files share the
+       same data and metadata, including the modification time, so writing
+       to the destination in place modifies the source too.
+    ``symlink``
+       Symbolic link to the absolute path of the source. As with ``link``,
+       writing to the destination modifies the source, and the destination
+       breaks if the source is removed.
+    ``copy``
+       Copy the data of the source in the kernel, without reading it into
+       Python buffers.
+
+    The destination is replaced atomically, as in :func:`atomic_write`.
+
+    :param str source: Path to the source file.
+    :param str destination: Path to the destination file.
+    :param list methods: Names of the methods to try, from
+     :data:`MATERIALIZE_METHODS`. If ``None``, the ``output_methods`` of the
+     configuration will be used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The name of the method used.
+    :rtype: str
+    """
+    if methods is None:
+        methods = (config or get_config()).output_methods
+
+    unknown = [method for method in methods if method not in _MATERIALIZERS]
+    if unknown or not methods:
+        raise ValueError('Invalid materialize methods {}'.format(methods))
+
+    fd, tmpfile = _temporary(destination)
+    close(fd)
+
+    try:
+        for method in methods:
+            try:
+                _MATERIALIZERS[method](source, tmpfile)
+                break
+            except OSError as e:
+                error = e
+        else:
+            raise error
+
+        replace(tmpfile, destination)
+    except Exception:
+        if lexists(tmpfile):
+            remove(tmpfile)
+        raise
+
+    log.debug('Materialized {} from {} using {}'.format(
+        destination, source, method
+    ))
+    return method
+
+
+def materialize_cached(
+        cache_dir, sha, format, destination, methods=None, config=None):
+    """
+    Make given destination file a copy of the content identified by given
+    values in the cache directory, without reading it. See
+    :func:`materialize`.
+
+    Materializing a cached content marks it as recently used, as in
+    :func:`read_cache`.
+
+    :param str cache_dir: Directory of the cache.
+    :param str sha: sha256 hash string identifying the content.
+    :param str format: File format of the rendered content.
+    :param str destination: Path to the destination file.
+    :param list methods: Names of the methods to try, as in
+     :func:`materialize`.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The name of the method used, or ``None`` if not cached.
+    :rtype: str
+    """
+    cache_file = cache_path(cache_dir, sha, format)
+    try:
+        mtime = getmtime(cache_file)
+    except OSError:
+        return None
+
+    if time() - mtime > TOUCH_INTERVAL:
+        try:
+            utime(cache_file)
+        except OSError:
+            pass
+
+    try:
+        method = materialize(
+            cache_file, destination, methods=methods, config=config
+        )
+    except FileNotFoundError:
+        # Removed while pruning the cache
+        if not isfile(cache_file):
+            return None
+        raise
+
+    index = get_index(cache_dir, config)
+    if index is not None:
+        index.touch(sha, format)
+
+    return method
+
+
+def write_cache(cache_file, output):
+    """
+    Write given bytes to the cache file atomically. See :func:`atomic_write`.
+
+    :param str cache_file: Path to the cache file.
+    :param bytes output: Bytes to cache.
+    """
+    atomic_write(cache_file, output)
+    log.debug('Wrote cache file {} ...'.format(cache_file))
+
+
+@contextmanager
+def file_lock(cache_file):
+    """
+    Context manager that holds an exclusive lock for given cache file across
+    processes.
+
+    The lock file is removed when the lock is released. A process that was
+    waiting for the removed lock file may then run concurrently with a new
+    one, so callers must re-check the cache once the lock is acquired.
+
+    On platforms without :func:`fcntl.flock` this does nothing.
+
+    :param str cache_file: Path to the cache file to lock.
+    """
+    if flock is None:
+        yield
+        return
+
+    lock_file = '{}.lock'.format(cache_file)
+    makedirs(dirname(lock_file), exist_ok=True)
+
+    with open(lock_file, 'ab') as fd:
+        flock(fd, LOCK_EX)
+        try:
+            yield
+        finally:
+            try:
+                remove(lock_file)
+            except OSError:
+                pass
+            flock(fd, LOCK_UN)
+
+
+def is_cached(cache_dir, sha, format, server, config=None):
+    """
+    Check if the content identified by given values is in any cache tier.
+
+    This doesn't affect the statistics nor the order of the entries of the
+    in-memory cache.
+
+    :return: ``True`` if the content is cached.
+    :rtype: bool
+    """
+    if (cache_dir, sha, format, server) in get_memory_cache(config):
+        return True
+    return isfile(cache_path(cache_dir, sha, format))
+
+
+def lookup(cache_dir, sha, format, server, config=None):
+    """
+    Fetch the content identified by given values from the cache tiers.
+
+    The in-memory cache is checked first, and entries found in disk are
+    promoted to it. The in-memory cache is keyed by the cache directory too,
+    so each cache directory gets populated independently.
+
+    :param str cache_dir: Directory of the cache.
+    :param str sha: sha256 hash string identifying the content.
+    :param str format: File format of the rendered content.
+    :param str server: URL of the server that rendered the content.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The cached bytes or ``None`` if not cached.
+    :rtype: bytes
+    """
+    memory = get_memory_cache(config)
+    key = (cache_dir, sha, format, server)
+
+    output = memory.get(key)
+    if output is not None:
+        return output
+
+    output = read_cache(cache_path(cache_dir, sha, format))
+    if output is not None:
+        memory.put(key, output)
+
+        index = get_index(cache_dir, config)
+        if index is not None:
+            index.touch(sha, format)
+
+    return output
+
+
+def store(cache_dir, sha, format, server, output, engine=None, config=None):
+    """
+    Store the content identified by given values in all the cache tiers.
+
+    See :func:`lookup`.
+
+    :param bytes output: Bytes to cache.
+    :param str engine: Engine used to render the content, to record in the
+     index of the cache directory.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+    """
+    write_cache(cache_path(cache_dir, sha, format), output)
+    get_memory_cache(config).put((cache_dir, sha, format, server), output)
+
+    index = get_index(cache_dir, config)
+    if index is not None:
+        index.record(sha, format, len(output), engine, server)
+
+
+_inflight = {}
+_inflight_lock = Lock()
+
+
+def single_flight(
+        cache_dir, sha, format, server, render, engine=None, config=None):
+    """
+    Render and store the content identified by given values, making sure that
+    only one render for it is in progress.
+
+    Within the process, concurrent callers for the same content wait for the
+    first one and share its result. Across processes, a file lock serializes
+    the callers, which re-check the cache directory once they get the lock.
+
+    :param str cache_dir: Directory of the cache.
+    :param str sha: sha256 hash string identifying the content.
+    :param str format: File format of the rendered content.
+    :param str server: URL of the server that renders the content.
+    :param function render: Function without arguments that renders the
+     content and returns its bytes.
+    :param str engine: Engine used to render the content, to record in the
+     index of the cache directory.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The rendered bytes.
+    :rtype: bytes
+    """
+    key = (cache_dir, sha, format, server)
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+
+    if not owner:
+        log.debug('Waiting for in-flight render of {} ...'.format(sha))
+        return future.result()
+
+    try:
+        cache_file = cache_path(cache_dir, sha, format)
+        with file_lock(cache_file):
+            output = read_cache(cache_file)
+            if output is None:
+                output = render()
+                store(
+                    cache_dir, sha, format, server, output,
+                    engine=engine, config=config
+                )
+                maybe_prune(cache_dir, config)
+
+        get_memory_cache(config).put(key, output)
+        future.set_result(output)
+        return output
+
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+_async_inflight = WeakKeyDictionary()
+
+
+async def async_single_flight(
+        cache_dir, sha, format, server, render, engine=None, config=None):
+    """
+    Render and store the content identified by given values, making sure that
+    only one render for it is in progress, asynchronously.
+
+    Same as :func:`single_flight`, but concurrent callers are coroutines of
+    the running event loop and ``render`` is a coroutine function.
+
+    :return: The rendered bytes.
+    :rtype: bytes
+    """
+    loop = get_running_loop()
+    key = (cache_dir, sha, format, server)
+
+    inflight = _async_inflight.setdefault(loop, {})
+    future = inflight.get(key)
+
+    if future is not None:
+        log.debug('Waiting for in-flight render of {} ...'.format(sha))
+        return await shield(future)
+
+    future = inflight[key] = loop.create_future()
+
+    try:
+        cache_file = cache_path(cache_dir, sha, format)
+        lock = file_lock(cache_file)
+
+        await loop.run_in_executor(None, lock.__enter__)
+        try:
+            output = await loop.run_in_executor(None, read_cache, cache_file)
+            if output is None:
+                output = await render()
+                await loop.run_in_executor(
+                    None, store, cache_dir, sha, format, server, output,
+                    engine, config
+                )
+                maybe_prune(cache_dir, config)
+        finally:
+            await loop.run_in_executor(None, lock.__exit__, None, None, None)
+
+        get_memory_cache(config).put(key, output)
+        future.set_result(output)
+        return output
+
+    except CancelledError:
+        future.cancel()
+        raise
+
+    except BaseException as e:
+        future.set_exception(e)
+        # Avoid warnings about never retrieved exceptions without waiters
+        future.exception()
+        raise
+
+    finally:
+        del inflight[key]
+
+
+def stream_cached(
+        cache_dir, sha, format, server, destination, render, engine=None,
+        config=None):
+    """
+    Write the content identified by given values to a file-like object,
+    streaming it from the cache or from its render.
+
+    A content in the in-memory cache is written at once. Otherwise, the cache
+    file is copied in chunks or, if not cached, the chunks of the render are
+    written both to the destination and to the cache file as they arrive, so
+    the content is never held whole in memory. See :data:`CHUNK_SIZE`.
+
+    Across threads and processes, a file lock serializes the callers for the
+    same content, which re-check the cache directory once they get the lock.
+    Streamed contents are not promoted to the in-memory cache. If the render
+    fails the destination may have been partially written, but the cache file
+    is left untouched.
+
+    :param str cache_dir: Directory of the cache.
+    :param str sha: sha256 hash string identifying the content.
+    :param str format: File format of the rendered content.
+    :param str server: URL of the server that renders the content.
+    :param destination: Binary file-like object to write to.
+    :param function render: Function without arguments that renders the
+     content and returns an iterable of chunks of its bytes.
+    :param str engine: Engine used to render the content, to record in the
+     index of the cache directory.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The number of bytes written.
+    :rtype: int
+    """
+    output = get_memory_cache(config).get((cache_dir, sha, format, server))
+    if output is not None:
+        destination.write(output)
+        return len(output)
+
+    cache_file = cache_path(cache_dir, sha, format)
+    index = get_index(cache_dir, config)
+
+    with file_lock(cache_file):
+        size = copy_cache(cache_file, destination)
+        if size is not None:
+            if index is not None:
+                index.touch(sha, format)
+            return size
+
+        size = 0
+        with atomic_open(cache_file) as fd:
+            for chunk in render():
+                fd.write(chunk)
+                destination.write(chunk)
+                size += len(chunk)
+        log.debug('Wrote cache file {} ...'.format(cache_file))
+
+        if index is not None:
+            index.record(sha, format, size, engine, server)
+
+    maybe_prune(cache_dir, config)
+    return size
+
+
+def _scan(cache_dir):
+    """
+    Iterate the directory entries of all the shards of given cache directory.
+    """
+    try:
+        shards = scandir(cache_dir)
+    except FileNotFoundError:
+        return
+
+    with shards:
+        for shard in shards:
+            if not SHARD_REGEX.match(shard.name) or not shard.is_dir():
+                continue
+
+            try:
+                entries = scandir(shard.path)
+            except FileNotFoundError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    yield entry
+
+
+def _scan_cache(cache_dir):
+    """
+    Iterate the cache files found in the shards of given cache directory.
+    """
+    for entry in _scan(cache_dir):
+        if not CACHE_FILE_REGEX.match(entry.name):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        yield (entry.path, stat.st_size, stat.st_mtime)
+
+
+def iter_cache(cache_dir, config=None):
+    """
+    Iterate the entries of given cache directory.
+
+    If the cache directory is indexed the entries are read from the index,
+    otherwise the shards are scanned.
+
+    :param str cache_dir: Directory of the cache.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: An iterator of tuples ``(path, size, mtime)`` for each cache file.
+     When read from the index, ``mtime`` is the time of the last access.
+    :rtype: iterator
+    """
+    prepare_cache_dir(cache_dir)
+
+    index = get_index(cache_dir, config)
+    if index is None:
+        for entry in _scan_cache(cache_dir):
+            yield entry
+        return
+
+    for sha, format, size, last_access in index.entries():
+        yield (cache_path(cache_dir, sha, format), size, last_access)
+
+
+def _remove_leftovers(cache_dir, dry_run=False):
+    """
+    Remove temporary and lock files left by interrupted processes.
+    """
+    limit = time() - LEFTOVER_AGE
+
+    for entry in _scan(cache_dir):
+        if not entry.name.endswith(('.tmp', '.lock')):
+            continue
+        try:
+            if entry.stat().st_mtime < limit and not dry_run:
+                remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def _remove_entry(cache_dir, path, config=None):
+    """
+    Remove given cache file and its index record, if any.
+    """
+    index = get_index(cache_dir, config)
+    if index is not None:
+        index.remove(*_parse_cache_path(path))
+
+    remove(path)
+
+
+def cache_stats(cache_dir, config=None):
+    """
+    Get the statistics of given cache directory.
+
+    :param str cache_dir: Directory of the cache.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A dictionary with the number of ``entries``, total ``size`` in
+     bytes, the number of entries by format in ``formats`` and the
+     modification time of the ``oldest`` and ``newest`` entries.
+    :rtype: dict
+    """
+    stats = {
+        'entries': 0,
+        'size': 0,
+        'formats': {},
+        'oldest': None,
+        'newest': None,
+    }
+
+    for path, size, mtime in iter_cache(cache_dir, config):
+        format = path.rsplit('.', 1)[-1]
+
+        stats['entries'] += 1
+        stats['size'] += size
+        stats['formats'][format] = stats['formats'].get(format, 0) + 1
+
+        if stats['oldest'] is None or mtime < stats['oldest']:
+            stats['oldest'] = mtime
+        if stats['newest'] is None or mtime > stats['newest']:
+            stats['newest'] = mtime
+
+    return stats
+
+
+def prune_cache(
+        cache_dir, max_size=None, max_age=None, dry_run=False, config=None):
+    """
+    Remove the least recently used entries of given cache directory.
+
+    Entries older than ``max_age`` are removed, then the least recently used
+    entries are removed until the total size is below ``max_size``.
+
+    :param str cache_dir: Directory of the cache.
+    :param int max_size: Maximum total size, in bytes, of the cache. If
+     ``None``, the size is not limited.
+    :param float max_age: Maximum age, in days, since the last use of an
+     entry. If ``None``, the age is not limited.
+    :param bool dry_run: Do not remove anything, just report.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A dictionary with the number of ``removed`` entries, the
+     ``reclaimed`` bytes and the number of ``entries`` and total ``size`` of
+     the cache after the prune.
+    :rtype: dict
+    """
+    entries = sorted(
+        iter_cache(cache_dir, config), key=lambda entry: entry[2]
+    )
+    size = sum(entry[1] for entry in entries)
+
+    limit = None
+    if max_age is not None:
+        limit = time() - max_age * 24 * 60 * 60
+
+    removed = 0
+    reclaimed = 0
+
+    # Entries are sorted from least to most recently used
+    for path, entry_size, mtime in entries:
+        expired = limit is not None and mtime < limit
+        oversized = max_size is not None and size > max_size
+
+        if not (expired or oversized):
+            break
+
+        if not dry_run:
+            try:
+                _remove_entry(cache_dir, path, config)
+            except FileNotFoundError:
+                continue
+
+        removed += 1
+        reclaimed += entry_size
+        size -= entry_size
+
+    _remove_leftovers(cache_dir, dry_run=dry_run)
+
+    log.info('Pruned {} entries ({} bytes) from cache {}'.format(
+        removed, reclaimed, cache_dir
+    ))
+
+    return {
+        'removed': removed,
+        'reclaimed': reclaimed,
+        'entries': len(entries) - removed,
+        'size': size,
+    }
+
+
+def clear_cache(cache_dir, dry_run=False, config=None):
+    """
+    Remove all the entries of given cache directory.
+
+    :param str cache_dir: Directory of the cache.
+    :param bool dry_run: Do not remove anything, just report.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A dictionary as in :func:`prune_cache`.
+    :rtype: dict
+    """
+    return prune_cache(
+        cache_dir, max_size=0, dry_run=dry_run, config=config
+    )
+
+
+SIGNATURES = {
+    'png': (b'\x89PNG\r\n\x1a\n', b'IEND\xaeB`\x82'),
+    'svg': (b'<', b'</svg>'),
+}
+"""
+Expected header and trailer of the cache files by format.
+"""
+
+
+def verify_cache(cache_dir, fix=False, config=None):
+    """
+    Verify the integrity of the entries of given cache directory.
+
+    Entries are checked to be non-empty and to have the header and trailer
+    expected for their format, as in :data:`SIGNATURES`.
+
+    :param str cache_dir: Directory of the cache.
+    :param bool fix: Remove the corrupted entries.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A dictionary with the number of verified ``entries`` and the list
+     of paths of the ``corrupted`` entries.
+    :rtype: dict
+    """
+    verified = 0
+    corrupted = []
+
+    for path, size, mtime in iter_cache(cache_dir, config):
+        verified += 1
+        header, trailer = SIGNATURES.get(
+            path.rsplit('.', 1)[-1], (b'', b'')
+        )
+
+        try:
+            with open(path, 'rb') as fd:
+                head = fd.read(len(header) + 64).lstrip()
+                fd.seek(max(size - len(trailer) - 64, 0))
+                tail = fd.read().rstrip()
+        except FileNotFoundError:
+            continue
+
+        if head and head.startswith(header) and tail.endswith(trailer):
+            continue
+
+        log.warning('Corrupted cache file {}'.format(path))
+        corrupted.append(path)
+
+        if fix:
+            _remove_entry(cache_dir, path, config)
+
+    return {
+        'entries': verified,
+        'corrupted': corrupted,
+    }
+
+
+class CacheIndex(object):
+    """
+    Index of the entries of a cache directory stored in a SQLite database.
+
+    The index records the size, format, engine, server and last access time
+    of each entry, so the cache can be inspected and pruned without listing
+    the cache directory.
+
+    Connections are opened per thread and per process.
+
+    :param str path: Path to the SQLite database.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            sha TEXT NOT NULL,
+            format TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            engine TEXT,
+            server TEXT,
+            last_access REAL NOT NULL,
+            PRIMARY KEY (sha, format)
+        )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None or self._local.pid != getpid():
+            connection = connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute(self.SCHEMA)
+
+            self._local.connection = connection
+            self._local.pid = getpid()
+
+        return connection
+
+    def record(self, sha, format, size, engine=None, server=None, when=None):
+        """
+        Record an entry of the cache.
+
+        :param str sha: sha256 hash string identifying the content.
+        :param str format: File format of the rendered content.
+        :param int size: Size in bytes of the cache file.
+        :param str engine: Engine used to render the content.
+        :param str server: URL of the server that rendered the content.
+        :param float when: Time of the last access. If ``None``, the current
+         time will be used.
+        """
+        self._connection().execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+            (sha, format, size, engine, server, when or time())
+        )
+
+    def touch(self, sha, format):
+        """
+        Mark an entry of the cache as accessed now.
+        """
+        self._connection().execute(
+            'UPDATE entries SET last_access = ? WHERE sha = ? AND format = ?',
+            (time(), sha, format)
+        )
+
+    def remove(self, sha, format):
+        """
+        Remove an entry from the index.
+        """
+        self._connection().execute(
+            'DELETE FROM entries WHERE sha = ? AND format = ?',
+            (sha, format)
+        )
+
+    def entries(self):
+        """
+        Get the entries of the index, least recently used first.
+
+        :return: A list of tuples ``(sha, format, size, last_access)``.
+        :rtype: list
+        """
+        return self._connection().execute(
+            'SELECT sha, format, size, last_access FROM entries '
+            'ORDER BY last_access'
+        ).fetchall()
+
+    def rebuild(self, cache_dir):
+        """
+        Rebuild the index from the files found in given cache directory.
+
+        The engine and server of the entries are unknown after a rebuild.
+
+        :param str cache_dir: Directory of the cache.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN')
+        try:
+            connection.execute('DELETE FROM entries')
+            for path, size, mtime in _scan_cache(cache_dir):
+                sha, format = _parse_cache_path(path)
+                self.record(sha, format, size, when=mtime)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+
+_indexes = {}
+_indexes_lock = Lock()
+
+
+def get_index(cache_dir, config=None):
+    """
+    Get the index of given cache directory.
+
+    Cache directories are indexed only if the ``cache_index`` value of the
+    configuration is set. The index is rebuilt from the cache directory if its
+    database doesn't exist.
+
+    :param str cache_dir: Directory of the cache.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The index of the cache directory, or ``None`` if not indexed.
+    :rtype: :class:`CacheIndex`
+    """
+    if not (config or get_config()).cache_index:
+        return None
+
+    with _indexes_lock:
+        index = _indexes.get(cache_dir)
+
+        if index is None:
+            path = join(cache_dir, INDEX_FILE)
+            missing = not isfile(path)
+
+            makedirs(cache_dir, exist_ok=True)
+            index = CacheIndex(path)
+            if missing:
+                index.rebuild(cache_dir)
+
+            _indexes[cache_dir] = index
+
+    return index
+
+
+def migrate_cache(cache_dir):
+    """
+    Move the files of given cache directory from the previous flat layout to
+    the sharded layout.
+
+    :param str cache_dir: Directory of the cache.
+
+    :return: The number of migrated files.
+    :rtype: int
+    """
+    migrated = 0
+
+    with scandir(cache_dir) as entries:
+        for entry in entries:
+            if not FLAT_CACHE_FILE_REGEX.match(entry.name):
+                continue
+
+            sha, format = entry.name.split('.', 1)
+            target = cache_path(cache_dir, sha, format)
+
+            makedirs(dirname(target), exist_ok=True)
+            try:
+                replace(entry.path, target)
+            except FileNotFoundError:
+                continue
+            migrated += 1
+
+    if migrated:
+        log.info('Migrated {} files in cache {} to sharded layout'.format(
+            migrated, cache_dir
+        ))
+    return migrated
+
+
+_prepared = set()
+_prepared_lock = Lock()
+
+
+def prepare_cache_dir(cache_dir):
+    """
+    Make sure given cache directory exists and uses the sharded layout.
+
+    A cache directory using the previous flat layout is migrated the first
+    time it is used, see :func:`migrate_cache`. This is checked once per
+    process.
+
+    :param str cache_dir: Directory of the cache.
+    """
+    if cache_dir in _prepared:
+        return
+
+    with _prepared_lock:
+        if cache_dir in _prepared:
+            return
+
+        marker = join(cache_dir, LAYOUT_FILE)
+        if not isfile(marker):
+            makedirs(cache_dir, exist_ok=True)
+            migrate_cache(cache_dir)
+            with open(marker, 'w') as fd:
+                fd.write('sharded\n')
+
+        _prepared.add(cache_dir)
+
+
+_pruning = set()
+_pruning_lock = Lock()
+
+
+def maybe_prune(cache_dir, config=None):
+    """
+    Prune given cache directory in the background if it is due.
+
+    The cache is pruned with the ``cache_max_size`` and ``cache_max_age``
+    values of the configuration, if any is set, at most once every
+    :data:`PRUNE_INTERVAL` seconds across all processes sharing the cache
+    directory. Pruning happens in a background thread, so it never stalls a
+    render.
+
+    :param str cache_dir: Directory of the cache.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The thread pruning the cache, or ``None`` if not due.
+    :rtype: :py:class:`threading.Thread`
+    """
+    if config is None:
+        config = get_config()
+    max_size = config.cache_max_size
+    max_age = config.cache_max_age
+
+    if max_size is None and max_age is None:
+        return None
+
+    stamp = join(cache_dir, '.pruned')
+
+    with _pruning_lock:
+        if cache_dir in _pruning:
+            return None
+
+        try:
+            if time() - getmtime(stamp) < PRUNE_INTERVAL:
+                return None
+        except OSError:
+            pass
+
+        with open(stamp, 'a'):
+            utime(stamp)
+        _pruning.add(cache_dir)
+
+    def prune():
+        try:
+            prune_cache(
+                cache_dir, max_size=max_size, max_age=max_age, config=config
+            )
+        except Exception:
+            log.exception('Unable to prune cache {}'.format(cache_dir))
+        finally:
+            with _pruning_lock:
+                _pruning.discard(cache_dir)
+
+    thread = Thread(target=prune, name='plantweb-prune', daemon=True)
+    thread.start()
+    return thread
+
+
+def _after_fork():
+    """
+    Reset the state shared with the threads of the parent process in a forked
+    child process, like the Sphinx parallel build workers.
+    """
+    global _memory_cache_lock, _inflight_lock, _indexes_lock
+    global _prepared_lock, _pruning_lock
+
+    _memory_cache_lock = Lock()
+    _inflight_lock = Lock()
+    _indexes_lock = Lock()
+    _prepared_lock = Lock()
+    _pruning_lock = Lock()
+
+    # Renders in progress in the parent will never complete in the child
+    _inflight.clear()
+    _pruning.clear()
+
+    if hasattr(get_memory_cache, 'cache'):
+        get_memory_cache.cache._lock = Lock()
+
+
+if register_at_fork is not None:
+    register_at_fork(after_in_child=_after_fork)
+
+
+__all__ = [
+    'MemoryCache',
+    'get_memory_cache',
+    'cache_options',
+    'cache_namespace',
+    'cache_key',
+    'cache_path',
+    'read_cache',
+    'copy_cache',
+    'write_cache',
+    'atomic_open',
+    'atomic_write',
+    'materialize',
+    'materialize_cached',
+    'file_lock',
+    'single_flight',
+    'async_single_flight',
+    'stream_cached',
+    'iter_cache',
+    'cache_stats',
+    'prune_cache',
+    'clear_cache',
+    'verify_cache',
+    'maybe_prune',
+    'CacheIndex',
+    'get_index',
+    'migrate_cache',
+    'prepare_cache_dir',
+    'is_cached',
+    'lookup',
+    'store',
+]
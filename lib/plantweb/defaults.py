@@ -23,16 +23,16 @@ from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
 import logging
-from os import getcwd
+from os import getcwd, stat
 from json import loads
+from threading import Lock
+from collections import namedtuple
+from stat import S_ISREG
 from copy import deepcopy
 from inspect import isfunction
 from traceback import format_exc
-from sys import getdefaultencoding
-from subprocess import Popen, PIPE
 from importlib import import_module
-from shutil import which
-from os.path import isfile, expanduser, join
+from os.path import isdir, isfile, expanduser, join, dirname, abspath
 
 
 log = logging.getLogger(__name__)
@@ -43,7 +43,27 @@ DEFAULT_CONFIG = {
     'format': 'svg',
     'server': 'http://plantuml.com/plantuml/',
     'use_cache': True,
-    'cache_dir': '~/.cache/plantweb'
+    'cache_dir': '~/.cache/plantweb',
+    'cache_max_size': None,
+    'cache_max_age': None,
+    'cache_index': False,
+    'cache_namespace': '',
+    'cache_aliases': {},
+    'normalize_content': False,
+    'memory_cache_entries': 256,
+    'memory_cache_size': 64 * 1024 * 1024,
+    'http_pool_size': 10,
+    'http_keep_alive': True,
+    'http_retries': 3,
+    'http_backoff_factor': 0.5,
+    'http_timeout': 30,
+    'plantuml_jar': None,
+    'java': 'java',
+    'local_batch': True,
+    'local_timeout': 60,
+    'use_backends': True,
+    'dot': 'dot',
+    'output_methods': ['reflink', 'copy']
 }
 """
 Default configuration for plantweb.
@@ -53,6 +73,112 @@ Default configuration for plantweb.
    The default engine will be used only when the engine was unset and it was
    unable to be auto-determined.
 
+The ``cache_max_*`` keys limit the ``cache_dir``. When set, the least recently
+used diagrams are removed in the background (see
+:func:`plantweb.cache.prune_cache`):
+
+``cache_max_size``
+   Maximum total size, in bytes, of the cached diagrams. Use ``null`` for no
+   limit.
+
+``cache_max_age``
+   Maximum number of days since the last use of a cached diagram. Use
+   ``null`` for no limit.
+
+The ``cache_index`` key enables an index of the ``cache_dir`` in a SQLite
+database, so it can be inspected and pruned without listing all its files
+(see :class:`plantweb.cache.CacheIndex`). Please note that SQLite databases
+shouldn't be shared over network file systems with unreliable locking.
+
+The ``cache_namespace`` and ``cache_aliases`` keys scope the cached diagrams,
+so that changing the PlantUML server only invalidates the diagrams rendered by
+it (see :func:`plantweb.cache.cache_key`):
+
+``cache_namespace``
+   Template of the namespace of the cached diagrams. It can refer to the
+   ``{server}`` URL and to the ``{engine}`` used, for example
+   ``"{server}"``. An empty string hashes only the content, as in previous
+   versions. Diagrams rendered by a local backend are always keyed by the
+   backend too.
+
+``cache_aliases``
+   Mapping of namespaces to the canonical namespace they are equivalent to,
+   for example to share the diagrams rendered by two servers running the same
+   PlantUML version.
+
+The ``normalize_content`` key enables the canonicalization of the diagrams
+before hashing and rendering them, so that diagrams differing only in line
+endings, trailing whitespace, surrounding blank lines or PlantUML comments
+share the same cache entry (see :func:`plantweb.render.normalize_content`).
+
+The ``memory_cache_*`` keys bound the in-memory cache layered in front of
+the ``cache_dir`` (see :class:`plantweb.cache.MemoryCache`):
+
+``memory_cache_entries``
+   Maximum number of rendered diagrams to keep in memory.
+
+``memory_cache_size``
+   Maximum total size, in bytes, of the rendered diagrams kept in memory.
+
+The ``http_*`` keys configure the shared HTTP session used to call the
+PlantUML server (see :func:`plantweb.plantuml.get_session`):
+
+``http_pool_size``
+   Maximum number of connections kept open to the server.
+
+``http_keep_alive``
+   Reuse connections between requests.
+
+``http_retries``
+   Number of retries for failed connections and server errors.
+
+``http_backoff_factor``
+   Backoff factor, in seconds, applied between retries.
+
+``http_timeout``
+   Timeout, in seconds, for each request to the server. Use ``null`` to wait
+   forever.
+
+To render the diagrams without a PlantUML server set the ``server`` key to
+``local://``. A local ``plantuml.jar`` will then be run in a long-lived JVM
+(see :mod:`plantweb.local`):
+
+``plantuml_jar``
+   Path to the PlantUML jar used by the ``local://`` server. A path can also
+   be given in the server itself, as in ``local:///path/to/plantuml.jar``.
+
+``java``
+   Java executable used to run the PlantUML jar.
+
+``local_batch``
+   Render batches of diagrams, like the files given to the command line
+   interface, with a single run of the PlantUML jar per CPU core. See
+   :func:`plantweb.render.render_many`.
+
+``local_timeout``
+   Timeout, in seconds, for each diagram rendered by the long-lived JVM. The
+   JVM is killed and restarted for the next diagram if exceeded. Use ``null``
+   to wait forever.
+
+Diagrams of some engines can be rendered by local backends instead of the
+PlantUML server (see :mod:`plantweb.backends`):
+
+``use_backends``
+   Use the local backends when available, for example Graphviz ``dot`` for
+   ``graphviz`` diagrams.
+
+``dot``
+   Graphviz ``dot`` executable. The ``dot`` backend is used only if found.
+
+The ``output_methods`` key lists, in order of preference, the methods used to
+write output files that are byte-identical copies of cached diagrams, without
+reading them: ``reflink``, ``link``, ``symlink`` or ``copy`` (see
+:func:`plantweb.cache.materialize`). Links are never used unless listed here.
+Please note that hard linked and symbolically linked outputs are the cache
+files themselves: writing to them in place corrupts the cached diagram for
+every later render, and their modification time changes when the cache entry
+is used. Symbolic links also break if the diagram is removed from the cache.
+
 To set a different default configuration create a JSON file ``.plantwebrc``
 in your git repository root or in your home, as defined in
 :data:`DEFAULTS_PROVIDERS`.
@@ -72,9 +198,9 @@ Last items will be processed last and thus will override previous values.
 Available providers are:
 
 ``git://``
-   Will fetch the repository root from current working directory using git's
-   ``git rev-parse --show-toplevel`` and then read the specified file from
-   that path.
+   Will find the repository root from current working directory, like git's
+   ``git rev-parse --show-toplevel`` does, and then read the specified file
+   from that path.
 
 ``file://``
    Will read the file specified. User expansion ``~`` is supported.
@@ -88,45 +214,99 @@ Available providers are:
 """
 
 
+def _find_git_root(path=None):
+    """
+    Find the root of the git working tree containing the given directory.
+
+    The directory and its parents are searched for a ``.git`` entry, either a
+    directory or a gitfile pointing to the git directory of a worktree or a
+    submodule, without calling the git executable.
+
+    Found roots are memoized by directory and checked to still exist.
+    Directories not in a repository are searched again on every call, as a
+    repository can be created in any of their parents.
+
+    :param str path: Directory to start the search from. If ``None``, the
+     current working directory is used.
+
+    :return: The path to the root of the working tree, or ``None`` if the
+     directory is not in a git repository.
+    :rtype: str
+    """
+    directory = abspath(path or getcwd())
+    if not isdir(directory):
+        return None
+
+    cache = _find_git_root.cache
+    root = cache.get(directory)
+    if root is not None and _is_git_root(root):
+        return root
+
+    current = directory
+    while True:
+        if _is_git_root(current):
+            cache[directory] = current
+            return current
+
+        parent = dirname(current)
+        if parent == current:
+            break
+        current = parent
+
+    cache.pop(directory, None)
+    return None
+
+
+_find_git_root.cache = {}
+
+
+def _is_git_root(directory):
+    """
+    Check if given directory is the root of a git working tree.
+
+    :param str directory: Directory to check.
+
+    :return: True if the directory has a ``.git`` directory, or a ``.git``
+     gitfile pointing to an existing git directory.
+    :rtype: bool
+    """
+    dotgit = join(directory, '.git')
+
+    if isdir(dotgit):
+        return True
+
+    if not isfile(dotgit):
+        return False
+
+    try:
+        with open(dotgit, 'r') as fd:
+            content = fd.readline().strip()
+    except (OSError, UnicodeDecodeError):
+        return False
+
+    if not content.startswith('gitdir:'):
+        return False
+
+    gitdir = content[len('gitdir:'):].strip()
+    return isdir(join(directory, gitdir))
+
+
 def _read_defaults_git(path):
     """
     Read defaults from given path in current git repository.
 
     See :data:`DEFAULTS_PROVIDERS` for inner workings.
     """
-    # Find git executable
-    git = which('git')
-    if not git:
-        log.debug(
-            'Unable to read defaults from repository. '
-            'git executable not found.'
-        )
-        return {}
-
-    # Call git to determine repository root
-    proc = Popen(
-        [git, 'rev-parse', '--show-toplevel'],
-        stdout=PIPE, stderr=PIPE
-    )
-    stdout_raw, stderr_raw = proc.communicate()
-    stdout = stdout_raw.decode(getdefaultencoding())
-    stderr = stderr_raw.decode(getdefaultencoding())
+    repo_root = _find_git_root()
 
     # Check that we were in a repository
-    if proc.returncode != 0:
-        if 'not a git repository' in stderr.lower():
-            log.debug(
-                'Not in a git repository: {}'.format(getcwd())
-            )
-        else:
-            log.error(
-                'Unable to determine git root directory:\n{}'.format(stderr)
-            )
+    if repo_root is None:
+        log.debug(
+            'Not in a git repository: {}'.format(getcwd())
+        )
         return {}
 
     # Read defaults file
-    repo_root = stdout.strip()
-
     return _read_defaults_file(
         join(repo_root, path)
     )
@@ -136,16 +316,37 @@ def _read_defaults_file(path):
     """
     Read defaults from given path.
 
+    The parsed file is memoized and read again only if its modification time
+    or size changes.
+
     See :data:`DEFAULTS_PROVIDERS` for inner workings.
     """
 
     rcfile = expanduser(path)
-    if isfile(rcfile):
-        with open(rcfile, 'r') as fd:
-            return loads(fd.read())
+    cache = _read_defaults_file.cache
 
-    log.info('Defaults file {} doesn\'t exists'.format(rcfile))
-    return {}
+    try:
+        info = stat(rcfile)
+    except OSError:
+        info = None
+
+    if info is None or not S_ISREG(info.st_mode):
+        cache.pop(rcfile, None)
+        log.info('Defaults file {} doesn\'t exists'.format(rcfile))
+        return {}
+
+    signature = (info.st_mtime_ns, info.st_size)
+    if rcfile in cache and cache[rcfile][0] == signature:
+        return cache[rcfile][1]
+
+    with open(rcfile, 'r') as fd:
+        overrides = loads(fd.read())
+
+    cache[rcfile] = (signature, overrides)
+    return overrides
+
+
+_read_defaults_file.cache = {}
 
 
 def _read_defaults_python(location):
@@ -214,4 +415,87 @@ def read_defaults(cached=True):
     return defaults
 
 
-__all__ = ['DEFAULT_CONFIG', 'DEFAULTS_PROVIDERS', 'read_defaults']
+class RenderConfig(namedtuple('RenderConfig', sorted(DEFAULT_CONFIG))):
+    """
+    Immutable configuration used to render diagrams.
+
+    It has one attribute for each key in :data:`DEFAULT_CONFIG`. Being a
+    named tuple, a copy with some values changed can be created with
+    ``config._replace(server='http://myserver.com/plantuml/')``.
+
+    See :func:`get_config`.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_defaults(cls, defaults):
+        """
+        Create a configuration from a dictionary of defaults.
+
+        Missing keys take the values of :data:`DEFAULT_CONFIG` and unknown
+        keys are ignored.
+
+        :param dict defaults: A dictionary like :data:`DEFAULT_CONFIG`.
+
+        :return: The new configuration.
+        :rtype: :class:`RenderConfig`
+        """
+        values = dict(DEFAULT_CONFIG)
+        values.update(
+            (key, value) for key, value in defaults.items()
+            if key in values
+        )
+        return cls(**values)
+
+
+_config_lock = Lock()
+
+
+def get_config():
+    """
+    Get the configuration resolved from the current defaults.
+
+    The configuration is created once for the defaults returned by
+    :func:`read_defaults` and shared by all threads until the defaults
+    change. Callers should resolve it once and pass it to the rendering
+    functions.
+
+    :return: The current configuration.
+    :rtype: :class:`RenderConfig`
+    """
+    defaults = read_defaults()
+    cached = get_config.cache
+
+    if cached[0] is not defaults:
+        cached = (defaults, RenderConfig.from_defaults(defaults))
+        get_config.cache = cached
+
+    return cached[1]
+
+
+get_config.cache = (None, None)
+
+
+def reload_config():
+    """
+    Read the defaults again from the providers and replace the configuration.
+
+    The new configuration is swapped in at once, so concurrent callers of
+    :func:`get_config` get either the previous or the new configuration, and
+    renders in progress keep the one they were given.
+
+    :return: The new configuration.
+    :rtype: :class:`RenderConfig`
+    """
+    with _config_lock:
+        defaults = read_defaults(cached=False)
+        config = RenderConfig.from_defaults(defaults)
+        get_config.cache = (defaults, config)
+
+    return config
+
+
+__all__ = [
+    'DEFAULT_CONFIG', 'DEFAULTS_PROVIDERS', 'read_defaults',
+    'RenderConfig', 'get_config', 'reload_config'
+]
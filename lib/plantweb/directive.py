@@ -24,20 +24,32 @@ from __future__ import print_function, division
 
 from logging import getLogger
 from traceback import format_exc
-from os import makedirs
+from collections import OrderedDict
+from re import compile as regex
+from os import scandir, remove
 from abc import ABCMeta, abstractmethod
 from os.path import join, relpath, dirname, isfile, isabs, realpath
+from os.path import getsize, splitext, isdir
 
 from six import add_metaclass
 from docutils import nodes
 from docutils.parsers.rst import directives
 from docutils.parsers.rst.directives.images import Image
+from sphinx.util.logging import getLogger as get_sphinx_logger
 
-from . import defaults
-from .render import render
+from . import defaults, __version__
+from .render import identify, render_many
+from .cache import atomic_write, materialize, cache_options, cache_path
 
 
 log = getLogger(__name__)
+sphinx_log = get_sphinx_logger(__name__)
+
+
+PLACEHOLDER_SCHEME = 'plantweb://'
+"""
+Scheme of the URIs of the images of the diagrams pending to be rendered.
+"""
 
 
 @add_metaclass(ABCMeta)
@@ -100,9 +112,12 @@ class Plantweb(Image):
         if warnings:
             return warnings
 
-        # Fetch builder and environment objects
+        # Fetch environment object
         env = self.state_machine.document.settings.env
-        builder = env.app.builder
+
+        # Make sure the Sphinx user defaults are set in this process
+        if not hasattr(defaults_provider, 'overrides'):
+            set_overrides(env.config.plantweb_defaults)
 
         # Determine document directory
         document_dir = realpath(dirname(env.doc2path(env.docname)))
@@ -120,6 +135,9 @@ class Plantweb(Image):
             else:
                 srcpath = join(document_dir, srcfile)
 
+            # Read the document again when the source file changes
+            env.note_dependency(srcpath)
+
             if not isfile(srcpath):
                 warning = self.state_machine.reporter.warning(
                     '{} directive cannot find file {}'.format(
@@ -133,9 +151,10 @@ class Plantweb(Image):
             with open(srcpath, 'rb') as fd:
                 content = fd.read().decode('utf-8')
 
-        # Execute plantweb call
+        # Identify the diagram, it will be rendered after reading all the
+        # documents. See env_updated_handler().
         try:
-            output, frmt, engine, sha = render(
+            content, engine, frmt, server, sha = identify(
                 content,
                 engine=self._get_engine_name()
             )
@@ -151,36 +170,17 @@ class Plantweb(Image):
 
         # Determine filename
         filename = '{}.{}'.format(sha, frmt)
-        imgpath = join(builder.outdir, builder.imagedir, 'plantweb')
-
-        # Create images output folder
-        log.debug('imgpath set to {}'.format(imgpath))
-        makedirs(imgpath, exist_ok=True)
-
-        # Write content
-        filepath = join(imgpath, filename)
-
-        with open(filepath, 'wb') as fd:
-            fd.write(output)
-
-        log.debug('Wrote image file {}'.format(filepath))
+        get_diagrams(env).setdefault(env.docname, {})[filename] = (
+            content, frmt, server
+        )
 
         # Default to align center
         if 'align' not in self.options:
             self.options['align'] = 'center'
 
-        # Determine relative path to image from source document directory
-        filepath_relative = relpath(filepath, document_dir)
-
-        # Windows compatibility:
-        # Sphinx Image directive expects paths in POSIX, Python's form.
-        # Replace backslash with slash, otherwise they are removed.
-        filepath_relative = filepath_relative.replace('\\', '/')
-
-        log.debug('Image relative path {}'.format(filepath_relative))
-
-        # Run Image directive
-        self.arguments = [filepath_relative]
+        # Run Image directive with a placeholder URI, resolved when writing.
+        # Sphinx ignores the URIs with a scheme when collecting the images.
+        self.arguments = [PLACEHOLDER_SCHEME + filename]
         return Image.run(self)
 
     @abstractmethod
@@ -266,18 +266,288 @@ def builder_inited_handler(app):
     log.debug('Sphinx overridden Plantweb defaults:')
     log.debug(app.config.plantweb_defaults)
 
+    set_overrides(app.config.plantweb_defaults)
+
+
+def set_overrides(overrides):
+    """
+    Set the Sphinx user defaults in the provider and register it.
+
+    Parallel builds read and write in worker processes forked after the
+    builder is created, so they inherit the registered provider and the
+    reloaded defaults. Workers started from scratch set them on first use.
+
+    :param dict overrides: The dictionary of the form :data:`DEFAULT_CONFIG`.
+    """
     # Set overrides in provider
-    defaults_provider.overrides = app.config.plantweb_defaults
+    defaults_provider.overrides = overrides
 
     # Register provider with the highest priority
     provider = 'python://plantweb.directive.defaults_provider'
     if provider not in defaults.DEFAULTS_PROVIDERS:
         defaults.DEFAULTS_PROVIDERS.append(provider)
 
-    # Force defaults reload
-    from .defaults import read_defaults
-    if hasattr(read_defaults, 'cache'):
-        del read_defaults.cache
+    # Reload the configuration with the overrides
+    defaults.reload_config()
+
+
+def get_diagrams(env):
+    """
+    Get the diagrams of each document of the Sphinx environment.
+
+    :param env: Sphinx environment.
+    :type env: :py:class:`sphinx.environment.BuildEnvironment`
+
+    :return: A dictionary mapping each document name to a dictionary mapping
+     the image filename ``{sha}.{frmt}`` of each of its diagrams to a tuple
+     of ``(content, format, server)`` to render it.
+    :rtype: dict
+    """
+    if not hasattr(env, 'plantweb_diagrams'):
+        env.plantweb_diagrams = {}
+    return env.plantweb_diagrams
+
+
+def image_dir(app):
+    """
+    Directory where the images of the diagrams are written.
+    """
+    return join(app.builder.outdir, app.builder.imagedir, 'plantweb')
+
+
+def image_uri(app, filename):
+    """
+    URI of the image of a diagram, relative to the source directory, as
+    expected by Sphinx for the images collected while reading.
+    """
+    uri = relpath(join(image_dir(app), filename), app.srcdir)
+
+    # Windows compatibility:
+    # Sphinx expects paths in POSIX, Python's form.
+    # Replace backslash with slash, otherwise they are removed.
+    return uri.replace('\\', '/')
+
+
+def env_purge_doc_handler(app, env, docname):
+    """
+    Forget the diagrams of a document that will be read again or was removed.
+
+    This is the handler of the 'env-purge-doc' event emitted by Sphinx.
+    """
+    get_diagrams(env).pop(docname, None)
+
+
+def env_merge_info_handler(app, env, docnames, other):
+    """
+    Merge the diagrams of the documents read by a parallel worker.
+
+    This is the handler of the 'env-merge-info' event emitted by Sphinx.
+    """
+    diagrams = get_diagrams(other)
+    for docname in docnames:
+        if docname in diagrams:
+            get_diagrams(env)[docname] = diagrams[docname]
+
+
+def env_updated_handler(app, env):
+    """
+    Render all the diagrams pending to be rendered, concurrently.
+
+    The diagrams are collected by the directives while reading the documents
+    and rendered at once here, so the reading time doesn't depend on the
+    number of diagrams nor on the latency of the PlantUML server. See
+    :func:`plantweb.render.render_many`.
+
+    Images are content addressed, so existing images are never written again.
+    Missing images found in the cache directory are reflinked from it if
+    possible, or copied. They are never linked, as linked images would share
+    the modification time of the cache files, updated when they are used. See
+    :func:`plantweb.cache.materialize`.
+
+    This is the handler of the 'env-updated' event emitted by Sphinx.
+
+        Emitted when the update() method of the build environment has
+        completed, that is, the environment and all added domains are up to
+        date.
+    """
+    imgpath = image_dir(app)
+    use_cache, cache_dir = cache_options(None, None)
+    env.plantweb_errors = {}
+
+    stats = OrderedDict(
+        (counter, 0) for counter in [
+            'existing', 'reflink', 'copy', 'rendered', 'avoided'
+        ]
+    )
+
+    # Collect the diagrams with missing images
+    pending = OrderedDict()
+
+    for docname, diagrams in sorted(get_diagrams(env).items()):
+        for filename, diagram in diagrams.items():
+            env.images.add_file(docname, image_uri(app, filename))
+
+            if filename in pending:
+                continue
+
+            filepath = join(imgpath, filename)
+            if isfile(filepath):
+                stats['existing'] += 1
+                stats['avoided'] += getsize(filepath)
+                continue
+
+            pending[filename] = (docname, diagram)
+
+    # Reflink or copy the images already in the cache, so they keep their own
+    # modification time and incremental uploads of the output skip them
+    methods = ['reflink', 'copy']
+
+    for filename in list(pending):
+        sha, frmt = splitext(filename)
+        cache_file = cache_path(cache_dir, sha, frmt[1:])
+        if not use_cache or not isfile(cache_file):
+            continue
+
+        method = materialize(
+            cache_file, join(imgpath, filename), methods=methods
+        )
+        stats[method] += 1
+        if method != 'copy':
+            stats['avoided'] += getsize(cache_file)
+        del pending[filename]
+
+    # Render the others, grouped by format and server
+    groups = OrderedDict()
+    for filename, (docname, (content, frmt, server)) in pending.items():
+        groups.setdefault((frmt, server), []).append(filename)
+
+    for (frmt, server), filenames in groups.items():
+        results = render_many(
+            [pending[filename][1][0] for filename in filenames],
+            format=frmt, server=server
+        )
+
+        for filename, result in zip(filenames, results):
+            if isinstance(result, Exception):
+                env.plantweb_errors[filename] = str(result)
+                sphinx_log.warning(
+                    'Unable to render diagram {}: {}'.format(filename, result),
+                    location=pending[filename][0]
+                )
+                continue
+
+            # Write atomically, parallel builds may write the same image
+            atomic_write(join(imgpath, filename), result[0])
+            stats['rendered'] += 1
+            log.debug('Wrote image file {}'.format(filename))
+
+    if not any(stats.values()):
+        return
+
+    sphinx_log.info(
+        'plantweb: {existing} images up to date, {rendered} written, '
+        '{reflink} reflinked and {copy} copied from '
+        'cache, {avoided} bytes of writes avoided'.format(**stats)
+    )
+
+
+def doctree_resolved_handler(app, doctree, docname):
+    """
+    Replace the placeholder URIs of the images of the diagrams with the URIs
+    of the rendered images.
+
+    This is the handler of the 'doctree-resolved' event emitted by Sphinx.
+    """
+    errors = getattr(app.env, 'plantweb_errors', {})
+    findall = getattr(doctree, 'findall', doctree.traverse)
+
+    for node in list(findall(nodes.image)):
+        if not node['uri'].startswith(PLACEHOLDER_SCHEME):
+            continue
+
+        filename = node['uri'][len(PLACEHOLDER_SCHEME):]
+
+        if not isfile(join(image_dir(app), filename)):
+            msg = errors.get(filename, 'Unable to render diagram')
+            node.replace_self(nodes.error(
+                '', nodes.literal_block('', msg)
+            ))
+            continue
+
+        uri = image_uri(app, filename)
+        node['uri'] = uri
+        node['candidates'] = {'*': uri}
+
+
+IMAGE_REGEX = regex(r'^[0-9a-f]{64}\.[a-z]+$')
+"""
+Regular expression matching the filenames of the images of the diagrams.
+"""
+
+
+def prune_images(app, dry_run=False):
+    """
+    Remove the images of the diagrams no longer referenced by any document.
+
+    Both the images written by Plantweb and their copies made by the builder
+    are removed.
+
+    :param app: Sphinx application.
+    :type app: :py:class:`sphinx.application.Sphinx`
+    :param bool dry_run: Only compute what would be removed.
+
+    :return: A tuple of ``(removed, reclaimed)`` with the number of images
+     removed and the number of bytes reclaimed.
+    :rtype: tuple
+    """
+    referenced = set()
+    for diagrams in get_diagrams(app.env).values():
+        referenced.update(diagrams)
+
+    removed = 0
+    reclaimed = 0
+
+    for directory in [image_dir(app), dirname(image_dir(app))]:
+        if not isdir(directory):
+            continue
+
+        for entry in scandir(directory):
+            if not entry.is_file() or not IMAGE_REGEX.match(entry.name):
+                continue
+            if entry.name in referenced:
+                continue
+
+            removed += 1
+            reclaimed += entry.stat().st_size
+
+            if not dry_run:
+                remove(entry.path)
+                log.debug('Removed orphaned image {}'.format(entry.path))
+
+    return (removed, reclaimed)
+
+
+def build_finished_handler(app, exception):
+    """
+    Remove the images of the diagrams no longer used after a successful
+    build, unless disabled with the ``plantweb_gc`` configuration value.
+
+    This is the handler of the 'build-finished' event emitted by Sphinx.
+    """
+    if exception is not None or not app.config.plantweb_gc:
+        return
+
+    dry_run = app.config.plantweb_gc_dry_run
+    removed, reclaimed = prune_images(app, dry_run=dry_run)
+
+    if not removed:
+        return
+
+    sphinx_log.info(
+        'plantweb: {} {} orphaned images, {} bytes reclaimed'.format(
+            'would remove' if dry_run else 'removed', removed, reclaimed
+        )
+    )
 
 
 def setup(app):
@@ -305,14 +575,38 @@ def setup(app):
     # Register the config value to allow to set plantweb defaults in conf.py
     app.add_config_value('plantweb_defaults', {}, 'env')
 
+    # Register the config values to remove the images no longer used
+    app.add_config_value('plantweb_gc', True, '')
+    app.add_config_value('plantweb_gc_dry_run', False, '')
+
     # Register Plantweb defaults setter
     # Note: The str() is because:
     #       - In Python 2.7, Sphinx expects a str, not unicode.
     #       - In Python 3.4, Sphinx expects a str, not bytes.
     app.connect(str('builder-inited'), builder_inited_handler)
 
+    # Register the handlers that render the diagrams after reading
+    app.connect(str('env-purge-doc'), env_purge_doc_handler)
+    app.connect(str('env-merge-info'), env_merge_info_handler)
+    app.connect(str('env-updated'), env_updated_handler)
+    app.connect(str('doctree-resolved'), doctree_resolved_handler)
+    app.connect(str('build-finished'), build_finished_handler)
+
+    # Images are content addressed and written atomically, and all the state
+    # is either inherited by the workers or set on first use
+    return {
+        'version': __version__,
+        'env_version': 1,
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
+
 
 __all__ = [
     'Plantweb', 'UmlDirective', 'GraphDirective', 'DiagramDirective',
-    'setup', 'builder_inited_handler', 'defaults_provider'
+    'setup', 'builder_inited_handler', 'defaults_provider', 'set_overrides',
+    'env_purge_doc_handler',
+    'env_merge_info_handler', 'env_updated_handler',
+    'doctree_resolved_handler', 'build_finished_handler', 'prune_images',
+    'get_diagrams', 'PLACEHOLDER_SCHEME'
 ]
@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Local PlantUML rendering module.
+
+Renders diagrams using a locally installed ``plantuml.jar`` instead of calling
+a PlantUML server. The jar is run in ``-pipe`` mode as a long-lived JVM
+subprocess, one per output format, so the JVM startup is paid once per
+process and not once per diagram.
+
+The local renderer is selected by setting the server to ``local://``, using the
+jar configured in the ``plantuml_jar`` default, or to ``local://`` followed by
+the path to the jar, for example ``local:///usr/share/plantuml/plantuml.jar``.
+
+Batches of diagrams can also be rendered by a single JVM invocation per CPU
+core, see :func:`local_batch`.
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+import logging
+from os import getpid, cpu_count, makedirs
+from re import compile as regex, MULTILINE
+from atexit import register
+from threading import Lock, Thread, Timer, Event
+from collections import deque
+from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, TimeoutExpired, run, DEVNULL
+from os.path import isfile, expanduser, join
+
+from .defaults import get_config
+
+try:
+    from os import register_at_fork
+except ImportError:
+    register_at_fork = None
+
+
+log = logging.getLogger(__name__)
+
+
+LOCAL_SCHEME = 'local://'
+"""
+Prefix of the server URLs that select the local renderer.
+"""
+
+PIPE_DELIMITER = '___PLANTWEB_PIPE_DELIMITER___'
+"""
+Delimiter written by PlantUML after each rendered diagram in ``-pipe`` mode.
+"""
+
+ERROR_REGEX = regex(br'ERROR\r?\n(-?\d+)\r?\n([^\x00]*?)\s*\Z')
+"""
+Regular expression matching the error report written by PlantUML after the
+image of an invalid diagram in ``-pipe`` mode, with the line of the error and
+its message.
+"""
+
+START_REGEX = regex(r'^(@start[a-z]+)\b.*$', MULTILINE)
+"""
+Regular expression matching the ``@startxxx`` tags, with the optional diagram
+name that PlantUML uses as output file name.
+"""
+
+
+def is_local(server):
+    """
+    Check if given server selects the local renderer.
+
+    :param str server: URL to PlantUML server.
+
+    :return: True if the server starts with ``local://``.
+    :rtype: bool
+    """
+    return server.startswith(LOCAL_SCHEME)
+
+
+def first_diagram(content):
+    """
+    Get the first diagram of given content.
+
+    PlantUML renders every ``@startxxx`` ... ``@endxxx`` block of its input,
+    while the PlantUML server renders only the first one. The first block is
+    returned, adding the ``@endxxx`` tag matching its ``@startxxx`` tag if
+    missing, so exactly one diagram is rendered for each content.
+
+    :param str content: Content with mandatory ``@startxxx`` tags.
+
+    :return: The first diagram of the content.
+    :rtype: str
+    """
+    match = START_REGEX.search(content)
+    if match is None:
+        raise ValueError('No @startxxx tag found in content')
+
+    end = '@end{}'.format(match.group(1)[len('@start'):])
+    lines = []
+
+    for line in content[match.start():].splitlines():
+        lines.append(line)
+        if line.strip().startswith(end):
+            break
+    else:
+        lines.append(end)
+
+    return '\n'.join(lines)
+
+
+def local_jar(server, config=None):
+    """
+    Get the path to the PlantUML jar selected by given local server.
+
+    :param str server: Local server, ``local://`` optionally followed by the
+     path to the jar. If no path is given the ``plantuml_jar`` default will be
+     used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: Path to the PlantUML jar.
+    :rtype: str
+    """
+    jar = server[len(LOCAL_SCHEME):]
+    if not jar:
+        jar = (config or get_config()).plantuml_jar
+    if not jar:
+        raise ValueError(
+            'No PlantUML jar configured for the local server. Set the '
+            '"plantuml_jar" default or use local:///path/to/plantuml.jar'
+        )
+
+    jar = expanduser(jar)
+    if not isfile(jar):
+        raise ValueError('PlantUML jar {} not found'.format(jar))
+    return jar
+
+
+class PipeProcess(object):
+    """
+    PlantUML JVM subprocess rendering diagrams in ``-pipe`` mode.
+
+    Diagrams are written to the standard input of the process, one at a time,
+    and read back from its standard output up to the :data:`PIPE_DELIMITER`.
+    Invalid diagrams raise an error instead of returning the error image, as
+    the PlantUML server does.
+    The process is started on first use and restarted if it dies or takes too
+    long to render a diagram.
+
+    :param str jar: Path to the PlantUML jar.
+    :param str format: Output format of the diagrams, ``svg`` or ``png``.
+    :param str java: Java executable. If ``None``, the ``java`` default will
+     be used.
+    """
+
+    def __init__(self, jar, format, java=None):
+        self.jar = jar
+        self.format = format
+        self.java = java or get_config().java
+
+        self.process = None
+        self.errors = deque(maxlen=50)
+        self._lock = Lock()
+
+    @property
+    def command(self):
+        """
+        Command line of the PlantUML process.
+        """
+        return [
+            self.java, '-Djava.awt.headless=true',
+            '-jar', self.jar,
+            '-pipe', '-pipeNoStderr', '-t{}'.format(self.format),
+            '-charset', 'UTF-8',
+            '-pipedelimitor', PIPE_DELIMITER,
+        ]
+
+    def _start(self):
+        log.debug('Starting PlantUML process:\n{}'.format(self.command))
+        self.errors.clear()
+        self.process = Popen(
+            self.command, stdin=PIPE, stdout=PIPE, stderr=PIPE
+        )
+
+        # Consume the standard error so the process never blocks on it
+        thread = Thread(
+            target=self._drain, args=(self.process.stderr, ),
+            name='plantweb-pipe-stderr'
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _drain(self, stderr):
+        for line in iter(stderr.readline, b''):
+            line = line.decode('utf-8', 'replace').rstrip()
+            self.errors.append(line)
+            log.warning('PlantUML: {}'.format(line))
+
+    def _expire(self, process, expired):
+        expired.set()
+        process.kill()
+
+    def _read(self, timeout, expired):
+        delimiter = PIPE_DELIMITER.encode('ascii')
+        chunks = []
+
+        while True:
+            line = self.process.stdout.readline()
+
+            if not line and expired.is_set():
+                raise RuntimeError(
+                    'PlantUML process timed out after {} seconds'.format(
+                        timeout
+                    )
+                )
+            if not line:
+                raise RuntimeError(
+                    'PlantUML process exited with code {}:\n{}'.format(
+                        self.process.wait(), '\n'.join(self.errors)
+                    )
+                )
+
+            # PNG images aren't line oriented, so the delimiter can follow
+            # the last bytes of the image in the same line
+            stripped = line.rstrip(b'\r\n')
+            if stripped.endswith(delimiter):
+                chunks.append(stripped[:-len(delimiter)])
+                return b''.join(chunks)
+
+            chunks.append(line)
+
+    def _close(self):
+        if self.process is None:
+            return
+
+        process, self.process = self.process, None
+        try:
+            process.stdin.close()
+            process.wait(timeout=5)
+        except (OSError, TimeoutExpired):
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+    def render(self, content, timeout=None):
+        """
+        Render given content.
+
+        Only the first diagram of the content is rendered. See
+        :func:`first_diagram`.
+
+        :param str content: Content to render with mandatory ``@startxxx``
+         tags.
+        :param float timeout: Maximum time, in seconds, to wait for the
+         diagram. If exceeded, the process is killed. If ``None``, wait
+         forever.
+
+        :return: The bytes of the rendered diagram.
+        :rtype: bytes
+        """
+        source = first_diagram(content).encode('utf-8') + b'\n'
+
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                self._close()
+                self._start()
+
+            timer = None
+            expired = Event()
+            if timeout is not None:
+                timer = Timer(
+                    timeout, self._expire, args=(self.process, expired)
+                )
+                timer.daemon = True
+                timer.start()
+
+            try:
+                self.process.stdin.write(source)
+                self.process.stdin.flush()
+                output = self._read(timeout, expired)
+            except Exception:
+                self._close()
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+        # Errors are reported after the error image
+        error = ERROR_REGEX.search(output)
+        if error is not None:
+            raise RuntimeError(
+                'PlantUML failed to render line {}:\n{}'.format(
+                    int(error.group(1)),
+                    error.group(2).decode('utf-8', 'replace')
+                )
+            )
+        return output
+
+    def close(self):
+        """
+        Stop the PlantUML process, if running.
+        """
+        with self._lock:
+            self._close()
+
+
+_pipes_lock = Lock()
+
+
+def get_pipe(jar, format, config=None):
+    """
+    Get the PlantUML process shared by the current process to render to given
+    format using given jar.
+
+    :param str jar: Path to the PlantUML jar.
+    :param str format: Output format of the diagrams.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The shared PlantUML process.
+    :rtype: :class:`PipeProcess`
+    """
+    key = (getpid(), jar, format, (config or get_config()).java)
+
+    with _pipes_lock:
+        if not hasattr(get_pipe, 'cache'):
+            get_pipe.cache = {}
+
+        # Processes are never shared with forked children
+        if key not in get_pipe.cache:
+            get_pipe.cache[key] = PipeProcess(jar, format, java=key[3])
+
+        return get_pipe.cache[key]
+
+
+def _after_fork():
+    """
+    Reset the lock of the shared processes in a forked child process. The
+    processes of the parent are never used by the child.
+    """
+    global _pipes_lock
+    _pipes_lock = Lock()
+
+
+if register_at_fork is not None:
+    register_at_fork(after_in_child=_after_fork)
+
+
+@register
+def close_pipes():
+    """
+    Stop all the PlantUML processes started by the current process.
+    """
+    with _pipes_lock:
+        pipes = getattr(get_pipe, 'cache', {})
+        for (pid, jar, format, java), pipe in list(pipes.items()):
+            if pid == getpid():
+                pipe.close()
+        pipes.clear()
+
+
+def local_plantuml(server, extension, content, config=None):
+    """
+    Render given content using the local PlantUML jar.
+
+    Same as :func:`plantweb.plantuml.plantuml` for local servers.
+
+    :param str server: Local server. See :func:`local_jar`.
+    :param str extension: Output format of the diagram.
+    :param str content: Content to render.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The bytes of the rendered diagram.
+    :rtype: bytes
+    """
+    if config is None:
+        config = get_config()
+    return get_pipe(
+        local_jar(server, config), extension, config
+    ).render(content, timeout=config.local_timeout)
+
+
+def _run_batch(command, sources, format):
+    """
+    Render the given source files with a single PlantUML invocation.
+
+    PlantUML writes an error image for invalid diagrams and exits with a
+    non-zero code. If so, the sources are rendered again one by one to find
+    the invalid ones, so error images are never returned.
+    """
+    log.debug('Calling PlantUML on {} files:\n{}'.format(
+        len(sources), command
+    ))
+    process = run(command + sources, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+    errors = (process.stdout + process.stderr).decode('utf-8', 'replace')
+
+    if process.returncode != 0 and len(sources) > 1:
+        return [
+            _run_batch(command, [source], format)[0] for source in sources
+        ]
+
+    outputs = []
+    for source in sources:
+        output = '{}.{}'.format(source.rsplit('.', 1)[0], format)
+
+        if process.returncode != 0 or not isfile(output):
+            outputs.append(RuntimeError(
+                'PlantUML exited with code {} '
+                'rendering {}:\n{}'.format(
+                    process.returncode, source, errors
+                )
+            ))
+            continue
+
+        with open(output, 'rb') as fd:
+            outputs.append(fd.read())
+
+    return outputs
+
+
+def local_batch(server, format, contents, jobs=None, config=None):
+    """
+    Render several contents using the local PlantUML jar, with a single JVM
+    invocation per shard of contents.
+
+    The contents are written to a temporary directory and rendered with
+    ``java -jar plantuml.jar -t<format> <files>``, paying the JVM startup once
+    per shard instead of once per diagram.
+
+    :param str server: Local server. See :func:`local_jar`.
+    :param str format: Output format of the diagrams.
+    :param list contents: List of contents to render with mandatory
+     ``@startxxx`` tags.
+    :param int jobs: Maximum number of shards rendered concurrently. If
+     ``None``, the number of CPU cores will be used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A list with, for each content and in the same order, either the
+     bytes of the rendered diagram or the exception raised while rendering
+     it.
+    :rtype: list
+    """
+    if config is None:
+        config = get_config()
+
+    jar = local_jar(server, config)
+    if jobs is None:
+        jobs = cpu_count() or 1
+    shards = max(1, min(jobs, cpu_count() or 1, len(contents)))
+
+    command = [
+        config.java, '-Djava.awt.headless=true',
+        '-jar', jar,
+        '-t{}'.format(format),
+        '-charset', 'UTF-8',
+    ]
+
+    with TemporaryDirectory(prefix='plantweb') as tmpdir:
+
+        # Write the contents distributed in shards, removing the names of the
+        # diagrams so the outputs are named after the source files
+        batches = [[] for _ in range(shards)]
+        for index, content in enumerate(contents):
+            shard = join(tmpdir, str(index % shards))
+            makedirs(shard, exist_ok=True)
+
+            source = join(shard, '{}.puml'.format(index))
+            with open(source, 'wb') as fd:
+                fd.write(START_REGEX.sub(
+                    r'\1', first_diagram(content)
+                ).encode('utf-8'))
+
+            batches[index % shards].append(source)
+
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            rendered = list(executor.map(
+                lambda sources: _run_batch(command, sources, format),
+                batches
+            ))
+
+    # Sources were distributed round-robin
+    return [
+        rendered[index % shards][index // shards]
+        for index in range(len(contents))
+    ]
+
+
+__all__ = [
+    'is_local',
+    'local_jar',
+    'local_plantuml',
+    'local_batch',
+    'first_diagram',
+    'get_pipe',
+    'close_pipes',
+    'PipeProcess',
+    'LOCAL_SCHEME',
+    'PIPE_DELIMITER',
+]
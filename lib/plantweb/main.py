@@ -23,13 +23,127 @@ from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
 import logging
+from time import ctime
+from timeit import default_timer
+from concurrent.futures import ThreadPoolExecutor
 
-from .render import render_file
+from .render import render_files
+from .watch import watch_files
+from .defaults import get_config
+from .plantuml import create_session
+from .cache import cache_stats, prune_cache, clear_cache, verify_cache
 
 
 log = logging.getLogger(__name__)
 
 
+def cache_main(args):
+    """
+    Cache management command main function.
+
+    :param args: An arguments namespace of the ``cache`` command.
+    :type args: :py:class:`argparse.Namespace`
+
+    :return: Exit code.
+    :rtype: int
+    """
+    print('Cache directory: {}'.format(args.cache_dir))
+
+    if args.action == 'stats':
+        stats = cache_stats(args.cache_dir)
+
+        print('Entries: {}'.format(stats['entries']))
+        print('Size: {} bytes'.format(stats['size']))
+        print('Formats: {}'.format(', '.join(
+            '{} ({})'.format(format, count)
+            for format, count in sorted(stats['formats'].items())
+        )))
+        if stats['entries']:
+            print('Least recently used: {}'.format(ctime(stats['oldest'])))
+            print('Most recently used: {}'.format(ctime(stats['newest'])))
+        return 0
+
+    if args.action in ['prune', 'clear']:
+        if args.action == 'prune':
+            result = prune_cache(
+                args.cache_dir,
+                max_size=args.max_size, max_age=args.max_age,
+                dry_run=args.dry_run
+            )
+        else:
+            result = clear_cache(args.cache_dir, dry_run=args.dry_run)
+
+        print('{} {} entries, {} bytes'.format(
+            'Would remove' if args.dry_run else 'Removed',
+            result['removed'], result['reclaimed']
+        ))
+        return 0
+
+    result = verify_cache(args.cache_dir, fix=args.fix)
+    for path in result['corrupted']:
+        print('{} {}'.format('Removed' if args.fix else 'Corrupted', path))
+
+    print('Verified {} entries, {} corrupted'.format(
+        result['entries'], len(result['corrupted'])
+    ))
+    return 1 if result['corrupted'] and not args.fix else 0
+
+
+def render_main(args, sources, renderopts, cacheopts, executor=None):
+    """
+    Render given source files and report the results.
+
+    :param args: An arguments namespace.
+    :type args: :py:class:`argparse.Namespace`
+    :param list sources: Paths to the source files to render.
+    :param dict renderopts: Rendering options as in
+     :func:`plantweb.render.render_files`.
+    :param dict cacheopts: Caching options as in
+     :func:`plantweb.render.render_files`.
+    :param executor: Pool of threads to render the files.
+    :type executor: :py:class:`concurrent.futures.ThreadPoolExecutor`
+
+    :return: The number of files that failed to render.
+    :rtype: int
+    """
+    start = default_timer()
+    stats = {}
+
+    results = render_files(
+        sources,
+        renderopts=renderopts,
+        cacheopts=cacheopts,
+        jobs=args.jobs,
+        stats=stats,
+        executor=executor
+    )
+
+    failed = 0
+    for src, destination in zip(sources, results):
+        if isinstance(destination, Exception):
+            log.error('Unable to render {}: {}'.format(src, destination))
+            failed += 1
+            continue
+
+        print('Writing output for {} to {}'.format(src, destination))
+
+    print(
+        'Rendered {} files in {:.2f} seconds: {} cache hits, '
+        '{} cache misses, {} failed'.format(
+            len(sources), default_timer() - start,
+            stats['hits'], stats['misses'], failed
+        )
+    )
+    if stats['normalized']:
+        print(
+            '{} cache hits and duplicates thanks to normalization'.format(
+                stats['normalized']
+            )
+        )
+
+    return failed
+
+
 def main(args):
     """
     Application main function.
@@ -40,26 +154,52 @@ def main(args):
     :return: Exit code.
     :rtype: int
     """
-    for src in args.sources:
-
-        destination = render_file(
-            src,
-            renderopts={
-                'engine': args.engine,
-                'format': args.format,
-                'server': args.server
-            },
-            cacheopts={
-                'use_cache': not args.no_cache,
-                'cache_dir': args.cache_dir
-            }
+    if args.command == 'cache':
+        return cache_main(args)
+
+    config = get_config()
+    if args.output_methods:
+        config = config._replace(output_methods=args.output_methods)
+
+    # The session and the pool of threads are shared by all the renders
+    renderopts = {
+        'engine': args.engine,
+        'format': args.format,
+        'server': args.server,
+        'session': create_session(pool_size=args.jobs, config=config),
+        'config': config
+    }
+    cacheopts = {
+        'use_cache': not args.no_cache,
+        'cache_dir': args.cache_dir,
+        'normalize': args.normalize or None
+    }
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        failed = render_main(
+            args, args.sources, renderopts, cacheopts, executor
         )
+        if not args.watch:
+            return 1 if failed else 0
 
-        print('Writing output for {} to {}'.format(src, destination))
+        print('Watching {} files for changes, press Ctrl+C to stop'.format(
+            len(args.sources)
+        ))
+        try:
+            watch_files(
+                args.sources,
+                lambda changed: render_main(
+                    args, changed, renderopts, cacheopts, executor
+                )
+            )
+        except KeyboardInterrupt:
+            pass
 
     return 0
 
 
 __all__ = [
     'main',
+    'render_main',
+    'cache_main',
 ]
@@ -23,16 +23,53 @@ from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
 import logging
-from zlib import compress
+from threading import Lock
+from functools import partial
+from asyncio import Semaphore, sleep, get_running_loop
+from zlib import compress, decompressobj, MAX_WBITS, error as zlib_error
+from base64 import b64encode, b64decode
 from posixpath import join
 
-from requests import get
-from six.moves import range
-from six import indexbytes, unichr
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .defaults import get_config
+from .local import is_local, local_plantuml
+from .cache import CHUNK_SIZE
+
+try:
+    from os import register_at_fork
+except ImportError:
+    register_at_fork = None
+
 
 log = logging.getLogger(__name__)
 
 
+ALPHABET = (
+    b'0123456789'
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    b'abcdefghijklmnopqrstuvwxyz'
+    b'-_'
+)
+"""
+Alphabet used by the PlantUML server encoding, indexed by 6-bit value.
+"""
+
+_B64_ALPHABET = (
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    b'abcdefghijklmnopqrstuvwxyz'
+    b'0123456789'
+    b'+/'
+)
+
+# Translation table from the standard base64 alphabet to the PlantUML one.
+# The padding character maps to the zero value, as PlantUML pads with zeros.
+_ENCODE_TABLE = bytes.maketrans(_B64_ALPHABET + b'=', ALPHABET + b'0')
+_DECODE_TABLE = bytes.maketrans(ALPHABET, _B64_ALPHABET)
+
+
 def compress_and_encode(content):
     """
     Compress the plantuml text and encode it for the plantuml server.
@@ -51,78 +88,419 @@ def encode(data):
     Encode given data into PlantUML server encoding.
 
     This algorithm is similar to the base64 but custom for the plantuml server.
+    It uses a different alphabet (see :data:`ALPHABET`) and the last group of
+    bytes is always padded with zero bits instead of ``=`` characters.
+
+    The whole buffer is encoded at once using the standard base64 encoder and
+    then translated to the PlantUML alphabet.
 
     :param bytes data: Data to encode.
     :return: The encoded data as printable ASCII.
     :rtype: str
     """
-    res = ''
-    for i in range(0, len(data), 3):
-        if i + 2 == len(data):
-            res += _encode3bytes(
-                indexbytes(data, i),
-                indexbytes(data, i + 1),
-                0
-            )
-        elif i + 1 == len(data):
-            res += _encode3bytes(
-                indexbytes(data, i),
-                0, 0
-            )
-        else:
-            res += _encode3bytes(
-                indexbytes(data, i),
-                indexbytes(data, i + 1),
-                indexbytes(data, i + 2)
+    return b64encode(data).translate(_ENCODE_TABLE).decode('ascii')
+
+
+def decompress_and_decode(encoded):
+    """
+    Decode and decompress a string encoded for the plantuml server.
+
+    This is the inverse of :func:`compress_and_encode` and allows to recover
+    the source of a diagram from a PlantUML server URL without any network
+    request.
+
+    :param str encoded: Encoded content as found in a PlantUML server URL.
+    :return: The plantuml text.
+    :rtype: str
+    :raises ValueError: If the encoded content is truncated or corrupt.
+    """
+    inflater = decompressobj(-MAX_WBITS)
+    try:
+        content = inflater.decompress(decode(encoded))
+    except zlib_error as e:
+        raise ValueError('Corrupt encoded content: {}'.format(e))
+
+    if not inflater.eof:
+        raise ValueError('Truncated encoded content')
+    return content.decode('utf-8')
+
+
+def decode(encoded):
+    """
+    Decode given PlantUML server encoded data.
+
+    This is the inverse of :func:`encode`. As the encoding pads the last group
+    of bytes with zeros, the decoded data may have up to two extra trailing
+    zero bytes.
+
+    :param str encoded: Encoded data as printable ASCII.
+    :return: The decoded data.
+    :rtype: bytes
+    :raises ValueError: If the data has characters outside :data:`ALPHABET`.
+    """
+    data = encoded.encode('ascii')
+
+    invalid = data.translate(None, ALPHABET)
+    if invalid:
+        raise ValueError(
+            'Invalid characters in encoded data: {}'.format(
+                invalid.decode('ascii')
             )
-    return res
-
-
-def _encode3bytes(b1, b2, b3):
-    c1 = b1 >> 2
-    c2 = ((b1 & 0x3) << 4) | (b2 >> 4)
-    c3 = ((b2 & 0xF) << 2) | (b3 >> 6)
-    c4 = b3 & 0x3F
-    res = ''
-    res += _encode6bit(c1 & 0x3F)
-    res += _encode6bit(c2 & 0x3F)
-    res += _encode6bit(c3 & 0x3F)
-    res += _encode6bit(c4 & 0x3F)
-    return res
-
-
-def _encode6bit(b):
-    if b < 10:
-        return unichr(48 + b)
-    b -= 10
-    if b < 26:
-        return unichr(65 + b)
-    b -= 26
-    if b < 26:
-        return unichr(97 + b)
-    b -= 26
-    if b == 0:
-        return '-'
-    if b == 1:
-        return '_'
-
-
-def plantuml(server, extension, content):
+        )
+
+    # Complete the last group, padding bits are always zero
+    missing = -len(data) % 4
+    if missing:
+        data += b'0' * missing
+
+    return b64decode(data.translate(_DECODE_TABLE))
+
+
+def create_session(
+        pool_size=None, keep_alive=None,
+        retries=None, backoff_factor=None, config=None):
+    """
+    Create a HTTP session with a pool of connections to the PlantUML server.
+
+    :param int pool_size: Maximum number of connections to keep in the pool.
+     If ``None``, the value of the configuration will be used.
+    :param bool keep_alive: Reuse connections between requests. If ``None``,
+     the value of the configuration will be used.
+    :param int retries: Number of retries for failed connections and server
+     errors. If ``None``, the value of the configuration will be used.
+    :param float backoff_factor: Backoff factor applied between retries. If
+     ``None``, the value of the configuration will be used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A new HTTP session.
+    :rtype: :py:class:`requests.Session`
+    """
+    if config is None:
+        config = get_config()
+
+    if pool_size is None:
+        pool_size = config.http_pool_size
+    if keep_alive is None:
+        keep_alive = config.http_keep_alive
+    if retries is None:
+        retries = config.http_retries
+    if backoff_factor is None:
+        backoff_factor = config.http_backoff_factor
+
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            # Let raise_for_status() report persistent server errors
+            raise_on_status=False,
+        ),
+    )
+
+    session = Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+_session_lock = Lock()
+
+
+def get_session(config=None):
+    """
+    Get the HTTP session shared by all calls to the PlantUML server.
+
+    The session is created on first use with the values of the configuration
+    as in :func:`create_session`. Configurations with different HTTP values
+    get different sessions.
+
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: The shared HTTP session.
+    :rtype: :py:class:`requests.Session`
+    """
+    if config is None:
+        config = get_config()
+
+    key = (
+        config.http_pool_size, config.http_keep_alive,
+        config.http_retries, config.http_backoff_factor,
+    )
+
+    with _session_lock:
+        if not hasattr(get_session, 'cache'):
+            get_session.cache = {}
+        if key not in get_session.cache:
+            get_session.cache[key] = create_session(config=config)
+        return get_session.cache[key]
+
+
+def _after_fork():
+    """
+    Drop the shared HTTP session in a forked child process, so that it never
+    shares the pooled connections of the parent process.
+    """
+    global _session_lock
+    _session_lock = Lock()
+    if hasattr(get_session, 'cache'):
+        del get_session.cache
+
+
+if register_at_fork is not None:
+    register_at_fork(after_in_child=_after_fork)
+
+
+def plantuml(
+        server, extension, content, session=None, timeout=None, config=None):
     """
     Call the PlantUML server.
 
+    If the server is ``local://`` the content is rendered using the local
+    PlantUML jar instead. See :mod:`plantweb.local`.
+
     :param str server: Base URL for the server.
     :param str extension: File format / extension to use for the request.
     :param str content: Content to render.
+    :param session: HTTP session to use for the request. If ``None``, the
+     shared session will be used. See :func:`get_session`.
+    :type session: :py:class:`requests.Session`
+    :param float timeout: Timeout in seconds for the request. If ``None``, the
+     value of the configuration will be used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
     :return: Response of the request.
     :rtype: str
     """
+    if is_local(server):
+        return local_plantuml(server, extension, content, config=config)
+
+    if config is None:
+        config = get_config()
+    if session is None:
+        session = get_session(config)
+    if timeout is None:
+        timeout = config.http_timeout
+
     encoded = compress_and_encode(content)
     url = join(server, extension, encoded)
     log.debug('Calling URL:\n{}'.format(url))
-    response = get(url)
+    response = session.get(url, timeout=timeout)
     response.raise_for_status()
     return response.content
 
 
-__all__ = ['plantuml']
+def plantuml_stream(
+        server, extension, content, session=None, timeout=None, config=None,
+        chunk_size=CHUNK_SIZE):
+    """
+    Call the PlantUML server, streaming the response.
+
+    Same as :func:`plantuml`, but the response is read in chunks as they
+    arrive instead of at once, so large diagrams are never held whole in
+    memory. Local servers render the diagram at once and yield it as a single
+    chunk.
+
+    :param int chunk_size: Maximum size, in bytes, of each chunk.
+
+    :return: An iterator of chunks of the bytes of the response.
+    :rtype: iterator
+    """
+    if is_local(server):
+        yield local_plantuml(server, extension, content, config=config)
+        return
+
+    if config is None:
+        config = get_config()
+    if session is None:
+        session = get_session(config)
+    if timeout is None:
+        timeout = config.http_timeout
+
+    encoded = compress_and_encode(content)
+    url = join(server, extension, encoded)
+    log.debug('Streaming URL:\n{}'.format(url))
+
+    with session.get(url, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size):
+            yield chunk
+
+
+def _import_aiohttp():
+    """
+    Import the optional aiohttp dependency required for asynchronous calls.
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError(
+            'aiohttp is required to call the PlantUML server asynchronously. '
+            'Install it with: pip install plantweb[async]'
+        )
+    return aiohttp
+
+
+_async_sessions = {}
+_async_closers = {}
+
+
+async def _close_on_shutdown(loop):
+    """
+    Asynchronous generator suspended until the event loop shuts down its
+    asynchronous generators, as :py:func:`asyncio.run` does, closing the
+    shared session of the loop then.
+    """
+    try:
+        yield
+    finally:
+        del _async_closers[loop]
+        await close_async_session()
+
+
+async def get_async_session(config=None):
+    """
+    Get the asynchronous HTTP session shared by all asynchronous calls to the
+    PlantUML server in the running event loop.
+
+    The session is created on first use with a pool limited to the
+    ``http_pool_size`` connections of the configuration, along with a
+    semaphore that limits the number of in-flight requests to the same value.
+    Configurations with different HTTP values get different sessions.
+
+    The session is closed when the event loop shuts down its asynchronous
+    generators, as :py:func:`asyncio.run` does. Loops managed otherwise must
+    call :func:`close_async_session` before being closed.
+
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A tuple of ``(session, semaphore)``.
+    :rtype: tuple
+    """
+    if config is None:
+        config = get_config()
+
+    loop = get_running_loop()
+    key = (config.http_pool_size, config.http_keep_alive)
+
+    # Strong references to the closers, as loops track them weakly
+    if loop not in _async_closers:
+        closer = _async_closers[loop] = _close_on_shutdown(loop)
+        await closer.asend(None)
+
+    sessions = _async_sessions.setdefault(loop, {})
+    if key not in sessions:
+        aiohttp = _import_aiohttp()
+
+        pool_size = config.http_pool_size
+        connector = aiohttp.TCPConnector(
+            limit=pool_size,
+            force_close=not config.http_keep_alive,
+        )
+        sessions[key] = (
+            aiohttp.ClientSession(connector=connector),
+            Semaphore(pool_size),
+        )
+
+    return sessions[key]
+
+
+async def close_async_session():
+    """
+    Close the asynchronous HTTP sessions of the running event loop, if any.
+    """
+    sessions = _async_sessions.pop(get_running_loop(), {})
+    for session, semaphore in sessions.values():
+        await session.close()
+
+
+async def async_plantuml(
+        server, extension, content, session=None, timeout=None,
+        config=None):
+    """
+    Call the PlantUML server asynchronously.
+
+    Same as :func:`plantuml` but using an asynchronous HTTP client. Requires
+    the optional dependency ``aiohttp``.
+
+    :param str server: Base URL for the server.
+    :param str extension: File format / extension to use for the request.
+    :param str content: Content to render.
+    :param session: HTTP session to use for the request. If ``None``, the
+     shared session will be used. See :func:`get_async_session`.
+    :type session: :py:class:`aiohttp.ClientSession`
+    :param float timeout: Timeout in seconds for the request. If ``None``, the
+     value of the configuration will be used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+    :return: Response of the request.
+    :rtype: bytes
+    """
+    if config is None:
+        config = get_config()
+
+    if is_local(server):
+        return await get_running_loop().run_in_executor(
+            None, partial(local_plantuml, config=config),
+            server, extension, content
+        )
+
+    aiohttp = _import_aiohttp()
+
+    shared, semaphore = await get_async_session(config)
+    if session is None:
+        session = shared
+    if timeout is None:
+        timeout = config.http_timeout
+
+    encoded = compress_and_encode(content)
+    url = join(server, extension, encoded)
+    log.debug('Calling URL:\n{}'.format(url))
+
+    retries = config.http_retries
+    backoff_factor = config.http_backoff_factor
+
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                async with session.get(
+                    url, timeout=aiohttp.ClientTimeout(total=timeout)
+                ) as response:
+                    if response.status < 500 or attempt == retries:
+                        response.raise_for_status()
+                        return await response.read()
+
+        except aiohttp.ClientConnectionError:
+            if attempt == retries:
+                raise
+
+        await sleep(backoff_factor * (2 ** attempt))
+
+
+__all__ = [
+    'plantuml',
+    'plantuml_stream',
+    'create_session',
+    'get_session',
+    'async_plantuml',
+    'get_async_session',
+    'close_async_session',
+    'compress_and_encode',
+    'decompress_and_decode',
+    'encode',
+    'decode',
+    'ALPHABET'
+]
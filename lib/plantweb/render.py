@@ -23,12 +23,20 @@ from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
 import logging
-from hashlib import sha256
-from os import makedirs
-from os.path import basename, splitext, isfile, expanduser, join
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, Future
+from asyncio import get_running_loop
+from os.path import basename, splitext
 
-from .plantuml import plantuml
-from .defaults import read_defaults
+from .plantuml import plantuml, plantuml_stream, async_plantuml
+from .local import is_local, local_batch
+from .backends import get_backend
+from .cache import cache_options, cache_key, is_cached, lookup
+from .cache import single_flight, async_single_flight, store, maybe_prune
+from .cache import stream_cached, atomic_open, atomic_write
+from .cache import materialize_cached
+from .defaults import get_config
 
 
 log = logging.getLogger(__name__)
@@ -71,12 +79,229 @@ def determine_engine(content):
     return None
 
 
+def normalize_content(content, engine=None):
+    """
+    Canonicalize given content so that equivalent diagrams share a cache key.
+
+    The following changes, which don't modify the rendered diagram, are
+    applied:
+
+    - Line endings are converted to ``\\n``.
+    - Trailing whitespace is removed from every line.
+    - Blank lines after the ``@startXXX`` tag and before the ``@endXXX`` tag,
+      and at the beginning and end of the content, are removed.
+    - For the ``plantuml`` engine, single line comments starting with ``'``
+      are removed. Block comments between ``/'`` and ``'/`` are kept.
+
+    :param str content: Content to normalize.
+    :param str engine: Engine of the content. If ``None``, it will be
+     determined from the content.
+
+    :return: The normalized content.
+    :rtype: str
+    """
+    if engine is None:
+        engine = determine_engine(content.lstrip())
+
+    lines = []
+    block = False
+    for line in content.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        line = line.rstrip()
+
+        if engine == 'plantuml':
+            stripped = line.lstrip()
+
+            if block:
+                block = "'/" not in stripped
+            elif stripped.startswith("/'"):
+                block = "'/" not in stripped[2:]
+            elif stripped.startswith("'"):
+                continue
+
+        if not line and lines and lines[-1].startswith('@start'):
+            continue
+
+        if line.startswith('@end'):
+            while lines and not lines[-1]:
+                lines.pop()
+
+        lines.append(line)
+
+    return '\n'.join(lines).strip()
+
+
+def prepare(content, engine=None, format=None, server=None, config=None):
+    """
+    Determine the engine, format and server to use to render given content.
+
+    :param str content: Content to render.
+    :param str engine: Engine to use to render the content. See
+     :func:`render`.
+    :param str format: Format of the rendered content. See :func:`render`.
+    :param str server: URL to PlantUML server. See :func:`render`.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A tuple of ``(content, engine, format, server)`` with the content
+     wrapped with the ``@startxxx`` tags if required, and the engine, format
+     and server to use.
+    :rtype: tuple
+    """
+    if config is None:
+        config = get_config()
+
+    # Determine engine
+    engine_found = determine_engine(content)
+
+    # Case 1: forced engine
+    if engine is not None:
+
+        if engine_found is None:
+            wrap = WRAP_STR[engine]
+            content = '@start{0}\n{1}\n@end{0}'.format(wrap, content)
+
+        elif engine_found != engine:
+            log.warning(
+                'Engine mismatch. Set: {0} != Found: {1}. '
+                'Assuming {1} ...'.format(engine, engine_found)
+            )
+            engine = engine_found
+
+    # Case 2: Use engine found
+    elif engine_found is not None:
+        engine = engine_found
+
+    # Case 3: Use a default engine
+    else:
+        engine = config.engine
+        log.warning(
+            'Unable to determine the engine. Assuming \'{}\'...'.format(engine)
+        )
+
+    # Determine output file format
+    if format is None:
+        format = config.format if engine != 'ditaa' else 'png'
+
+    # Determine server
+    if server is None:
+        server = config.server
+
+    return (content, engine, format, server)
+
+
+def identify(
+        content, engine=None, format=None, server=None, cacheopts=None,
+        config=None):
+    """
+    Identify the output of given content without rendering it.
+
+    The content is prepared as in :func:`prepare` and, if enabled, normalized,
+    to compute the same cache key that :func:`render` would use to render it.
+
+    :param str content: Content to render.
+    :param str engine: Engine to use to render the content. See
+     :func:`render`.
+    :param str format: Format of the rendered content. See :func:`render`.
+    :param str server: URL to PlantUML server. See :func:`render`.
+    :param dict cacheopts: Caching options as in :func:`render`. Only
+     ``namespace`` and ``normalize`` are used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+
+    :return: A tuple of ``(content, engine, format, server, sha)`` with the
+     content to render, the engine, format and server to use and the sha256
+     hash string identifying the output.
+    :rtype: tuple
+    """
+    if cacheopts is None:
+        cacheopts = {}
+    if config is None:
+        config = get_config()
+
+    content, engine, format, server = prepare(
+        content, engine=engine, format=format, server=server, config=config
+    )
+
+    normalize = cacheopts.get('normalize')
+    if normalize is None:
+        normalize = config.normalize_content
+    if normalize:
+        content = normalize_content(content)
+
+    sha = _cache_key(
+        content, server, determine_engine(content),
+        cacheopts.get('namespace'), config
+    )
+    return (content, engine, format, server, sha)
+
+
+def _cache_key(content, server, engine, namespace, config):
+    """
+    Compute the cache key of given content, keyed by the backend of the
+    engine if any renders it. See :func:`plantweb.cache.cache_key`.
+    """
+    backend = get_backend(engine, config)
+    return cache_key(
+        content, server, engine, namespace=namespace, config=config,
+        backend=None if backend is None else backend.name
+    )
+
+
+def _render_backend(
+        server, format, content, engine, session=None, config=None):
+    """
+    Render given content with the backend of the engine, if any, or call the
+    PlantUML server. See :func:`plantweb.backends.get_backend`.
+    """
+    backend = get_backend(engine, config)
+    if backend is not None:
+        return backend.render(format, content, config)
+    return plantuml(server, format, content, session=session, config=config)
+
+
+async def _async_render_backend(
+        server, format, content, engine, session=None, config=None):
+    """
+    Same as :func:`_render_backend` but calling the PlantUML server
+    asynchronously.
+    """
+    backend = get_backend(engine, config)
+    if backend is not None:
+        return await get_running_loop().run_in_executor(
+            None, backend.render, format, content, config
+        )
+    return await async_plantuml(
+        server, format, content, session=session, config=config
+    )
+
+
+def _stream_backend(
+        server, format, content, engine, session=None, config=None):
+    """
+    Same as :func:`_render_backend` but returning an iterable of chunks of the
+    output, streamed from the PlantUML server.
+    """
+    backend = get_backend(engine, config)
+    if backend is not None:
+        return [backend.render(format, content, config)]
+    return plantuml_stream(
+        server, format, content, session=session, config=config
+    )
+
+
 def render_cached(
         server, format, content,
-        use_cache=None, cache_dir=None):
+        use_cache=None, cache_dir=None, session=None, namespace=None,
+        normalize=None, config=None):
     """
     Render given content in the PlantUML server or fetch it from cache.
 
+    The in-memory cache is checked before the cache directory. See
+    :mod:`plantweb.cache`. Diagrams of engines with an available local backend
+    are rendered by it instead of the server. See :mod:`plantweb.backends`.
+
     :param str server: URL to PlantUML server.
     :param str format: File format to render the content. One of the supported
      by the PlantUML server (``svg`` or ``png``).
@@ -85,45 +310,115 @@ def render_cached(
      already rendered diagrams. If ``None``, the default value will be used.
     :param str cache_dir: Directory to store the cached diagrams. If ``None``
      the default value will be used.
+    :param session: HTTP session to use to call the PlantUML server. If
+     ``None``, the shared session will be used.
+    :type session: :py:class:`requests.Session`
+    :param str namespace: Cache namespace template, see
+     :func:`plantweb.cache.cache_key`. If ``None``, the default value will be
+     used.
+    :param bool normalize: Normalize the content before hashing and rendering
+     it, see :func:`normalize_content`. If ``None``, the default value will be
+     used.
+    :param config: Configuration to use. If ``None``, the current
+     configuration will be used. See :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
 
     :return: A tuple of ``(content, sha)`` with the bytes of the rendered
      content and a sha256 hash string identifying the content.
     :rtype: tuple
     """
-    sha = sha256(content.encode('utf-8')).hexdigest()
+    if config is None:
+        config = get_config()
+
+    if normalize is None:
+        normalize = config.normalize_content
+    if normalize:
+        content = normalize_content(content)
 
-    if use_cache is None:
-        use_cache = read_defaults()['use_cache']
+    engine = determine_engine(content)
+    sha = _cache_key(content, server, engine, namespace, config)
+    use_cache, cache_dir = cache_options(use_cache, cache_dir, config)
 
     if not use_cache:
         return (
-            plantuml(server, format, content),
+            _render_backend(
+                server, format, content, engine, session, config
+            ),
             sha
         )
 
-    if cache_dir is None:
-        cache_dir = read_defaults()['cache_dir']
-    cache_dir = expanduser(cache_dir)
+    # Use cache if available
+    output = lookup(cache_dir, sha, format, server, config)
+    if output is not None:
+        return (output, sha)
 
-    cache_file = join(
-        cache_dir, '{}.{}'.format(sha, format)
+    # Normal render and save cache
+    output = single_flight(
+        cache_dir, sha, format, server,
+        lambda: _render_backend(
+            server, format, content, engine, session, config
+        ),
+        engine=engine, config=config
     )
 
-    # Use cache if available
-    log.debug('Trying to load cache file {} ...'.format(cache_file))
-    if isfile(cache_file):
-        with open(cache_file, 'rb') as fd:
-            return (fd.read(), sha)
+    return (output, sha)
 
-    # No cache, make sure the directory is available
-    makedirs(cache_dir, exist_ok=True)
 
-    # Normal render and save cache
-    output = plantuml(server, format, content)
+async def async_render_cached(
+        server, format, content,
+        use_cache=None, cache_dir=None, session=None, namespace=None,
+        normalize=None, config=None):
+    """
+    Render given content in the PlantUML server or fetch it from cache,
+    asynchronously.
 
-    with open(cache_file, 'wb') as fd:
-        fd.write(output)
-    log.debug('Wrote cache file {} ...'.format(cache_file))
+    Same as :func:`render_cached`, sharing the same cache, but calling the
+    server using :func:`plantweb.plantuml.async_plantuml`.
+
+    :param session: Asynchronous HTTP session to use to call the PlantUML
+     server. If ``None``, the shared session will be used.
+    :type session: :py:class:`aiohttp.ClientSession`
+
+    :return: A tuple of ``(content, sha)`` as in :func:`render_cached`.
+    :rtype: tuple
+    """
+    if config is None:
+        config = get_config()
+
+    if normalize is None:
+        normalize = config.normalize_content
+    if normalize:
+        content = normalize_content(content)
+
+    engine = determine_engine(content)
+    sha = _cache_key(content, server, engine, namespace, config)
+    use_cache, cache_dir = cache_options(use_cache, cache_dir, config)
+
+    if not use_cache:
+        return (
+            await _async_render_backend(
+                server, format, content, engine, session, config
+            ),
+            sha
+        )
+
+    loop = get_running_loop()
+
+    # Use cache if available
+    output = await loop.run_in_executor(
+        None, lookup, cache_dir, sha, format, server, config
+    )
+    if output is not None:
+        return (output, sha)
+
+    # Normal render and save cache
+    output = await async_single_flight(
+        cache_dir, sha, format, server,
+        lambda: _async_render_backend(
+            server, format, content, engine, session, config
+        ),
+        engine=engine, config=config
+    )
 
     return (output, sha)
 
@@ -133,7 +428,9 @@ def render(
         engine=None,
         format=None,
         server=None,
-        cacheopts=None):
+        cacheopts=None,
+        session=None,
+        config=None):
     """
     Render given PlantUML, Graphviz or DITAA content.
 
@@ -148,6 +445,15 @@ def render(
      doesn't supports it.
     :param str server: URL to PlantUML server. This will passed as is to
      :func:`render_cached`. If ``None`` the default server URL will be used.
+    :param dict cacheopts: Caching options (``use_cache``, ``cache_dir``,
+     ``namespace`` and ``normalize``) as in :func:`render_cached`.
+    :param session: HTTP session to use to call the PlantUML server. This will
+     be passed as is to :func:`render_cached`.
+    :type session: :py:class:`requests.Session`
+    :param config: Configuration to use. If ``None``, the current
+     configuration is resolved once and used for the whole render. See
+     :func:`plantweb.defaults.get_config`.
+    :type config: :class:`plantweb.defaults.RenderConfig`
 
     :return: A tuple of ``(output, format, engine, sha)`` with the bytes of the
      rendered output, a string with the name of the output format, a string
@@ -155,63 +461,136 @@ def render(
      for identifying the cache file.
     :rtype: tuple
     """
+    if config is None:
+        config = get_config()
 
-    # Determine engine
-    engine_found = determine_engine(content)
+    content, engine, format, server = prepare(
+        content, engine=engine, format=format, server=server, config=config
+    )
 
-    # Case 1: forced engine
-    if engine is not None:
+    # Render cached
+    if cacheopts is None:
+        cacheopts = {}
 
-        if engine_found is None:
-            wrap = WRAP_STR[engine]
-            content = '@start{0}\n{1}\n@end{0}'.format(wrap, content)
+    output, sha = render_cached(
+        server, format, content, session=session, config=config, **cacheopts
+    )
 
-        elif engine_found != engine:
-            log.warning(
-                'Engine mismatch. Set: {0} != Found: {1}. '
-                'Assuming {1} ...'.format(engine, engine_found)
-            )
-            engine = engine_found
+    return (output, format, engine, sha)
 
-    # Case 2: Use engine found
-    elif engine_found is not None:
-        engine = engine_found
 
-    # Case 3: Use a default engine
-    else:
-        engine = read_defaults()['engine']
-        log.warning(
-            'Unable to determine the engine. Assuming \'{}\'...'.format(engine)
-        )
+async def async_render(
+        content,
+        engine=None,
+        format=None,
+        server=None,
+        cacheopts=None,
+        session=None,
+        config=None):
+    """
+    Render given PlantUML, Graphviz or DITAA content, asynchronously.
 
-    # Determine output file format
-    if format is None:
-        format = read_defaults()['format'] if engine != 'ditaa' else 'png'
+    Same as :func:`render` but rendering with :func:`async_render_cached`.
 
-    # Determine server
-    if server is None:
-        server = read_defaults()['server']
+    :param session: Asynchronous HTTP session to use to call the PlantUML
+     server. This will be passed as is to :func:`async_render_cached`.
+    :type session: :py:class:`aiohttp.ClientSession`
+
+    :return: A tuple of ``(output, format, engine, sha)`` as in
+     :func:`render`.
+    :rtype: tuple
+    """
+    if config is None:
+        config = get_config()
+
+    content, engine, format, server = prepare(
+        content, engine=engine, format=format, server=server, config=config
+    )
 
-    # Render cached
     if cacheopts is None:
         cacheopts = {}
 
-    output, sha = render_cached(server, format, content, **cacheopts)
+    output, sha = await async_render_cached(
+        server, format, content, session=session, config=config, **cacheopts
+    )
 
     return (output, format, engine, sha)
 
 
+def render_stream(
+        content,
+        destination,
+        engine=None,
+        format=None,
+        server=None,
+        cacheopts=None,
+        session=None,
+        config=None):
+    """
+    Render given PlantUML, Graphviz or DITAA content to a file-like object.
+
+    Same as :func:`render`, but the output is streamed in chunks from the
+    cache or the PlantUML server to the destination, and to the cache file
+    when rendered, so it is never held whole in memory. See
+    :func:`plantweb.cache.stream_cached`.
+
+    :param str content: Content to render.
+    :param destination: Binary file-like object to write the output to, like
+     an open file or the result of :py:meth:`socket.socket.makefile`.
+
+    :return: A tuple of ``(format, engine, sha)`` as in :func:`render`,
+     without the output.
+    :rtype: tuple
+    """
+    if cacheopts is None:
+        cacheopts = {}
+    if config is None:
+        config = get_config()
+
+    content, engine, format, server, sha = identify(
+        content, engine=engine, format=format, server=server,
+        cacheopts=cacheopts, config=config
+    )
+    found = determine_engine(content)
+
+    def chunks():
+        return _stream_backend(
+            server, format, content, found, session, config
+        )
+
+    use_cache, cache_dir = cache_options(
+        cacheopts.get('use_cache'), cacheopts.get('cache_dir'), config
+    )
+
+    if use_cache:
+        stream_cached(
+            cache_dir, sha, format, server, destination, chunks,
+            engine=found, config=config
+        )
+    else:
+        for chunk in chunks():
+            destination.write(chunk)
+
+    return (format, engine, sha)
+
+
 def render_file(infile, outfile=None, renderopts=None, cacheopts=None):
     """
     Render given PlantUML, Graphviz or DITAA file.
 
+    If the output is in the cache directory, the output file is materialized
+    from it without reading it, as in :func:`plantweb.cache.materialize`,
+    using the ``output_methods`` of the configuration. Otherwise, the output
+    is streamed to the output file as in :func:`render_stream`. In both cases
+    the output file is replaced atomically once fully written.
+
     :param str infile: Path to source file to render.
     :param str outfile: Path to output file. If ``None``, the filename will be
      auto-determined and saved to the current working directory.
-    :param dict renderopts: Rendering options (``engine``, ``format`` and
-     ``server``) as in :func:`render`.
-    :param dict cacheopts: Caching options (``use_cache`` and ``cache_dir``) as
-     in :func:`render`.
+    :param dict renderopts: Rendering options (``engine``, ``format``,
+     ``server``, ``session`` and ``config``) as in :func:`render`.
+    :param dict cacheopts: Caching options (``use_cache``, ``cache_dir``,
+     ``namespace`` and ``normalize``) as in :func:`render`.
 
     :return: Path to output file.
     :rtype: str
@@ -221,31 +600,424 @@ def render_file(infile, outfile=None, renderopts=None, cacheopts=None):
     with open(infile, 'rb') as fd:
         content = fd.read().decode('utf-8')
 
-    # Render output
     if renderopts is None:
         renderopts = {}
+    if cacheopts is None:
+        cacheopts = {}
+    config = renderopts.get('config') or get_config()
 
-    output, format, engine, sha = render(
-        content, cacheopts=cacheopts, **renderopts
+    # Materialize output from the cache
+    content, engine, format, server, outfile, method, normalized = \
+        _output_file(content, infile, outfile, renderopts, cacheopts, config)
+    if method is not None:
+        return outfile
+
+    # Stream output
+    with atomic_open(outfile) as fd:
+        render_stream(
+            content, fd, engine=engine, format=format, server=server,
+            cacheopts=cacheopts, session=renderopts.get('session'),
+            config=config
+        )
+
+    return outfile
+
+
+def _output_file(content, infile, outfile, renderopts, cacheopts, config):
+    """
+    Prepare the content of given source file and materialize its output file
+    from the cache directory, if cached. See
+    :func:`plantweb.cache.materialize_cached`.
+
+    :return: A tuple of ``(content, engine, format, server, outfile, method,
+     normalized)`` with the prepared content, the engine, format and server to
+     use, the path to the output file, the name of the method used to
+     materialize it or ``None`` if not cached, and whether the content was
+     changed by its normalization.
+    :rtype: tuple
+    """
+    content, engine, format, server = prepare(
+        content,
+        engine=renderopts.get('engine'),
+        format=renderopts.get('format'),
+        server=renderopts.get('server'),
+        config=config
     )
 
-    # Determine destination file
     if outfile is None:
-        outfile = '{}.{}'.format(
-            splitext(basename(infile))[0],
-            format
+        outfile = _default_outfile(infile, format)
+
+    use_cache, cache_dir = cache_options(
+        cacheopts.get('use_cache'), cacheopts.get('cache_dir'), config
+    )
+    if not use_cache:
+        return (content, engine, format, server, outfile, None, False)
+
+    identified, engine, format, server, sha = identify(
+        content, engine=engine, format=format, server=server,
+        cacheopts=cacheopts, config=config
+    )
+    method = materialize_cached(
+        cache_dir, sha, format, outfile, config=config
+    )
+    return (
+        content, engine, format, server, outfile, method,
+        identified != content
+    )
+
+
+def _default_outfile(infile, format):
+    """
+    Output file in the current working directory for given source file.
+    """
+    return '{}.{}'.format(
+        splitext(basename(infile))[0],
+        format
+    )
+
+
+def render_many(
+        contents,
+        engine=None,
+        format=None,
+        server=None,
+        cacheopts=None,
+        session=None,
+        jobs=None,
+        stats=None,
+        batch=None,
+        config=None,
+        executor=None):
+    """
+    Render several PlantUML, Graphviz or DITAA contents concurrently.
+
+    Contents are deduplicated by their cache key before calling the server, so
+    identical diagrams are rendered only once. Cache hits are resolved in the
+    calling thread while cache misses are rendered in a bounded pool of
+    threads.
+
+    In batch mode, cache misses for a ``local://`` server are instead rendered
+    together by a few invocations of the local PlantUML jar. See
+    :func:`plantweb.local.local_batch`.
+
+    :param list contents: List of contents to render.
+    :param str engine: Engine to use to render the contents as in
+     :func:`render`.
+    :param str format: Format of the rendered contents as in :func:`render`.
+    :param str server: URL to PlantUML server as in :func:`render`.
+    :param dict cacheopts: Caching options (``use_cache``, ``cache_dir``,
+     ``namespace`` and ``normalize``) as in :func:`render_cached`.
+    :param session: HTTP session to use to call the PlantUML server. If
+     ``None``, the shared session will be used.
+    :type session: :py:class:`requests.Session`
+    :param int jobs: Maximum number of concurrent calls to the server. If
+     ``None``, the size of the HTTP connections pool will be used.
+    :param dict stats: If given, the number of ``hits``, ``misses``,
+     ``duplicates`` and ``errors`` will be accumulated into it. The number of
+     hits and duplicates found only thanks to the normalization of the
+     contents is accumulated as ``normalized``.
+    :param bool batch: Render the cache misses for ``local://`` servers in
+     batch. If ``None``, the ``local_batch`` default will be used.
+    :param config: Configuration to use for all the contents. If ``None``,
+     the current configuration will be used.
+    :type config: :class:`plantweb.defaults.RenderConfig`
+    :param executor: Pool of threads to render the cache misses, shared
+     between calls. If ``None``, a pool of ``jobs`` threads is created for
+     this call.
+    :type executor: :py:class:`concurrent.futures.ThreadPoolExecutor`
+
+    :return: A list with, for each content and in the same order, either a
+     tuple of ``(output, format, engine, sha)`` as in :func:`render` or the
+     exception raised while rendering it.
+    :rtype: list
+    """
+    if cacheopts is None:
+        cacheopts = {}
+    if config is None:
+        config = get_config()
+    if jobs is None:
+        jobs = config.http_pool_size
+    if stats is None:
+        stats = {}
+    for counter in ['hits', 'misses', 'duplicates', 'errors', 'normalized']:
+        stats.setdefault(counter, 0)
+
+    use_cache, cache_dir = cache_options(
+        cacheopts.get('use_cache'), cacheopts.get('cache_dir'), config
+    )
+    normalize = cacheopts.get('normalize')
+    if normalize is None:
+        normalize = config.normalize_content
+    if batch is None:
+        batch = config.local_batch
+
+    results = [None] * len(contents)
+
+    # Prepare contents and group them by rendering key
+    pending = OrderedDict()
+    originals = set()
+    normalized = set()
+
+    for index, content in enumerate(contents):
+        try:
+            content, item_engine, item_format, item_server = prepare(
+                content, engine=engine, format=format, server=server,
+                config=config
+            )
+        except Exception as e:
+            results[index] = e
+            continue
+
+        original = (content, item_format, item_server)
+        if normalize:
+            content = normalize_content(content)
+
+        sha = _cache_key(
+            content, item_server, determine_engine(content),
+            cacheopts.get('namespace'), config
         )
+        key = (sha, item_format, item_server)
 
-    # Write output
-    with open(outfile, 'wb') as fd:
-        fd.write(output)
+        if key in pending:
+            pending[key][2].append(index)
+            stats['duplicates'] += 1
+            if original not in originals:
+                stats['normalized'] += 1
+            originals.add(original)
+            continue
 
-    return outfile
+        originals.add(original)
+        if original[0] != content:
+            normalized.add(key)
+
+        pending[key] = (content, item_engine, [index])
+
+    def render_key(key):
+        sha, item_format, item_server = key
+        content = pending[key][0]
+        output, sha = render_cached(
+            item_server, item_format, content,
+            session=session, config=config, **cacheopts
+        )
+        return output
+
+    # Resolve cache hits and dispatch cache misses to the pool
+    outputs = OrderedDict()
+    batched = OrderedDict()
+
+    if executor is None:
+        pool = ThreadPoolExecutor(max_workers=max(jobs, 1))
+    else:
+        pool = nullcontext(executor)
+
+    with pool as executor:
+        for key in pending:
+            sha, item_format, item_server = key
+
+            if use_cache and is_cached(
+                    cache_dir, sha, item_format, item_server, config):
+                stats['hits'] += 1
+                if key in normalized:
+                    stats['normalized'] += 1
+                try:
+                    outputs[key] = render_key(key)
+                except Exception as e:
+                    outputs[key] = e
+                continue
+
+            stats['misses'] += 1
+
+            if batch and is_local(item_server) and \
+                    get_backend(
+                        determine_engine(pending[key][0]), config
+                    ) is None:
+                batched.setdefault((item_server, item_format), []).append(key)
+                continue
+
+            outputs[key] = executor.submit(render_key, key)
+
+        # Render batched cache misses while the pool is busy
+        for (item_server, item_format), keys in batched.items():
+            if len(keys) == 1:
+                outputs[keys[0]] = executor.submit(render_key, keys[0])
+                continue
+
+            try:
+                rendered = local_batch(
+                    item_server, item_format,
+                    [pending[key][0] for key in keys], jobs=jobs,
+                    config=config
+                )
+            except Exception as e:
+                rendered = [e] * len(keys)
+
+            for key, output in zip(keys, rendered):
+                outputs[key] = output
+                if not use_cache or isinstance(output, Exception):
+                    continue
+                try:
+                    store(
+                        cache_dir, key[0], item_format, item_server, output,
+                        engine=determine_engine(pending[key][0]),
+                        config=config
+                    )
+                except Exception as e:
+                    log.warning('Unable to cache {}: {}'.format(key[0], e))
+
+    if use_cache and any(len(keys) > 1 for keys in batched.values()):
+        maybe_prune(cache_dir, config)
+
+    # Collect results in the same order of the contents
+    for key, (content, item_engine, indexes) in pending.items():
+        sha, item_format, item_server = key
+        output = outputs[key]
+
+        if isinstance(output, Future):
+            try:
+                output = output.result()
+            except Exception as e:
+                output = e
+
+        if isinstance(output, Exception):
+            log.error('Unable to render {}: {}'.format(sha, output))
+            result = output
+        else:
+            result = (output, item_format, item_engine, sha)
+
+        for index in indexes:
+            results[index] = result
+
+    stats['errors'] += sum(
+        1 for result in results if isinstance(result, Exception)
+    )
+    return results
+
+
+def render_files(
+        infiles, outfiles=None, renderopts=None, cacheopts=None,
+        jobs=None, stats=None, executor=None):
+    """
+    Render several PlantUML, Graphviz or DITAA files concurrently.
+
+    Output files in the cache directory are materialized from it without
+    reading them, as in :func:`render_file`. The others are rendered with
+    :func:`render_many`.
+
+    :param list infiles: List of paths to source files to render.
+    :param list outfiles: List of paths to output files, one for each source
+     file. If ``None``, or for any ``None`` item, the filename will be
+     auto-determined and saved to the current working directory.
+    :param dict renderopts: Rendering options (``engine``, ``format``,
+     ``server``, ``session`` and ``config``) as in :func:`render`.
+    :param dict cacheopts: Caching options (``use_cache``, ``cache_dir``,
+     ``namespace`` and ``normalize``) as in :func:`render_cached`.
+    :param int jobs: Maximum number of concurrent calls to the server as in
+     :func:`render_many`.
+    :param dict stats: Dictionary to accumulate statistics as in
+     :func:`render_many`.
+    :param executor: Pool of threads to render the files as in
+     :func:`render_many`.
+    :type executor: :py:class:`concurrent.futures.ThreadPoolExecutor`
+
+    :return: A list with, for each source file and in the same order, either
+     the path to the output file or the exception raised while rendering it.
+    :rtype: list
+    """
+    if outfiles is None:
+        outfiles = [None] * len(infiles)
+    if renderopts is None:
+        renderopts = {}
+    if cacheopts is None:
+        cacheopts = {}
+    if stats is None:
+        stats = {}
+    for counter in ['hits', 'misses', 'duplicates', 'errors', 'normalized']:
+        stats.setdefault(counter, 0)
+
+    config = renderopts.get('config') or get_config()
+    renderopts = dict(renderopts, config=config)
+    use_cache, cache_dir = cache_options(
+        cacheopts.get('use_cache'), cacheopts.get('cache_dir'), config
+    )
+
+    results = [None] * len(infiles)
+    failed = 0
+
+    # Read source files
+    contents = []
+    indexes = []
+
+    for index, infile in enumerate(infiles):
+        try:
+            with open(infile, 'rb') as fd:
+                content = fd.read().decode('utf-8')
+        except Exception as e:
+            results[index] = e
+            failed += 1
+            continue
+
+        # Materialize outputs from the cache. Errors are reported when
+        # rendering below
+        if use_cache:
+            try:
+                outfile, method, normalized = _output_file(
+                    content, infile, outfiles[index],
+                    renderopts, cacheopts, config
+                )[-3:]
+            except Exception:
+                method = None
+
+            if method is not None:
+                results[index] = outfile
+                stats['hits'] += 1
+                if normalized:
+                    stats['normalized'] += 1
+                continue
+
+        contents.append(content)
+        indexes.append(index)
+
+    # Render outputs
+    rendered = render_many(
+        contents, cacheopts=cacheopts, jobs=jobs, stats=stats,
+        executor=executor, **renderopts
+    )
+
+    # Write outputs
+    for index, result in zip(indexes, rendered):
+        if isinstance(result, Exception):
+            results[index] = result
+            continue
+
+        output, format, engine, sha = result
+        outfile = outfiles[index]
+        if outfile is None:
+            outfile = _default_outfile(infiles[index], format)
+
+        try:
+            if not use_cache or materialize_cached(
+                    cache_dir, sha, format, outfile, config=config) is None:
+                atomic_write(outfile, output)
+            results[index] = outfile
+        except Exception as e:
+            results[index] = e
+            failed += 1
+
+    stats['errors'] += failed
+    return results
 
 
 __all__ = [
+    'render_files',
+    'render_many',
     'render_file',
     'render',
+    'render_stream',
+    'async_render',
+    'async_render_cached',
+    'prepare',
+    'identify',
+    'normalize_content',
     'render_cached',
     'determine_engine',
     'WRAP_STR'
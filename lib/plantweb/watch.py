@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Source files watching module.
+
+Watches source files for changes to render them again as they are edited. See
+the ``--watch`` option of the command line interface.
+
+Changes are detected with Linux ``inotify``, called through :mod:`ctypes`, or
+by polling the modification time and size of the files where ``inotify`` is
+not available. The directories of the files are watched, so that files saved
+by editors that replace them instead of writing them in place are detected
+too.
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+import logging
+from os import read, close, stat, strerror
+from time import time, sleep
+from struct import calcsize, unpack_from
+from select import select
+from hashlib import sha256
+from threading import Event
+from abc import ABCMeta, abstractmethod
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from os.path import dirname, join, abspath
+
+from six import add_metaclass
+
+
+log = logging.getLogger(__name__)
+
+
+DEBOUNCE = 0.2
+"""
+Time, in seconds, to wait for more changes after a change is detected, so a
+burst of saves is rendered only once.
+"""
+
+POLL_INTERVAL = 0.5
+"""
+Interval, in seconds, between checks of the files when polling.
+"""
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0o2000000
+
+_EVENT = 'iIII'
+_EVENT_SIZE = calcsize(_EVENT)
+
+
+@add_metaclass(ABCMeta)
+class Watcher(object):
+    """
+    Base class of the watchers of a set of files.
+
+    :param list paths: Paths to the files to watch.
+    """
+
+    def __init__(self, paths):
+        self.paths = set(abspath(path) for path in paths)
+
+    @abstractmethod
+    def wait(self, timeout=None):
+        """
+        Wait for changes in the files.
+
+        :param float timeout: Maximum time to wait, in seconds. If ``None``,
+         wait until a change is detected.
+
+        :return: The set of paths of the files changed, empty if none changed
+         before the timeout.
+        :rtype: set
+        """
+
+    def close(self):
+        """
+        Release the resources of the watcher.
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watcher using Linux ``inotify``.
+
+    Files are reported when closed after being written, or when moved or
+    renamed into place.
+
+    :raises OSError: If ``inotify`` is not available.
+    """
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO
+
+    def __init__(self, paths):
+        super(InotifyWatcher, self).__init__(paths)
+
+        libc = CDLL(find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(get_errno(), strerror(get_errno()))
+
+        self._directories = {}
+        try:
+            for directory in sorted(set(dirname(path) for path in self.paths)):
+                wd = libc.inotify_add_watch(
+                    self._fd, directory.encode('utf-8'), self.mask
+                )
+                if wd < 0:
+                    raise OSError(get_errno(), strerror(get_errno()))
+                self._directories[wd] = directory
+        except Exception:
+            close(self._fd)
+            raise
+
+    def wait(self, timeout=None):
+        readable, _, _ = select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = read(self._fd, 64 * 1024)
+        changed = set()
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, cookie, length = unpack_from(_EVENT, data, offset)
+            offset += _EVENT_SIZE
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+
+            path = join(directory, name.decode('utf-8', 'replace'))
+            if path in self.paths:
+                changed.add(path)
+
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            close(self._fd)
+            self._fd = None
+
+
+class PollingWatcher(Watcher):
+    """
+    Watcher polling the modification time and size of the files.
+
+    :param float interval: Interval, in seconds, between checks of the files.
+    """
+
+    def __init__(self, paths, interval=POLL_INTERVAL):
+        super(PollingWatcher, self).__init__(paths)
+        self.interval = interval
+        self._signatures = {path: self._signature(path) for path in self.paths}
+
+    @staticmethod
+    def _signature(path):
+        try:
+            info = stat(path)
+        except OSError:
+            return None
+        return (info.st_mtime_ns, info.st_size)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+
+        while True:
+            changed = set()
+            for path in self.paths:
+                signature = self._signature(path)
+                if signature != self._signatures[path]:
+                    self._signatures[path] = signature
+                    changed.add(path)
+
+            if changed:
+                return changed
+
+            if deadline is None:
+                sleep(self.interval)
+                continue
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                return changed
+            sleep(min(self.interval, remaining))
+
+
+def create_watcher(paths, interval=POLL_INTERVAL):
+    """
+    Create the best watcher available for given files.
+
+    :param list paths: Paths to the files to watch.
+    :param float interval: Polling interval, in seconds, if ``inotify`` is
+     not available.
+
+    :return: An :class:`InotifyWatcher` or, if not available, a
+     :class:`PollingWatcher`.
+    :rtype: :class:`Watcher`
+    """
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, TypeError) as e:
+        log.info('Unable to use inotify, polling files: {}'.format(e))
+    return PollingWatcher(paths, interval=interval)
+
+
+def file_hash(path):
+    """
+    Compute the sha256 hash string of the content of given file.
+
+    :param str path: Path to the file.
+
+    :return: The hash string, or ``None`` if the file can't be read.
+    :rtype: str
+    """
+    try:
+        with open(path, 'rb') as fd:
+            return sha256(fd.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def watch_files(
+        paths, callback, debounce=DEBOUNCE, stop=None, watcher=None,
+        check_interval=1.0):
+    """
+    Watch given files and call back with the files whose content changed.
+
+    The hash of the content of each file is kept in memory, so saves that
+    don't change the content are ignored. After a change is detected, more
+    changes are collected until none happens for ``debounce`` seconds, so a
+    burst of saves results in a single call.
+
+    :param list paths: Paths to the files to watch.
+    :param function callback: Function called with the list of paths of the
+     files whose content changed, in the same order of ``paths``.
+    :param float debounce: Time, in seconds, to wait for more changes. See
+     :data:`DEBOUNCE`.
+    :param stop: Event to set to stop watching. If ``None``, files are
+     watched until interrupted.
+    :type stop: :py:class:`threading.Event`
+    :param watcher: Watcher to use. If ``None``, one is created with
+     :func:`create_watcher`.
+    :type watcher: :class:`Watcher`
+    :param float check_interval: Interval, in seconds, between checks of the
+     ``stop`` event.
+    """
+    paths = [abspath(path) for path in paths]
+    if stop is None:
+        stop = Event()
+    if watcher is None:
+        watcher = create_watcher(paths)
+
+    hashes = {path: file_hash(path) for path in paths}
+
+    with watcher:
+        while not stop.is_set():
+            changed = watcher.wait(check_interval)
+            if not changed:
+                continue
+
+            # Debounce bursts of saves
+            while True:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+
+            modified = []
+            for path in paths:
+                if path not in changed:
+                    continue
+
+                digest = file_hash(path)
+                if digest is None or digest == hashes[path]:
+                    continue
+
+                hashes[path] = digest
+                modified.append(path)
+
+            if modified:
+                log.debug('Files changed: {}'.format(modified))
+                callback(modified)
+
+
+__all__ = [
+    'Watcher',
+    'InotifyWatcher',
+    'PollingWatcher',
+    'create_watcher',
+    'file_hash',
+    'watch_files',
+    'DEBOUNCE',
+    'POLL_INTERVAL',
+]
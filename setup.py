@@ -65,7 +65,11 @@ setup(
     packages=find_packages('lib'),
 
     # Dependencies
+    python_requires='>=3.7',
     install_requires=find_requirements('requirements.txt'),
+    extras_require={
+        'async': ['aiohttp'],
+    },
 
     # Metadata
     author='Carlos Jenkins',
@@ -83,10 +87,13 @@ setup(
         'License :: OSI Approved :: Apache Software License',
         'Natural Language :: English',
         'Operating System :: POSIX :: Linux',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     # Sphinx autodoc cannot extract the documentation of zipped eggs with the
     # ``.. autodata::`` directive, causing caos in autoapi.
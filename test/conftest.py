@@ -25,15 +25,19 @@ from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
 from os import listdir
+from time import sleep
+from asyncio import sleep as async_sleep
 from shutil import rmtree
 from tempfile import mkdtemp
 from logging import getLogger, NOTSET
 from os import makedirs
-from os.path import join, abspath, dirname, normpath
+from os.path import join, abspath, dirname, normpath, isfile
 
 from pytest import fixture
 from sphinx.application import Sphinx
 
+from plantweb.defaults import read_defaults
+
 
 @fixture(scope='session')
 def sources():
@@ -52,6 +56,63 @@ def sources():
     return sources
 
 
+class FakePlantUML(object):
+    """
+    Fake of the calls to the PlantUML server, recording them.
+    """
+    def __init__(self):
+        # Contents rendered and all the arguments of each call
+        self.calls = []
+        self.requests = []
+
+        # Bytes returned, or the encoded content if None
+        self.output = None
+        # Seconds each call takes
+        self.delay = 0
+        # Contents including this string fail to render
+        self.fail = None
+
+    def _render(self, server, format, content, **kwargs):
+        self.calls.append(content)
+        self.requests.append(
+            dict(kwargs, server=server, format=format, content=content)
+        )
+
+        if self.fail is not None and self.fail in content:
+            raise Exception('Failed to render')
+        if self.output is None:
+            return content.encode('utf-8')
+        return self.output
+
+    def __call__(self, *args, **kwargs):
+        output = self._render(*args, **kwargs)
+        sleep(self.delay)
+        return output
+
+    async def async_call(self, *args, **kwargs):
+        output = self._render(*args, **kwargs)
+        await async_sleep(self.delay)
+        return output
+
+
+@fixture(scope='function')
+def fake_plantuml(monkeypatch):
+    from plantweb import render as rendermod
+
+    fake = FakePlantUML()
+    monkeypatch.setattr(rendermod, 'plantuml', fake)
+    monkeypatch.setattr(rendermod, 'async_plantuml', fake.async_call)
+    return fake
+
+
+@fixture(scope='function')
+def no_backends(monkeypatch):
+    # Render the diagrams of all engines in the server
+    local = dict(read_defaults())
+    local['use_backends'] = False
+    monkeypatch.setattr(read_defaults, 'cache', local, raising=False)
+
+
 class SphinxTest(object):
     """
     Run a Sphinx build for testing.
@@ -78,10 +139,22 @@ class SphinxTest(object):
             }
         }
 
-    def execute(self, content, buildername='html'):
-        # Create source index.rst
-        with open(join(self.srcdir, 'index.rst'), 'wb') as fd:
-            fd.write(content.encode('utf-8'))
+    def execute(self, content, buildername='html', documents=None,
+                parallel=0):
+        # Create source index.rst and any other document, keeping unchanged
+        # documents untouched for incremental builds
+        documents = dict(documents or {}, index=content)
+        for docname, document in documents.items():
+            path = join(self.srcdir, docname + '.rst')
+            document = document.encode('utf-8')
+
+            if isfile(path):
+                with open(path, 'rb') as fd:
+                    if fd.read() == document:
+                        continue
+
+            with open(path, 'wb') as fd:
+                fd.write(document)
 
         sphinx = Sphinx(
             self.srcdir,
@@ -90,9 +163,11 @@ class SphinxTest(object):
             self.doctreedir,
             buildername,
             confoverrides=self.confoverrides,
-            warningiserror=True
+            warningiserror=True,
+            parallel=parallel
         )
         sphinx.build()
+        return sphinx
 
     def __call__(self, *args, **kwargs):
         return self.execute(*args, **kwargs)
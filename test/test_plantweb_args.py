@@ -27,10 +27,12 @@ from __future__ import print_function, division
 from os import listdir
 from os.path import join, abspath, dirname, normpath
 
+from pytest import raises
+
 from plantweb import args
 
 
-def test_args():
+def test_args(tmpdir, monkeypatch):
 
     examples_dir = normpath(join(abspath(dirname(__file__)), '../examples/'))
     sources = [
@@ -50,3 +52,40 @@ def test_args():
 
     assert not parsed.no_cache
     assert parsed.cache_dir == '~/.cache/plantweb'
+    assert not parsed.normalize
+    assert parsed.jobs >= 1
+
+    parsed = args.parse_args(sources + ['--jobs', '4', '--normalize'])
+    assert parsed.jobs == 4
+    assert parsed.normalize
+    assert parsed.output_methods is None
+    assert not parsed.watch
+
+    parsed = args.parse_args(sources + ['--watch'])
+    assert parsed.watch
+
+    parsed = args.parse_args(sources + ['--output-methods', 'reflink,copy'])
+    assert parsed.output_methods == ['reflink', 'copy']
+
+    with raises(SystemExit):
+        args.parse_args(sources + ['--output-methods', 'teleport'])
+
+    with raises(args.InvalidArguments):
+        args.parse_args(sources + ['--jobs', '0'])
+
+    # Sources named like the cache command are rendered
+    monkeypatch.chdir(str(tmpdir))
+    with open('cache', 'w') as fd:
+        fd.write('Bob -> Alice : hello')
+
+    for argv in [['cache'], ['cache', sources[0]], ['cache', '-v']]:
+        parsed = args.parse_args(argv)
+        assert parsed.command == 'render'
+        assert parsed.sources[0] == abspath('cache')
+
+    parsed = args.parse_args(['cache', '--max-size', '1K', 'prune'])
+    assert parsed.command == 'cache'
+    assert parsed.action == 'prune'
+
+    with raises(SystemExit):
+        args.parse_args(['cache', '--help'])
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Test suite for module plantweb.backends.
+
+See http://pythontesting.net/framework/pytest/pytest-introduction/#fixtures
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+from os import chmod
+from sys import executable
+from os.path import join
+
+from pytest import raises
+
+from plantweb.defaults import read_defaults, get_config
+from plantweb.backends import get_backend, Backend, DotBackend
+from plantweb.render import render
+
+
+FAKE_DOT = '''#!{executable}
+import sys
+
+source = sys.stdin.read()
+if 'error' in source:
+    sys.stderr.write('syntax error')
+    sys.exit(1)
+sys.stdout.write('<svg format="{{}}">{{}}</svg>'.format(sys.argv[1], source))
+'''
+
+
+def test_dot_backend(tmpdir, monkeypatch, fake_plantuml):
+
+    dot = join(str(tmpdir), 'dot')
+    with open(dot, 'w') as fd:
+        fd.write(FAKE_DOT.format(executable=executable))
+    chmod(dot, 0o755)
+
+    defaults = dict(read_defaults())
+    defaults['dot'] = join(str(tmpdir), 'doesnotexist')
+    monkeypatch.setattr(read_defaults, 'cache', defaults, raising=False)
+
+    # Backends must implement the interface
+    with raises(TypeError):
+        Backend()
+
+    # Not available if not installed
+    assert get_backend('graphviz') is None
+
+    defaults['dot'] = dot
+    monkeypatch.setattr(read_defaults, 'cache', dict(defaults))
+    backend = get_backend('graphviz')
+    assert isinstance(backend, DotBackend)
+    assert get_backend('plantuml') is None
+
+    calls = fake_plantuml.calls
+
+    # Graphviz diagrams skip the server
+    output, format, engine, sha = render(
+        'digraph { a -> b }', engine='graphviz', format='svg',
+        cacheopts={'use_cache': False}
+    )
+    assert output == b'<svg format="-Tsvg">digraph { a -> b }</svg>'
+    assert engine == 'graphviz'
+    assert not calls
+
+    with raises(RuntimeError) as e:
+        backend.render('svg', '@startdot\nerror\n@enddot')
+    assert 'syntax error' in str(e.value)
+
+    # Other engines, or disabled backends, use the server
+    render('Bob -> Alice', engine='plantuml', cacheopts={'use_cache': False})
+    defaults['use_backends'] = False
+    monkeypatch.setattr(read_defaults, 'cache', dict(defaults))
+    render(
+        'digraph { a -> b }', engine='graphviz',
+        cacheopts={'use_cache': False}
+    )
+    assert len(calls) == 2
+
+    # Explicit configurations are used instead of the current one
+    config = get_config()._replace(dot=dot, use_backends=True)
+    defaults['dot'] = join(str(tmpdir), 'doesnotexist')
+    monkeypatch.setattr(read_defaults, 'cache', dict(defaults))
+    assert get_backend('graphviz') is None
+    assert get_backend('graphviz', config) is backend
+
+    output, format, engine, sha = render(
+        'digraph { a -> b }', engine='graphviz', format='svg',
+        cacheopts={'use_cache': False}, config=config
+    )
+    assert output == b'<svg format="-Tsvg">digraph { a -> b }</svg>'
+    assert len(calls) == 2
+
+    # Backend renders never share the cache entries of server renders
+    cache_dir = str(tmpdir.mkdir('cache'))
+    cacheopts = {'use_cache': True, 'cache_dir': cache_dir}
+    output, format, engine, backend_sha = render(
+        'digraph { a -> b }', engine='graphviz', format='svg',
+        cacheopts=cacheopts, config=config
+    )
+    assert output == b'<svg format="-Tsvg">digraph { a -> b }</svg>'
+    output, format, engine, server_sha = render(
+        'digraph { a -> b }', engine='graphviz', format='svg',
+        cacheopts=cacheopts
+    )
+    assert output == calls[-1].encode('utf-8')
+    assert backend_sha != server_sha
+    assert len(calls) == 3
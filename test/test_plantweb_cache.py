@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Test suite for module plantweb.cache.
+
+See http://pythontesting.net/framework/pytest/pytest-introduction/#fixtures
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+from os import remove, listdir, utime, stat
+from os.path import join, isfile, dirname, basename, islink, realpath
+from hashlib import sha256
+from time import sleep, time
+from sqlite3 import connect
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context, get_all_start_methods
+
+from pytest import mark, raises
+
+from plantweb import cache
+from plantweb.defaults import read_defaults, get_config
+from plantweb.cache import MemoryCache, cache_path, write_cache
+from plantweb.cache import cache_stats, prune_cache, clear_cache
+from plantweb.cache import verify_cache, maybe_prune
+from plantweb.cache import prepare_cache_dir, get_index, cache_key
+from plantweb.cache import materialize
+from plantweb.render import render_cached
+
+
+def test_memory_cache():
+
+    memory = MemoryCache(max_entries=3, max_size=10)
+
+    assert memory.get('a') is None
+    memory.put('a', b'aaa')
+    memory.put('b', b'bbb')
+    memory.put('c', b'ccc')
+    assert memory.get('a') == b'aaa'
+
+    # Bounded by entries, least recently used is evicted
+    memory.put('d', b'd')
+    assert 'b' not in memory
+    assert len(memory) == 3
+
+    # Bounded by size
+    memory.put('e', b'eeeeee')
+    assert memory.size <= 10
+    assert 'e' in memory
+    assert 'c' not in memory
+
+    # Too big entries are not stored
+    memory.put('f', b'f' * 11)
+    assert 'f' not in memory
+
+    assert memory.stats() == {
+        'entries': len(memory),
+        'size': memory.size,
+        'hits': 1,
+        'misses': 1,
+        'evictions': 2,
+    }
+
+
+def test_render_cached_memory(tmpdir, monkeypatch, fake_plantuml):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    monkeypatch.setattr(
+        cache.get_memory_cache, 'cache', MemoryCache(10, 1024),
+        raising=False
+    )
+
+    content = '@startuml\nBob -> Alice : hello\n@enduml'
+    server = 'http://localhost/plantuml/'
+    output, sha = render_cached(
+        server, 'svg', content, use_cache=True, cache_dir=cache_dir
+    )
+
+    # Served from memory even if removed from disk
+    remove(cache_path(cache_dir, sha, 'svg'))
+    assert render_cached(
+        server, 'svg', content, use_cache=True, cache_dir=cache_dir
+    ) == (output, sha)
+    assert len(fake_plantuml.calls) == 1
+
+    # The memory tier is keyed by server
+    render_cached(
+        'http://otherhost/plantuml/', 'svg', content,
+        use_cache=True, cache_dir=cache_dir
+    )
+    assert len(fake_plantuml.calls) == 2
+
+    stats = cache.get_memory_cache().stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+
+
+def test_single_flight(tmpdir, monkeypatch, fake_plantuml):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    monkeypatch.setattr(
+        cache.get_memory_cache, 'cache', MemoryCache(10, 1024),
+        raising=False
+    )
+
+    fake_plantuml.delay = 0.2
+
+    content = '@startuml\nBob -> Alice : hello\n@enduml'
+
+    def render():
+        return render_cached(
+            'http://localhost/plantuml/', 'svg', content,
+            use_cache=True, cache_dir=cache_dir
+        )
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: render(), range(8)))
+
+    # Rendered once and shared, without leftover temporary or lock files
+    assert len(fake_plantuml.calls) == 1
+    assert len(set(results)) == 1
+    cache_file = cache_path(cache_dir, results[0][1], 'svg')
+    assert listdir(dirname(cache_file)) == [basename(cache_file)]
+
+
+@mark.skipif(
+    'fork' not in get_all_start_methods(),
+    reason='fork start method is not available'
+)
+def test_single_flight_processes(tmpdir, monkeypatch):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    calls_file = join(str(tmpdir), 'calls')
+
+    from plantweb import render as rendermod
+
+    def plantuml(server, format, content, **kwargs):
+        with open(calls_file, 'a') as fd:
+            fd.write('call\n')
+        sleep(0.5)
+        return content.encode('utf-8')
+    monkeypatch.setattr(rendermod, 'plantuml', plantuml)
+
+    content = '@startuml\nBob -> Alice : hi\n@enduml'
+    context = get_context('fork')
+    processes = [
+        context.Process(target=render_cached, args=(
+            'http://localhost/plantuml/', 'svg', content, True, cache_dir
+        ))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    with open(calls_file) as fd:
+        assert fd.read() == 'call\n'
+
+
+def populate(cache_dir, entries):
+    """
+    Create cache entries of given format, size and age in days.
+    """
+    now = time()
+    paths = []
+    for index, (format, size, age) in enumerate(entries):
+        path = cache_path(cache_dir, '{:064x}'.format(index), format)
+        write_cache(path, b'x' * size)
+        mtime = now - age * 24 * 60 * 60
+        utime(path, (mtime, mtime))
+        paths.append(path)
+    return paths
+
+
+def test_prune_cache(tmpdir):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    paths = populate(cache_dir, [
+        ('svg', 100, 10),
+        ('svg', 100, 5),
+        ('png', 100, 1),
+        ('png', 100, 0),
+    ])
+
+    # Leftovers and other files
+    leftover = join(cache_dir, '{}.lock'.format(paths[0]))
+    with open(leftover, 'w'):
+        pass
+    utime(leftover, (0, 0))
+    with open(join(cache_dir, 'README'), 'w'):
+        pass
+
+    stats = cache_stats(cache_dir)
+    assert stats['entries'] == 4
+    assert stats['size'] == 400
+    assert stats['formats'] == {'svg': 2, 'png': 2}
+
+    # Dry run doesn't remove anything
+    result = prune_cache(cache_dir, max_age=7, dry_run=True)
+    assert result['removed'] == 1
+    assert cache_stats(cache_dir)['entries'] == 4
+
+    # Prune by age, then by size in least recently used order
+    result = prune_cache(cache_dir, max_age=7)
+    assert result == {
+        'removed': 1, 'reclaimed': 100, 'entries': 3, 'size': 300
+    }
+    assert not isfile(paths[0])
+    assert not isfile(leftover)
+
+    result = prune_cache(cache_dir, max_size=150)
+    assert result['removed'] == 2
+    assert [isfile(path) for path in paths] == [False, False, False, True]
+
+    result = clear_cache(cache_dir)
+    assert result['removed'] == 1
+    assert cache_stats(cache_dir)['entries'] == 0
+    assert 'README' in listdir(cache_dir)
+
+
+def test_verify_cache(tmpdir):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    valid = {
+        'svg': b'<?xml version="1.0"?><svg></svg>\n',
+        'png': b'\x89PNG\r\n\x1a\n...IEND\xaeB`\x82',
+    }
+    for format, output in valid.items():
+        write_cache(cache_path(cache_dir, 'a' * 64, format), output)
+        write_cache(cache_path(cache_dir, 'b' * 64, format), output[:-12])
+    write_cache(cache_path(cache_dir, 'c' * 64, 'svg'), b'')
+
+    result = verify_cache(cache_dir)
+    assert result['entries'] == 5
+    assert sorted(result['corrupted']) == sorted([
+        cache_path(cache_dir, 'b' * 64, 'png'),
+        cache_path(cache_dir, 'b' * 64, 'svg'),
+        cache_path(cache_dir, 'c' * 64, 'svg'),
+    ])
+
+    verify_cache(cache_dir, fix=True)
+    assert verify_cache(cache_dir) == {'entries': 2, 'corrupted': []}
+
+
+def test_maybe_prune(tmpdir, monkeypatch):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    populate(cache_dir, [('svg', 100, 10), ('svg', 100, 0)])
+
+    defaults = dict(read_defaults())
+    monkeypatch.setattr(read_defaults, 'cache', defaults, raising=False)
+
+    # Disabled by default
+    defaults['cache_max_size'] = None
+    defaults['cache_max_age'] = None
+    assert maybe_prune(cache_dir) is None
+
+    defaults['cache_max_size'] = 100
+    monkeypatch.setattr(read_defaults, 'cache', dict(defaults))
+    thread = maybe_prune(cache_dir)
+    thread.join()
+    assert cache_stats(cache_dir)['entries'] == 1
+
+    # Not due again
+    assert maybe_prune(cache_dir) is None
+
+
+def test_migrate_and_index(tmpdir, monkeypatch, fake_plantuml):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+
+    # Flat layout is migrated on first use
+    flat = join(cache_dir, '{}.svg'.format('ab' * 32))
+    with open(flat, 'wb') as fd:
+        fd.write(b'<svg></svg>')
+
+    prepare_cache_dir(cache_dir)
+    assert not isfile(flat)
+    assert isfile(join(cache_dir, 'ab', '{}.svg'.format('ab' * 31)))
+    assert isfile(cache_path(cache_dir, 'ab' * 32, 'svg'))
+
+    # Index is built from the existing entries when enabled
+    defaults = dict(read_defaults())
+    defaults['cache_index'] = True
+    monkeypatch.setattr(read_defaults, 'cache', defaults, raising=False)
+
+    index = get_index(cache_dir)
+    assert [entry[:3] for entry in index.entries()] == [
+        ('ab' * 32, 'svg', 11)
+    ]
+
+    content = '@startdot\ndigraph { a -> b }\n@enddot'
+    output, sha = render_cached(
+        'http://localhost/plantuml/', 'svg', content,
+        use_cache=True, cache_dir=cache_dir
+    )
+
+    connection = connect(index.path)
+    assert connection.execute(
+        'SELECT size, engine, server FROM entries WHERE sha = ?', (sha, )
+    ).fetchall() == [(len(output), 'graphviz', 'http://localhost/plantuml/')]
+
+    # Entries are listed and pruned from the index
+    assert cache_stats(cache_dir)['entries'] == 2
+    prune_cache(cache_dir, max_size=len(output))
+    assert [entry[0] for entry in index.entries()] == [sha]
+    assert not isfile(cache_path(cache_dir, 'ab' * 32, 'svg'))
+
+    # Explicit configurations are used instead of the current one
+    other_dir = str(tmpdir.mkdir('other'))
+    defaults['cache_index'] = False
+    monkeypatch.setattr(read_defaults, 'cache', dict(defaults))
+    assert get_index(other_dir) is None
+
+    config = get_config()._replace(cache_index=True)
+    render_cached(
+        'http://localhost/plantuml/', 'svg', content,
+        use_cache=True, cache_dir=other_dir, config=config
+    )
+    assert isfile(join(other_dir, 'index.sqlite'))
+    assert [entry[0] for entry in get_index(other_dir, config).entries()] == [
+        sha
+    ]
+
+
+def test_cache_key(tmpdir, monkeypatch, fake_plantuml):
+
+    defaults = dict(read_defaults())
+    defaults['cache_namespace'] = ''
+    defaults['cache_aliases'] = {}
+    monkeypatch.setattr(read_defaults, 'cache', defaults, raising=False)
+
+    content = '@startuml\nBob -> Alice : hello\n@enduml'
+    public = 'http://plantuml.com/plantuml/'
+    internal = 'http://plantuml.internal/'
+
+    # Without namespace the key is the sha256 of the content
+    legacy = sha256(content.encode('utf-8')).hexdigest()
+    assert cache_key(content, public, 'plantuml') == legacy
+    assert cache_key(content, internal, 'plantuml') == legacy
+
+    # Namespaced by server
+    defaults['cache_namespace'] = '{server}'
+    monkeypatch.setattr(read_defaults, 'cache', dict(defaults))
+    assert cache_key(content, public, 'plantuml') != legacy
+    assert cache_key(content, public, 'plantuml') != cache_key(
+        content, internal, 'plantuml'
+    )
+    assert cache_key(content, public, 'plantuml') == cache_key(
+        content, public.rstrip('/'), 'plantuml'
+    )
+    assert cache_key(content, public, 'plantuml', namespace='') == legacy
+
+    # Aliased namespaces share the same key
+    defaults['cache_aliases'] = {
+        'http://plantuml.mirror': internal.rstrip('/')
+    }
+    monkeypatch.setattr(read_defaults, 'cache', dict(defaults))
+    assert cache_key(content, 'http://plantuml.mirror/', 'plantuml') == (
+        cache_key(content, internal, 'plantuml')
+    )
+
+    # The key identifies the cache file
+    cache_dir = str(tmpdir.mkdir('cache'))
+    for server in [public, internal, 'http://plantuml.mirror/']:
+        output, sha = render_cached(
+            server, 'svg', content, use_cache=True, cache_dir=cache_dir
+        )
+        assert sha == cache_key(content, server, 'plantuml')
+        assert isfile(cache_path(cache_dir, sha, 'svg'))
+
+    assert [
+        request['server'] for request in fake_plantuml.requests
+    ] == [public, internal]
+
+
+def test_materialize(tmpdir, monkeypatch):
+
+    source = join(str(tmpdir), 'source.svg')
+    with open(source, 'wb') as fd:
+        fd.write(b'<svg></svg>')
+
+    # Data is shared if possible
+    destination = join(str(tmpdir), 'images', 'destination.svg')
+    assert materialize(
+        source, destination, methods=['reflink', 'link']
+    ) in ['reflink', 'link']
+    with open(destination, 'rb') as fd:
+        assert fd.read() == b'<svg></svg>'
+    assert stat(destination).st_mode & 0o777 == stat(source).st_mode & 0o777
+
+    # Copied otherwise, replacing the destination
+    def link(source, destination):
+        raise OSError('Invalid cross-device link')
+    monkeypatch.setattr(cache, 'link', link)
+    monkeypatch.setattr(cache, 'ioctl', None)
+
+    with open(source, 'wb') as fd:
+        fd.write(b'<svg>changed</svg>')
+    assert materialize(source, destination) == 'copy'
+    with open(destination, 'rb') as fd:
+        assert fd.read() == b'<svg>changed</svg>'
+    assert stat(destination).st_mode & 0o777 == stat(source).st_mode & 0o777
+    assert listdir(dirname(destination)) == ['destination.svg']
+
+    # Methods are tried in the given order
+    assert materialize(source, destination, methods=['symlink']) == 'symlink'
+    assert islink(destination)
+    assert realpath(destination) == realpath(source)
+
+    monkeypatch.setattr(cache, 'copy_file_range', None)
+    assert materialize(
+        source, destination, methods=['link', 'copy']
+    ) == 'copy'
+    assert not islink(destination)
+    with open(destination, 'rb') as fd:
+        assert fd.read() == b'<svg>changed</svg>'
+
+    with raises(OSError):
+        materialize(source, destination, methods=['link'])
+    with raises(ValueError):
+        materialize(source, destination, methods=['teleport'])
+    assert listdir(dirname(destination)) == ['destination.svg']
@@ -26,13 +26,13 @@ from __future__ import print_function, division
 
 from json import dumps
 from copy import deepcopy
-from os import chdir, getcwd
+from os import chdir, getcwd, makedirs, stat, utime, remove
 from os.path import abspath, join
 from subprocess import check_call
 from shlex import split as shsplit
 from shutil import which
 
-from pytest import mark
+from pytest import mark, raises
 
 from plantweb import defaults
 
@@ -117,3 +117,108 @@ def test_defaults(tmpdir, monkeypatch):
 
     finally:
         chdir(cwd)
+
+
+def test_find_git_root(tmpdir):
+
+    repo_root = abspath(str(tmpdir.mkdir('repo')))
+    deep = join(repo_root, 'sub', 'deep')
+    makedirs(deep)
+    makedirs(join(repo_root, '.git', 'worktrees', 'wt'))
+
+    outside = abspath(str(tmpdir.mkdir('outside')))
+    assert defaults._find_git_root(outside) is None
+
+    # Directories and subdirectories of a repository
+    assert defaults._find_git_root(repo_root) == repo_root
+    assert defaults._find_git_root(deep) == repo_root
+
+    # Worktrees use a gitfile pointing to the git directory
+    worktree = abspath(str(tmpdir.mkdir('worktree')))
+    with open(join(worktree, '.git'), 'w') as fd:
+        fd.write('gitdir: ../repo/.git/worktrees/wt\n')
+    assert defaults._find_git_root(worktree) == worktree
+
+    # Invalid gitfiles are ignored
+    with open(join(outside, '.git'), 'w') as fd:
+        fd.write('gitdir: ../missing/.git\n')
+    assert defaults._find_git_root(outside) is None
+
+    # Memoized results are invalidated
+    remove(join(worktree, '.git'))
+    assert defaults._find_git_root(worktree) is None
+
+    nested = join(outside, 'nested')
+    makedirs(nested)
+    assert defaults._find_git_root(nested) is None
+
+    # Repositories created in a parent are found
+    remove(join(outside, '.git'))
+    makedirs(join(outside, '.git'))
+    assert defaults._find_git_root(outside) == outside
+    assert defaults._find_git_root(nested) == outside
+
+
+def test_read_defaults_file(tmpdir):
+
+    rcfile = join(str(tmpdir), '.plantwebrc')
+    assert defaults._read_defaults_file(rcfile) == {}
+
+    with open(rcfile, 'w') as fd:
+        fd.write(dumps({'engine': 'graphviz'}))
+    assert defaults._read_defaults_file(rcfile) == {'engine': 'graphviz'}
+
+    # File is parsed again only when modified
+    mtime = stat(rcfile).st_mtime_ns
+    with open(rcfile, 'w') as fd:
+        fd.write(dumps({'engine': 'plantuml'}))
+    utime(rcfile, ns=(mtime, mtime))
+    assert defaults._read_defaults_file(rcfile) == {'engine': 'graphviz'}
+
+    utime(rcfile, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+    assert defaults._read_defaults_file(rcfile) == {'engine': 'plantuml'}
+
+
+def test_config(monkeypatch):
+
+    # Restore the current defaults afterwards
+    monkeypatch.setattr(
+        defaults.read_defaults, 'cache', defaults.read_defaults(),
+        raising=False
+    )
+
+    overrides = {'server': 'http://plantuml.internal/', 'unknown': True}
+    monkeypatch.setattr(defaults, 'DEFAULTS_PROVIDERS', [
+        'python://plantweb.defaults.DEFAULT_CONFIG',
+        'python://test_plantweb_defaults.OVERRIDES',
+    ])
+    monkeypatch.setattr(
+        'test_plantweb_defaults.OVERRIDES', overrides, raising=False
+    )
+
+    config = defaults.reload_config()
+    assert config.server == 'http://plantuml.internal/'
+    assert config.format == defaults.DEFAULT_CONFIG['format']
+    assert not hasattr(config, 'unknown')
+
+    # The configuration is shared until the defaults change
+    assert defaults.get_config() is config
+    assert defaults.get_config() is defaults.get_config()
+
+    # Configurations are immutable
+    with raises(AttributeError):
+        config.server = 'http://plantuml.com/plantuml/'
+
+    replaced = config._replace(format='png')
+    assert replaced.format == 'png'
+    assert config.format == defaults.DEFAULT_CONFIG['format']
+
+    # Reloading swaps the configuration
+    overrides['server'] = 'http://plantuml.mirror/'
+    assert defaults.get_config() is config
+
+    reloaded = defaults.reload_config()
+    assert reloaded is not config
+    assert reloaded.server == 'http://plantuml.mirror/'
+    assert defaults.get_config() is reloaded
+    assert config.server == 'http://plantuml.internal/'
@@ -24,8 +24,11 @@ See http://pythontesting.net/framework/pytest/pytest-introduction/#fixtures
 from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
-from os import listdir
-from os.path import join, basename
+from os import listdir, remove, utime, stat
+from time import time
+from os.path import join, basename, dirname, getmtime
+
+from plantweb.cache import iter_cache
 
 
 def identify_content(content):
@@ -45,6 +48,13 @@ def images_in(path):
     ]
 
 
+def images_cached(cache_dir):
+    return [
+        basename(dirname(path)) + basename(path)
+        for path, size, mtime in iter_cache(cache_dir)
+    ]
+
+
 DIRECTIVE_CONTENT_TPL = """
 .. {}::
 
@@ -74,7 +84,7 @@ def test_directive_content(sources, sphinx):
     sphinx('\n'.join(directives))
 
     # Assert images creation
-    cached_images = images_in(sphinx.cachedir)
+    cached_images = images_cached(sphinx.cachedir)
     copied_images = images_in(join(sphinx.outdir, '_images'))
     assert len(sources) == len(cached_images)
     assert sorted(cached_images) == sorted(copied_images)
@@ -115,7 +125,159 @@ def test_directive_argument(sources, sphinx):
     for src in sources:
         assert basename(src) in source_files
 
-    cached_images = images_in(sphinx.cachedir)
+    cached_images = images_cached(sphinx.cachedir)
     copied_images = images_in(join(sphinx.outdir, '_images'))
     assert len(sources) == len(cached_images)
     assert sorted(cached_images) == sorted(copied_images)
+
+
+def test_directive_parallel(sources, sphinx):
+
+    directives = []
+    for src in sources:
+        with open(src, 'rb') as fd:
+            content = fd.read().decode('utf-8')
+        directives.append(DIRECTIVE_CONTENT_TPL.format(
+            identify_content(content),
+            '\n    '.join(content.split('\n')[1:-2])
+        ))
+
+    # Every document renders the same images concurrently
+    documents = {
+        'page{}'.format(index): ':orphan:\n\n' + '\n'.join(directives)
+        for index in range(8)
+    }
+
+    # Sphinx warns, failing the build, if the extension isn't parallel safe
+    app = sphinx('\n'.join(directives), documents=documents, parallel=4)
+    assert app.parallel == 4
+
+    metadata = app.extensions['plantweb.directive']
+    assert metadata.parallel_read_safe
+    assert metadata.parallel_write_safe
+
+    cached_images = images_cached(sphinx.cachedir)
+    copied_images = images_in(join(sphinx.outdir, '_images'))
+    assert len(sources) == len(cached_images)
+    assert sorted(cached_images) == sorted(copied_images)
+
+    # No leftovers of the atomic writes
+    assert not [
+        name for name in listdir(join(sphinx.outdir, '_images', 'plantweb'))
+        if name.endswith('.tmp')
+    ]
+
+
+def test_directive_deferred(sphinx, fake_plantuml):
+
+    fake_plantuml.output = b'<svg xmlns="http://www.w3.org/2000/svg"></svg>'
+    fake_plantuml.fail = 'Fail'
+
+    shared = DIRECTIVE_CONTENT_TPL.format('uml', 'Bob -> Alice : hello')
+    documents = {
+        'page{}'.format(index): ':orphan:\n\n' + shared +
+        DIRECTIVE_CONTENT_TPL.format('uml', 'Bob -> Page{}'.format(index))
+        for index in range(3)
+    }
+
+    # Diagrams are rendered once, after reading all documents
+    sphinx(shared, documents=documents)
+    assert len(fake_plantuml.calls) == 4
+
+    with open(join(sphinx.outdir, 'page0.html')) as fd:
+        html = fd.read()
+    assert 'plantweb://' not in html
+    assert html.count('src="_images/') == 2
+    assert len(images_in(join(sphinx.outdir, '_images'))) == 4
+
+    # Unchanged documents aren't rendered again, nor their images rewritten
+    plantweb_dir = join(sphinx.outdir, '_images', 'plantweb')
+    mtimes = {
+        name: getmtime(join(plantweb_dir, name))
+        for name in listdir(plantweb_dir)
+    }
+    documents['page1'] += '\nChanged text.\n'
+    sphinx(shared, documents=documents)
+    assert len(fake_plantuml.calls) == 4
+    assert mtimes == {
+        name: getmtime(join(plantweb_dir, name))
+        for name in listdir(plantweb_dir)
+    }
+
+    # Missing images are restored from the cache
+    for name in listdir(plantweb_dir):
+        remove(join(plantweb_dir, name))
+    sphinx(shared, documents=documents)
+    assert len(fake_plantuml.calls) == 4
+    assert sorted(listdir(plantweb_dir)) == sorted(mtimes)
+
+    # Restored images don't share the metadata of the cache files
+    for name in listdir(plantweb_dir):
+        assert stat(join(plantweb_dir, name)).st_nlink == 1
+
+    # Failures are reported
+    documents['page0'] = ':orphan:\n\n' + DIRECTIVE_CONTENT_TPL.format(
+        'uml', 'Fail'
+    )
+    app = sphinx(shared, documents=documents)
+    assert app.statuscode != 0
+
+    with open(join(sphinx.outdir, 'page0.html')) as fd:
+        assert 'Failed to render' in fd.read()
+
+
+def test_directive_dependency(sphinx, fake_plantuml):
+
+    fake_plantuml.output = b'<svg xmlns="http://www.w3.org/2000/svg"></svg>'
+
+    def write(srcfile, content, offset=0):
+        srcpath = join(sphinx.srcdir, srcfile)
+        with open(srcpath, 'w') as fd:
+            fd.write(content)
+        mtime = time() + offset
+        utime(srcpath, (mtime, mtime))
+
+    write('one.uml', 'Bob -> Alice : one')
+    write('two.uml', 'Bob -> Alice : two')
+    documents = {
+        'page': ':orphan:\n\n' + DIRECTIVE_ARGUMENT_TPL.format(
+            'uml', 'two.uml'
+        )
+    }
+    content = DIRECTIVE_ARGUMENT_TPL.format('uml', 'one.uml') + \
+        DIRECTIVE_CONTENT_TPL.format('uml', 'Bob -> Alice : inline')
+
+    sphinx(content, documents=documents)
+    assert len(fake_plantuml.calls) == 3
+
+    # Only the changed diagram is rendered again
+    write('one.uml', 'Bob -> Alice : changed', offset=10)
+    sphinx(content, documents=documents)
+    assert len(fake_plantuml.calls) == 4
+    assert 'changed' in fake_plantuml.calls[-1]
+
+
+def test_directive_gc(sphinx, fake_plantuml):
+
+    fake_plantuml.output = b'<svg xmlns="http://www.w3.org/2000/svg"></svg>'
+
+    first = DIRECTIVE_CONTENT_TPL.format('uml', 'Bob -> Alice : first')
+    second = DIRECTIVE_CONTENT_TPL.format('uml', 'Bob -> Alice : second')
+
+    plantweb_dir = join(sphinx.outdir, '_images', 'plantweb')
+    sphinx(first + second)
+    assert len(images_in(plantweb_dir)) == 2
+    assert len(images_in(join(sphinx.outdir, '_images'))) == 2
+
+    # Dry run keeps the orphaned images
+    sphinx.confoverrides['plantweb_gc_dry_run'] = True
+    sphinx(first)
+    assert len(images_in(plantweb_dir)) == 2
+
+    # Orphaned images and their copies are removed
+    sphinx.confoverrides['plantweb_gc_dry_run'] = False
+    sphinx(first + '\nChanged text.\n')
+    assert len(images_in(plantweb_dir)) == 1
+    assert images_in(join(sphinx.outdir, '_images')) == images_in(
+        plantweb_dir
+    )
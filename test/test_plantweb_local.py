@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Test suite for module plantweb.local.
+
+See http://pythontesting.net/framework/pytest/pytest-introduction/#fixtures
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+from os import chmod, kill
+from sys import executable
+from signal import SIGKILL
+from os.path import join, isfile
+
+from pytest import raises, fixture
+
+from plantweb.defaults import read_defaults
+from plantweb.local import local_jar, get_pipe, close_pipes, first_diagram
+from plantweb.cache import cache_path, cache_stats
+from plantweb.render import render_cached, render_many
+
+
+FAKE_JAVA = '''#!{executable}
+import os
+import sys
+import time
+
+with open(sys.argv[0] + '.log', 'a') as fd:
+    fd.write(' '.join(sys.argv[1:]) + '\\n')
+
+# Batch mode, writing error images for invalid diagrams
+if '-pipe' not in sys.argv:
+    code = 0
+    for source in sys.argv[sys.argv.index('UTF-8') + 1:]:
+        with open(source) as fd:
+            content = fd.read()
+        if 'Fail' in content:
+            content = 'Syntax Error?'
+            code = 1
+        with open(source.rsplit('.', 1)[0] + '.svg', 'w') as fd:
+            fd.write('<svg>{{}}</svg>'.format(content))
+    sys.exit(code)
+
+delimiter = sys.argv[sys.argv.index('-pipedelimitor') + 1].encode()
+lines = []
+for line in iter(sys.stdin.buffer.readline, b''):
+    lines.append(line)
+    if not line.startswith(b'@end'):
+        continue
+    sys.stderr.write('rendered\\n')
+    output = b''.join(lines).strip()
+    if b'Hang' in output:
+        time.sleep(60)
+    if b'Fail' in output:
+        output += b'</svg>ERROR\\n2\\nSyntax Error?\\n'
+    sys.stdout.buffer.write(
+        '<svg pid="{{}}">'.format(os.getpid()).encode() + output + b'</svg>'
+    )
+    sys.stdout.buffer.write(delimiter + b'\\n')
+    sys.stdout.flush()
+    lines = []
+'''
+
+
+@fixture
+def fake_jar(tmpdir, monkeypatch):
+    """
+    Fake PlantUML jar and java executable speaking the ``-pipe`` protocol.
+    """
+    java = join(str(tmpdir), 'java')
+    with open(java, 'w') as fd:
+        fd.write(FAKE_JAVA.format(executable=executable))
+    chmod(java, 0o755)
+
+    jar = join(str(tmpdir), 'plantuml.jar')
+    open(jar, 'w').close()
+
+    defaults = dict(read_defaults())
+    defaults['java'] = java
+    defaults['plantuml_jar'] = jar
+    monkeypatch.setattr(read_defaults, 'cache', defaults, raising=False)
+
+    yield jar
+    close_pipes()
+
+
+def test_local_jar(fake_jar):
+
+    assert local_jar('local://') == fake_jar
+    assert local_jar('local://' + fake_jar) == fake_jar
+
+    with raises(ValueError):
+        local_jar('local:///doesnotexist/plantuml.jar')
+
+
+def test_local_render(tmpdir, fake_jar):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    first = '@startuml\nBob -> Alice : hello\n@enduml'
+    second = '@startuml\nAlice -> Bob : hi\n@enduml'
+
+    output, sha = render_cached(
+        'local://', 'svg', first, use_cache=True, cache_dir=cache_dir
+    )
+    assert output.endswith(first.encode('utf-8') + b'</svg>')
+
+    # Diagrams are rendered by the same long-lived process
+    pipe = get_pipe(fake_jar, 'svg')
+    pid = pipe.process.pid
+    output, sha = render_cached(
+        'local://', 'svg', second, use_cache=True, cache_dir=cache_dir
+    )
+    assert output == '<svg pid="{}">{}</svg>'.format(pid, second).encode()
+
+    # The process is restarted if it dies
+    kill(pid, SIGKILL)
+    pipe.process.wait()
+    output = pipe.render(first)
+    assert pipe.process.pid != pid
+    assert first.encode('utf-8') in output
+
+    # Only the first diagram is rendered, ended by its tag if missing
+    output = pipe.render(first + '\n' + second)
+    assert output.endswith(first.encode('utf-8') + b'</svg>')
+    output = pipe.render(second)
+    assert output.endswith(second.encode('utf-8') + b'</svg>')
+    output = pipe.render('@startuml\nBob -> Alice : bye')
+    assert output.endswith(b'Bob -> Alice : bye\n@enduml</svg>')
+
+    # Error images of invalid diagrams are never returned nor cached
+    pid = pipe.process.pid
+    with raises(RuntimeError) as e:
+        render_cached(
+            'local://', 'svg', '@startuml\nFail\n@enduml',
+            use_cache=True, cache_dir=cache_dir
+        )
+    assert 'line 2:\nSyntax Error?' in str(e.value)
+    assert pipe.process.pid == pid
+    assert cache_stats(cache_dir)['entries'] == 2
+
+    # The process is killed and restarted if it takes too long
+    pid = pipe.process.pid
+    with raises(RuntimeError) as e:
+        pipe.render('@startuml\nHang\n@enduml', timeout=0.5)
+    assert 'timed out' in str(e.value)
+    assert pipe.render(first, timeout=5).endswith(
+        first.encode('utf-8') + b'</svg>'
+    )
+    assert pipe.process.pid != pid
+
+
+def test_first_diagram():
+
+    assert first_diagram('@startuml\nA -> B\n@enduml') == (
+        '@startuml\nA -> B\n@enduml'
+    )
+    assert first_diagram(
+        '@startuml a\nA -> B\n  @enduml\n@startuml b\nC -> D\n@enduml'
+    ) == '@startuml a\nA -> B\n  @enduml'
+    assert first_diagram('@startdot\ndigraph {}') == (
+        '@startdot\ndigraph {}\n@enddot'
+    )
+
+    with raises(ValueError):
+        first_diagram('A -> B')
+
+
+def test_local_batch(tmpdir, monkeypatch, fake_jar):
+
+    from plantweb import local
+    monkeypatch.setattr(local, 'cpu_count', lambda: 4)
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    contents = [
+        'Bob -> Alice : hello',
+        '@startuml named\nAlice -> Bob : hi\n@enduml',
+        'Bob -> Alice : hello',
+        'Fail -> Bob : hi',
+        'Bob -> Carol : hey',
+    ]
+    cacheopts = {
+        'use_cache': True,
+        'cache_dir': cache_dir
+    }
+
+    stats = {}
+    results = render_many(
+        contents, engine='plantuml', format='svg', server='local://',
+        cacheopts=cacheopts, jobs=2, stats=stats, batch=True
+    )
+    assert stats['misses'] == 4
+
+    # Diagram names are removed so outputs are found
+    assert results[1][0] == b'<svg>@startuml\nAlice -> Bob : hi\n@enduml</svg>'
+    assert results[0] == results[2]
+    assert isinstance(results[3], Exception)
+    assert b'Bob -> Carol' in results[4][0]
+
+    # Rendered with one JVM per shard and stored in the cache. The shard with
+    # the invalid diagram is rendered again one by one
+    with open(read_defaults()['java'] + '.log') as fd:
+        runs = fd.read().splitlines()
+    assert len(runs) == 4
+    assert 'Fail' not in str(results[0][0])
+    assert not any('-pipe' in run for run in runs)
+
+    for result in [results[0], results[1], results[4]]:
+        assert isfile(cache_path(cache_dir, result[3], 'svg'))
+
+    stats = {}
+    assert render_many(
+        contents, engine='plantuml', format='svg', server='local://',
+        cacheopts=cacheopts, stats=stats, batch=True
+    )[:3] == results[:3]
+    assert stats['hits'] == 3
@@ -24,11 +24,12 @@ See http://pythontesting.net/framework/pytest/pytest-introduction/#fixtures
 from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
-from os import listdir, getcwd
-from os.path import splitext, basename
+from os import listdir, getcwd, stat
+from os.path import splitext, basename, join, islink
 
 from plantweb.main import main
 from plantweb.args import parse_args
+from plantweb.cache import cache_stats
 
 
 def test_main(tmpdir, sources):
@@ -57,3 +58,145 @@ def test_main(tmpdir, sources):
     ]
 
     assert set(src_names) == set(out_names)
+
+
+def test_main_jobs(
+        tmpdir, monkeypatch, capsys, sources, fake_plantuml, no_backends):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    monkeypatch.chdir(str(tmpdir))
+    fake_plantuml.fail = 'ditaa'
+
+    parsed = parse_args(
+        sources + ['--jobs', '3', '--cache-dir', cache_dir]
+    )
+    assert parsed.jobs == 3
+
+    rcode = main(parsed)
+    assert rcode == 1
+
+    # Output lines follow the order of the sources
+    lines = capsys.readouterr().out.splitlines()
+    written = [src for src in sources if 'ditaa' not in basename(src)]
+    assert len(lines) == len(written) + 1
+    for src, line in zip(written, lines):
+        assert line.startswith('Writing output for {} '.format(src))
+
+    summary = lines[-1]
+    assert 'Rendered {} files'.format(len(sources)) in summary
+    assert '0 cache hits, {} cache misses, 1 failed'.format(
+        len(sources)
+    ) in summary
+
+
+def test_main_cache(tmpdir, capsys):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    for name in ['{}.svg'.format('a' * 64), '{}.png'.format('b' * 64)]:
+        with open(join(cache_dir, name), 'wb') as fd:
+            fd.write(b'<svg></svg>')
+
+    parsed = parse_args(['cache', 'stats', '--cache-dir', cache_dir])
+    assert parsed.command == 'cache'
+    assert main(parsed) == 0
+    out = capsys.readouterr().out
+    assert 'Entries: 2' in out
+    assert 'Formats: png (1), svg (1)' in out
+
+    parsed = parse_args(['cache', 'verify', '--cache-dir', cache_dir])
+    assert main(parsed) == 1
+    assert 'Verified 2 entries, 1 corrupted' in capsys.readouterr().out
+
+    parsed = parse_args([
+        'cache', 'prune', '--max-size', '1K', '--cache-dir', cache_dir
+    ])
+    assert parsed.max_size == 1024
+    assert main(parsed) == 0
+    assert 'Removed 0 entries' in capsys.readouterr().out
+
+    parsed = parse_args([
+        'cache', 'clear', '--dry-run', '--cache-dir', cache_dir
+    ])
+    assert main(parsed) == 0
+    assert 'Would remove 2 entries' in capsys.readouterr().out
+    assert cache_stats(cache_dir)['entries'] == 2
+
+
+def test_main_materialize(
+        tmpdir, monkeypatch, capsys, sources, fake_plantuml):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    monkeypatch.chdir(str(tmpdir))
+
+    sources = [src for src in sources if 'ditaa' not in basename(src)]
+    argv = sources + ['--cache-dir', cache_dir, '--engine', 'plantuml']
+    assert main(parse_args(argv)) == 0
+
+    def outputs():
+        return sorted(
+            name for name in listdir(str(tmpdir))
+            if splitext(name)[1] in ['.png', '.svg']
+        )
+    written = outputs()
+    assert len(written) == len(sources)
+
+    # Outputs are not linked to the cache files by default
+    assert not any(islink(name) for name in written)
+    assert all(stat(name).st_nlink == 1 for name in written)
+
+    # Outputs share the data of the cache files when links are opted in
+    assert main(parse_args(argv + ['--output-methods', 'link,copy'])) == 0
+    assert all(stat(name).st_nlink == 2 for name in written)
+
+    # Cache hits are materialized without rendering
+    calls = len(fake_plantuml.calls)
+    capsys.readouterr()
+
+    assert main(parse_args(argv + ['--output-methods', 'symlink'])) == 0
+    assert len(fake_plantuml.calls) == calls
+    assert outputs() == written
+    assert all(islink(name) for name in written)
+
+    summary = capsys.readouterr().out.splitlines()[-1]
+    assert '{} cache hits, 0 cache misses, 0 failed'.format(
+        len(sources)
+    ) in summary
+
+
+def test_main_watch(tmpdir, monkeypatch, capsys, fake_plantuml):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    monkeypatch.chdir(str(tmpdir))
+
+    from plantweb import main as mainmod
+
+    sources = []
+    for name in ['one', 'two']:
+        sources.append(join(str(tmpdir), '{}.uml'.format(name)))
+        with open(sources[-1], 'w') as fd:
+            fd.write('Bob -> Alice : {}'.format(name))
+
+    # Render changed files until interrupted
+    def watch_files(paths, callback):
+        assert paths == sources
+        with open(sources[0], 'w') as fd:
+            fd.write('Bob -> Alice : changed')
+        assert callback(sources[:1]) == 0
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(mainmod, 'watch_files', watch_files)
+
+    parsed = parse_args(sources + ['--cache-dir', cache_dir, '--watch'])
+    assert main(parsed) == 0
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[-2] == 'Writing output for {} to one.svg'.format(sources[0])
+    assert 'Rendered 1 files' in lines[-1]
+    assert '0 cache hits, 1 cache misses' in lines[-1]
+
+    with open('one.svg') as fd:
+        assert 'changed' in fd.read()
+
+    # The same session is used for the whole session
+    sessions = [request['session'] for request in fake_plantuml.requests]
+    assert len(sessions) == 3
+    assert len(set(id(session) for session in sessions)) == 1
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Test suite for module plantweb.plantuml.
+
+See http://pythontesting.net/framework/pytest/pytest-introduction/#fixtures
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+from random import Random
+from asyncio import run, gather
+from threading import Thread
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from pytest import raises, importorskip
+from requests.exceptions import HTTPError
+
+from plantweb import defaults
+from plantweb.plantuml import (
+    encode, decode, compress_and_encode, decompress_and_decode,
+    plantuml, plantuml_stream, create_session, get_session,
+    async_plantuml, close_async_session, get_async_session
+)
+
+
+def reference_encode(data):
+    """
+    Per-byte reference implementation of the PlantUML encoding.
+    """
+    def encode6bit(b):
+        if b < 10:
+            return chr(48 + b)
+        b -= 10
+        if b < 26:
+            return chr(65 + b)
+        b -= 26
+        if b < 26:
+            return chr(97 + b)
+        return '-_'[b - 26]
+
+    res = ''
+    for i in range(0, len(data), 3):
+        b1, b2, b3 = (bytearray(data[i:i + 3]) + bytearray(2))[:3]
+        res += encode6bit(b1 >> 2)
+        res += encode6bit(((b1 & 0x3) << 4) | (b2 >> 4))
+        res += encode6bit(((b2 & 0xF) << 2) | (b3 >> 6))
+        res += encode6bit(b3 & 0x3F)
+    return res
+
+
+def test_encode():
+
+    assert encode(b'') == ''
+
+    rnd = Random(0)
+    for length in list(range(0, 16)) + [255, 256, 257, 4096]:
+        data = bytes(bytearray(rnd.getrandbits(8) for _ in range(length)))
+        assert encode(data) == reference_encode(data)
+
+    # Full alphabet coverage
+    data = bytes(bytearray(range(256))) * 3
+    assert encode(data) == reference_encode(data)
+
+
+def test_decode_roundtrip():
+
+    rnd = Random(1)
+    for length in list(range(0, 16)) + [255, 256, 257, 4096]:
+        data = bytes(bytearray(rnd.getrandbits(8) for _ in range(length)))
+        decoded = decode(encode(data))
+
+        # Padding can only add up to two zero bytes
+        assert decoded[:length] == data
+        assert decoded[length:] == b'\0' * (len(decoded) - length)
+        assert len(decoded) - length < 3
+
+    # Random printable and unicode content
+    symbols = 'abcxyz ->:@{}[]()\n\t\'"ñáé漢字'
+    for length in [0, 1, 2, 3, 100, 1000, 10000]:
+        content = ''.join(rnd.choice(symbols) for _ in range(length))
+        encoded = compress_and_encode(content)
+        assert decompress_and_decode(encoded) == content.strip()
+        assert compress_and_encode(decompress_and_decode(encoded)) == encoded
+
+    with raises(ValueError):
+        decode('abc+')
+
+    # Truncated or corrupt contents are never decoded partially
+    content = ''.join(rnd.choice(symbols) for _ in range(1500))
+    encoded = compress_and_encode(content)
+    with raises(ValueError) as e:
+        decompress_and_decode(encoded[:len(encoded) // 2])
+    assert 'Truncated' in str(e.value)
+    with raises(ValueError):
+        decompress_and_decode('_' * 16)
+
+
+def test_session(monkeypatch):
+
+    monkeypatch.delattr(get_session, 'cache', raising=False)
+
+    # Shared session is pooled and created only once
+    session = get_session()
+    assert get_session() is session
+
+    adapter = session.get_adapter('http://plantuml.com/plantuml/')
+    assert adapter._pool_maxsize == defaults.DEFAULT_CONFIG['http_pool_size']
+    assert adapter.max_retries.total == defaults.DEFAULT_CONFIG['http_retries']
+    assert not adapter.max_retries.raise_on_status
+
+    session = create_session(pool_size=2, keep_alive=False, retries=0)
+    adapter = session.get_adapter('https://plantuml.com/plantuml/')
+    assert adapter._pool_maxsize == 2
+    assert session.headers['Connection'] == 'close'
+
+    # Explicit configurations get their own shared sessions
+    config = defaults.get_config()._replace(
+        http_pool_size=3, http_retries=1, http_keep_alive=False
+    )
+    session = get_session(config)
+    assert session is get_session(config)
+    assert session is not get_session()
+    assert session is get_session(config._replace(format='png'))
+
+    adapter = session.get_adapter('http://plantuml.com/plantuml/')
+    assert adapter._pool_maxsize == 3
+    assert adapter.max_retries.total == 1
+    assert session.headers['Connection'] == 'close'
+    assert create_session(config=config).headers['Connection'] == 'close'
+
+    # Given session is used to call the server
+    class Response(object):
+        content = b'<svg/>'
+
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, chunk_size):
+            for start in range(0, len(self.content), chunk_size):
+                yield self.content[start:start + chunk_size]
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.closed = True
+
+    class FakeSession(object):
+        def get(self, url, timeout=None, stream=False):
+            self.url = url
+            self.timeout = timeout
+            self.response = Response()
+            return self.response
+
+    fake = FakeSession()
+    output = plantuml(
+        'http://localhost/plantuml/', 'svg', 'Bob -> Alice : hello',
+        session=fake, timeout=5
+    )
+    assert output == b'<svg/>'
+    assert fake.url == (
+        'http://localhost/plantuml/svg/SyfFKj2rKt3CoKnELR1Io4ZDoSa70000'
+    )
+    assert fake.timeout == 5
+
+    # Streamed responses are read in chunks
+    chunks = list(plantuml_stream(
+        'http://localhost/plantuml/', 'svg', 'Bob -> Alice : hello',
+        session=fake, timeout=5, chunk_size=4
+    ))
+    assert chunks == [b'<svg', b'/>']
+    assert fake.response.closed
+
+
+def test_server_errors():
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(500)
+            self.end_headers()
+            self.wfile.write(b'Internal Server Error')
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    # Persistent server errors are retried, then raised by the response
+    session = create_session(retries=1, backoff_factor=0)
+    session.trust_env = False
+    try:
+        with raises(HTTPError) as e:
+            plantuml(
+                'http://127.0.0.1:{}/plantuml/'.format(server.server_port),
+                'svg', 'Bob -> Alice : hello', session=session, timeout=5
+            )
+        assert e.value.response.status_code == 500
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_async_plantuml():
+
+    web = importorskip('aiohttp.web')
+    requested = []
+
+    async def handler(request):
+        requested.append(request.path)
+        return web.Response(body=b'<svg/>')
+
+    async def call():
+        app = web.Application()
+        app.router.add_get('/plantuml/svg/{encoded}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        try:
+            server = 'http://127.0.0.1:{}/plantuml/'.format(port)
+            return await gather(*[
+                async_plantuml(server, 'svg', 'Bob -> Alice : hello')
+                for _ in range(5)
+            ])
+        finally:
+            await close_async_session()
+            await runner.cleanup()
+
+    outputs = run(call())
+    assert outputs == [b'<svg/>'] * 5
+    assert requested == [
+        '/plantuml/svg/SyfFKj2rKt3CoKnELR1Io4ZDoSa70000'
+    ] * 5
+
+
+def test_async_session():
+
+    importorskip('aiohttp')
+    from plantweb import plantuml as plantumlmod
+
+    async def session():
+        shared, semaphore = await get_async_session()
+        assert (shared, semaphore) == await get_async_session()
+
+        # Explicit configurations get their own shared sessions
+        config = defaults.get_config()._replace(http_pool_size=3)
+        other, limit = await get_async_session(config)
+        assert other is not shared
+        assert other.connector.limit == 3
+        return shared
+
+    # Shared sessions are closed when their event loops shut down
+    sessions = [run(session()) for _ in range(3)]
+    assert len(set(sessions)) == 3
+    assert all(shared.closed for shared in sessions)
+    assert not plantumlmod._async_sessions
+    assert not plantumlmod._async_closers
+
+    # Also when closed explicitly before
+    async def closed():
+        shared = await session()
+        await close_async_session()
+        assert shared is not await session()
+        return shared
+
+    assert run(closed()).closed
+    assert not plantumlmod._async_sessions
+    assert not plantumlmod._async_closers
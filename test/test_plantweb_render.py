@@ -24,11 +24,15 @@ See http://pythontesting.net/framework/pytest/pytest-introduction/#fixtures
 from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
-from os import listdir, getcwd
+from io import BytesIO
+from asyncio import run, gather
+from os import listdir, getcwd, walk
 from os.path import join, isfile
 
 from plantweb import defaults
-from plantweb.render import render_file, render
+from plantweb.render import render_file, render, render_files, render_many
+from plantweb.render import async_render, normalize_content, render_stream
+from plantweb.cache import cache_path
 
 from pytest import raises
 
@@ -53,7 +57,7 @@ def test_render(tmpdir, sources):
             )
 
         # Assert cache exists
-        assert isfile(join(cache_dir, '{}.{}'.format(sha, format)))
+        assert isfile(cache_path(cache_dir, sha, format))
 
 
 def test_render_forced_and_defaults(monkeypatch):
@@ -64,8 +68,12 @@ def test_render_forced_and_defaults(monkeypatch):
         'DEFAULTS_PROVIDERS',
         [defaults.DEFAULTS_PROVIDERS[0]]
     )
-    # Force reload of defaults
-    defaults.read_defaults(cached=False)
+    # Force reload of defaults, rendering graphviz diagrams in the server
+    local = dict(defaults.read_defaults(cached=False))
+    local['use_backends'] = False
+    monkeypatch.setattr(
+        defaults.read_defaults, 'cache', local, raising=False
+    )
 
     # Test forced render
     src = """\
@@ -126,7 +134,7 @@ def test_render_file(tmpdir, sources):
         print('Output file at {}'.format(outfile))
 
 
-def test_render_cache(tmpdir, monkeypatch, sources):
+def test_render_cache(tmpdir, monkeypatch, sources, no_backends):
 
     cache_dir = str(tmpdir.mkdir('cache'))
     print('Cache directory at: {}'.format(cache_dir))
@@ -155,7 +163,7 @@ def test_render_cache(tmpdir, monkeypatch, sources):
     # Re-render using cache
     from plantweb import render as rendermod
 
-    def plantuml(server, format, content):
+    def plantuml(server, format, content, **kwargs):
         raise Exception('You shouldn\'t have got here.')
     monkeypatch.setattr(rendermod, 'plantuml', plantuml)
 
@@ -174,7 +182,7 @@ def test_render_cache(tmpdir, monkeypatch, sources):
             )
 
         # Assert cache exists
-        assert isfile(join(cache_dir, '{}.{}'.format(sha, format)))
+        assert isfile(cache_path(cache_dir, sha, format))
 
     # Test server recall if not use_cache
     for src in sources:
@@ -187,3 +195,265 @@ def test_render_cache(tmpdir, monkeypatch, sources):
                     }
                 )
             assert str(e.value) == 'You shouldn\'t have got here.'
+
+
+def test_render_many(tmpdir, fake_plantuml):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    calls = fake_plantuml.calls
+    fake_plantuml.fail = 'Fail'
+
+    contents = [
+        'Bob -> Alice : hello',
+        'Alice -> Bob : hi',
+        'Bob -> Alice : hello',
+        'Fail -> Alice : hello',
+    ]
+    cacheopts = {
+        'use_cache': True,
+        'cache_dir': cache_dir
+    }
+
+    stats = {}
+    results = render_many(
+        contents, engine='plantuml', format='svg',
+        cacheopts=cacheopts, jobs=2, stats=stats
+    )
+
+    # Results are in order, duplicates are rendered once, errors are returned
+    assert len(results) == 4
+    assert len(calls) == 3
+    assert results[0] == results[2]
+    assert b'Bob -> Alice : hello' in results[0][0]
+    assert b'Alice -> Bob : hi' in results[1][0]
+    assert results[0][1:3] == ('svg', 'plantuml')
+    assert isinstance(results[3], Exception)
+    assert stats == {
+        'hits': 0, 'misses': 3, 'duplicates': 1, 'errors': 1, 'normalized': 0
+    }
+
+    # Second pass is served from cache
+    stats = {}
+    again = render_many(
+        contents, engine='plantuml', format='svg',
+        cacheopts=cacheopts, stats=stats
+    )
+    assert again[:3] == results[:3]
+    assert len(calls) == 4
+    assert stats == {
+        'hits': 2, 'misses': 1, 'duplicates': 1, 'errors': 1, 'normalized': 0
+    }
+
+    # Render files
+    infiles = []
+    for index, content in enumerate(contents):
+        infile = join(str(tmpdir), 'source{}.uml'.format(index))
+        with open(infile, 'w') as fd:
+            fd.write(content)
+        infiles.append(infile)
+    infiles.append(join(str(tmpdir), 'doesnotexist.uml'))
+
+    outfiles = [join(str(tmpdir), 'out{}.svg'.format(i)) for i in range(5)]
+    stats = {}
+    results = render_files(
+        infiles, outfiles=outfiles,
+        renderopts={'engine': 'plantuml'}, cacheopts=cacheopts, stats=stats
+    )
+    assert results[:3] == outfiles[:3]
+    assert isinstance(results[3], Exception)
+    assert isinstance(results[4], Exception)
+    assert stats['errors'] == 2
+    with open(outfiles[1], 'rb') as fd:
+        assert b'Alice -> Bob : hi' in fd.read()
+
+
+def test_normalize_content(tmpdir, fake_plantuml):
+
+    content = '@startuml\nBob -> Alice : hello\n@enduml'
+    variants = [
+        content,
+        content.replace('\n', '\r\n'),
+        '@startuml\n\nBob -> Alice : hello   \n\n@enduml\n',
+        "@startuml\n' A comment\nBob -> Alice : hello\n  'indented\n@enduml",
+    ]
+    for variant in variants:
+        assert normalize_content(variant) == content
+        assert normalize_content(normalize_content(variant)) == content
+
+    # Block comments are kept whole, including the line that closes them
+    block = (
+        "@startuml\n/' block\n' comment\n'/\nBob -> Alice : hi\n@enduml"
+    )
+    assert normalize_content(block) == block
+    assert normalize_content(
+        "@startuml\n/' block\n'/\n' comment\nBob -> Alice : hi\n@enduml"
+    ) == "@startuml\n/' block\n'/\nBob -> Alice : hi\n@enduml"
+    inline = "@startuml\n/' inline '/\n' comment\nBob -> Alice : hi\n@enduml"
+    assert normalize_content(inline) == (
+        "@startuml\n/' inline '/\nBob -> Alice : hi\n@enduml"
+    )
+
+    # Quotes are significant in ditaa diagrams
+    ditaa = "@startditaa\n+--+\n'  |\n+--+\n@endditaa"
+    assert normalize_content(ditaa) == ditaa
+
+    # Equivalent contents share the cache entries
+    calls = fake_plantuml.calls
+    cacheopts = {
+        'use_cache': True,
+        'cache_dir': str(tmpdir.mkdir('cache')),
+        'normalize': True
+    }
+
+    stats = {}
+    results = render_many(
+        variants[:3], format='svg', cacheopts=cacheopts, stats=stats
+    )
+    assert calls == [content]
+    assert len(set(results)) == 1
+    assert stats['duplicates'] == 2
+    assert stats['normalized'] == 2
+
+    stats = {}
+    render_many(variants[3:], format='svg', cacheopts=cacheopts, stats=stats)
+    assert calls == [content]
+    assert stats['hits'] == 1
+    assert stats['normalized'] == 1
+
+    # Disabled by default
+    render(variants[1], format='svg', cacheopts={
+        'use_cache': True, 'cache_dir': cacheopts['cache_dir']
+    })
+    assert calls == [content, variants[1]]
+
+
+def test_async_render(tmpdir, fake_plantuml, no_backends):
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    cacheopts = {
+        'use_cache': True,
+        'cache_dir': cache_dir
+    }
+
+    fake_plantuml.delay = 0.1
+
+    async def render_all(contents):
+        return await gather(*[
+            async_render(content, engine='graphviz', cacheopts=cacheopts)
+            for content in contents
+        ])
+
+    contents = ['a -> b', 'b -> c', 'a -> b']
+    results = run(render_all(contents))
+
+    # Concurrent renders of the same content are done once
+    assert len(fake_plantuml.calls) == 2
+    assert results[0] == results[2]
+
+    for content, (output, format, engine, sha) in zip(contents, results):
+        assert content.encode('utf-8') in output
+        assert engine == 'graphviz'
+        assert isfile(cache_path(cache_dir, sha, format))
+
+    # Synchronous render shares the cache
+    for content, result in zip(contents, results):
+        assert render(
+            content, engine='graphviz', cacheopts=cacheopts
+        ) == result
+    assert len(fake_plantuml.calls) == 2
+
+
+def test_render_config(monkeypatch, fake_plantuml):
+
+    from plantweb import render as rendermod
+
+    config = defaults.get_config()._replace(
+        server='http://plantuml.internal/', format='png', use_backends=False
+    )
+
+    # The given configuration is used instead of the defaults
+    output, format, engine, sha = render(
+        'Bob -> Alice', cacheopts={'use_cache': False}, config=config
+    )
+    assert format == 'png'
+    assert [
+        (request['server'], request['format'], request['config'])
+        for request in fake_plantuml.requests
+    ] == [('http://plantuml.internal/', 'png', config)]
+
+    # The defaults are resolved once per render
+    resolved = []
+    get_config = rendermod.get_config
+
+    def counting():
+        resolved.append(True)
+        return get_config()
+    monkeypatch.setattr(rendermod, 'get_config', counting)
+
+    render('Bob -> Alice', cacheopts={'use_cache': False})
+    assert len(resolved) == 1
+
+
+def test_render_stream(tmpdir, monkeypatch, no_backends):
+
+    from plantweb import render as rendermod
+
+    cache_dir = str(tmpdir.mkdir('cache'))
+    output = b'<svg>' + b'x' * 1000 + b'</svg>'
+    calls = []
+
+    def plantuml_stream(server, format, content, **kwargs):
+        calls.append(content)
+        for start in range(0, len(output), 100):
+            yield output[start:start + 100]
+    monkeypatch.setattr(rendermod, 'plantuml_stream', plantuml_stream)
+
+    cacheopts = {'use_cache': True, 'cache_dir': cache_dir}
+
+    # Chunks are written to the destination and the cache file
+    destination = BytesIO()
+    format, engine, sha = render_stream(
+        'Bob -> Alice : stream', destination, format='svg',
+        cacheopts=cacheopts
+    )
+    assert destination.getvalue() == output
+    assert (format, engine) == ('svg', 'plantuml')
+    with open(cache_path(cache_dir, sha, 'svg'), 'rb') as fd:
+        assert fd.read() == output
+    assert len(calls) == 1
+
+    # Cache hits are copied from the cache file
+    destination = BytesIO()
+    render_stream(
+        'Bob -> Alice : stream', destination, format='svg',
+        cacheopts=cacheopts
+    )
+    assert destination.getvalue() == output
+    assert len(calls) == 1
+
+    # Failed renders leave the cache untouched
+    def failing(server, format, content, **kwargs):
+        yield output[:100]
+        raise IOError('Connection reset')
+    monkeypatch.setattr(rendermod, 'plantuml_stream', failing)
+
+    with raises(IOError):
+        render_stream(
+            'Bob -> Alice : failed', BytesIO(), format='svg',
+            cacheopts=cacheopts
+        )
+    assert not [
+        name for _, _, names in walk(cache_dir) for name in names
+        if name.endswith('.tmp') or name.endswith('.svg') and
+        not name.startswith(sha[2:])
+    ]
+
+    # Output files are replaced only when fully written
+    src = join(str(tmpdir), 'failed.uml')
+    with open(src, 'w') as fd:
+        fd.write('Bob -> Alice : failed')
+    outfile = join(str(tmpdir), 'failed.svg')
+
+    with raises(IOError):
+        render_file(src, outfile=outfile, cacheopts=cacheopts)
+    assert not isfile(outfile)
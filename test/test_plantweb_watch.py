@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017-2019 KuraLabs S.R.L
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Test suite for module plantweb.watch.
+
+See http://pythontesting.net/framework/pytest/pytest-introduction/#fixtures
+"""
+
+from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, division
+
+from os import replace
+from os.path import join
+from time import sleep
+from queue import Queue, Empty
+from threading import Thread, Event
+
+from pytest import mark, raises
+
+from plantweb.watch import Watcher, InotifyWatcher, PollingWatcher
+from plantweb.watch import watch_files
+
+
+def write(path, content):
+    with open(path, 'w') as fd:
+        fd.write(content)
+
+
+def inotify_available():
+    try:
+        InotifyWatcher([__file__]).close()
+    except Exception:
+        return False
+    return True
+
+
+@mark.parametrize('watcher_class', [
+    lambda paths: PollingWatcher(paths, interval=0.01),
+    mark.skipif(
+        not inotify_available(), reason='inotify is not available'
+    )(InotifyWatcher),
+])
+def test_watchers(tmpdir, watcher_class):
+
+    source = join(str(tmpdir), 'one.uml')
+    other = join(str(tmpdir), 'other.uml')
+    write(source, 'Bob -> Alice')
+
+    # Watchers must implement the interface
+    with raises(TypeError):
+        Watcher([source])
+
+    with watcher_class([source]) as watcher:
+        assert watcher.wait(0.1) == set()
+
+        # Files written in place
+        write(source, 'Bob -> Alice : hello')
+        assert watcher.wait(5) == {source}
+
+        # Files replaced, as saved by some editors
+        write(source + '.swp', 'Bob -> Alice : bye')
+        replace(source + '.swp', source)
+        assert watcher.wait(5) == {source}
+
+        # Other files are ignored
+        write(other, 'Alice -> Bob')
+        assert watcher.wait(0.2) == set()
+
+
+def test_watch_files(tmpdir):
+
+    one = join(str(tmpdir), 'one.uml')
+    two = join(str(tmpdir), 'two.uml')
+    write(one, 'Bob -> Alice')
+    write(two, 'Alice -> Bob')
+
+    calls = Queue()
+    stop = Event()
+    thread = Thread(target=watch_files, args=([one, two], calls.put), kwargs={
+        'debounce': 0.3,
+        'stop': stop,
+        'watcher': PollingWatcher([one, two], interval=0.01),
+        'check_interval': 0.05,
+    })
+    thread.start()
+
+    # Let the watcher hash the files
+    sleep(0.2)
+
+    try:
+        # Saves without changes are ignored
+        write(one, 'Bob -> Alice')
+        write(one, 'Bob -> Alice : saved')
+        write(one, 'Bob -> Alice')
+        try:
+            calls.get(timeout=1)
+            assert False, 'Unchanged file rendered'
+        except Empty:
+            pass
+
+        # Bursts of saves are rendered once, in the order of the files
+        write(two, 'Alice -> Bob : hello')
+        write(one, 'Bob -> Alice : hello')
+        write(one, 'Bob -> Alice : hello again')
+        assert calls.get(timeout=5) == [one, two]
+
+        try:
+            calls.get(timeout=1)
+            assert False, 'Burst of saves rendered more than once'
+        except Empty:
+            pass
+
+    finally:
+        stop.set()
+        thread.join(5)
+
+    assert not thread.is_alive()